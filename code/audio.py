@@ -18,10 +18,17 @@
 
 import sklearn
 import numpy as np
-import sounddevice as sd
+try:
+    import sounddevice as sd
+except (ImportError, OSError):
+    # PortAudio is not available (headless machine)
+    sd = None
 from parallel import ProcessInput
+from audio_sink import AudioSink, DeviceSink, OfflineSink
 from models.ddsp import DDSP
 from models.nsf_impacts import NSF
+from latency import LatencyTracer
+from voices import VoicePool
 from multiprocessing import Event, Process
 from config import config
 
@@ -35,7 +42,11 @@ class Audio(ProcessInput):
     def __init__(self,
                  callback: callable,
                  model: str = 'nsf',
-                 sr: int = 22050):
+                 sr: int = 22050,
+                 sink: AudioSink = None,
+                 model_args: dict = None,
+                 tracer: LatencyTracer = None,
+                 voices: int = 4):
         '''
             Constructor - Creates a new instance of the Audio class.
             Parameters:
@@ -45,6 +56,14 @@ class Audio(ProcessInput):
                             Specify the audio model to load [default : 'nsf']
                 sr:         int, optional
                             Specify the sampling rate [default: 22050]
+                sink:       [AudioSink], optional
+                            Output backend for model streams [default: DeviceSink]
+                model_args: [dict], optional
+                            Keyword arguments of the model constructor
+                tracer:     [LatencyTracer], optional
+                            Tracer of the gate-to-sound latency (shared with the CV process)
+                voices:     [int], optional
+                            Number of impacts played simultaneously [default: 4]
         '''
         super().__init__('audio')
         # Setup audio callback 
@@ -53,9 +72,13 @@ class Audio(ProcessInput):
         self._signal = Event()
         # Configure audio
         self._sr = sr
-        # Set devices default
-        self.set_defaults()
+        # Output backend (sets devices default)
+        self._sink = sink if sink is not None else DeviceSink(self._sr)
         self._model_name = model
+        self._model_args = model_args if model_args is not None else {}
+        self._tracer = tracer if tracer is not None else LatencyTracer()
+        # Playheads of the impacts
+        self._voices = VoicePool(voices)
         # Current block stream
         self._cur_stream = None
         # Set model
@@ -65,7 +88,7 @@ class Audio(ProcessInput):
         if self._model_name == 'ddsp':
             self._model = DDSP()
         elif self._model_name == 'nsf':
-            self._model = NSF()
+            self._model = NSF(**self._model_args)
         else:
             raise NotImplementedError
 
@@ -80,6 +103,9 @@ class Audio(ProcessInput):
         # Perform display loop
         while True:
             self._signal.wait()
+            # Only a gate starts a trigger (other events keep its stamps)
+            if state["audio"]["event"] == config.events.gate0:
+                self._tracer.stamp('wake')
             if self._signal.is_set():
                 # The refresh comes from an external signal
                 self._signal.clear()
@@ -88,6 +114,7 @@ class Audio(ProcessInput):
     def handle_signal_event(self, state):
         cur_event = state["audio"]["event"]
         if cur_event in [config.events.gate0]:
+            self._tracer.arm()
             self.play_model_block(state)
         if cur_event in [config.events.gate1]:
             cv2 = state['cv'][2] if state['cv_active'][2] else 0.0
@@ -103,20 +130,16 @@ class Audio(ProcessInput):
             cv5 = state['cv'][5] if state['cv_active'][5] else 1.0
             print('CV LIST DETECTED - Interpolate')
             self._model.interp_trio([cv2, cv3, cv4, cv5])
+        if cur_event in [config.events.latency]:
+            self._tracer.dump()
 
     def set_defaults(self):
         '''
             Sets default parameters for the soundevice library.
-            See 
+            See DeviceSink.set_defaults
         '''
-        sd.default.samplerate = self._sr
-        sd.default.device = 1
-        sd.default.latency = 'low'
-        sd.default.dtype = 'float32'
-        sd.default.blocksize = 0
-        sd.default.clip_off = False
-        sd.default.dither_off = False
-        sd.default.never_drop_input = False
+        if isinstance(self._sink, DeviceSink):
+            self._sink.set_defaults()
 
     def model_burn_in(self):
         '''
@@ -158,35 +181,28 @@ class Audio(ProcessInput):
 
     def play_model_block(self, state, wait: bool = True):
         '''
-            Play a sinus signal 
-            Parameters:
-                amplitude:  [float], optional
-                            Amplitude of the sinusoid
-                length:     [int], optional
-                            Length of signal to generate (in seconds)
+            Start a new voice of the generated impact.
+            Previous impacts keep ringing (up to the number of voices).
         '''
 
         def callback_block(outdata, frames, time, status):
-            # print('Start of call block')
-            # print(outdata.shape)
-            # cur_data = self._model.request_block(self.cur_idx)[:, np.newaxis]
-            cur_data = self._model.request_block_threaded(self.cur_idx)
-            if cur_data is None:
-                # print('Stream stopping (end of features)')
-                raise sd.CallbackStop()
-            outdata[:] = cur_data[:, np.newaxis]
-            self.cur_idx += 1
-
-        self.cur_idx = 0
+            # Mix all voices straight into the device buffer
+            playing = self._model.request_voices(self._voices, outdata[:, 0])
+            self._tracer.check_block(outdata, time.outputBufferDacTime - time.currentTime)
+            if not playing:
+                # print('Stream stopping (no voice left)')
+                raise self._sink.CallbackStop()
+
         self._model.signal_start_stream()
+        self._voices.trigger()
         if self._cur_stream == None:
-            self._cur_stream = sd.OutputStream(callback=callback_block, blocksize=512, channels=1, samplerate=self._sr)
+            self._cur_stream = self._sink.output_stream(callback_block, blocksize=512, channels=1)
             self._cur_stream.start()
             # print('Stream launched')
         elif not self._cur_stream.active:
             # print('Restart stream')
             self._cur_stream.close()
-            self._cur_stream = sd.OutputStream(callback=callback_block, blocksize=512, channels=1, samplerate=self._sr)
+            self._cur_stream = self._sink.output_stream(callback_block, blocksize=512, channels=1)
             self._cur_stream.start()
 
     def play_sine_block(self, amplitude=1.0, frequency=440.0):
@@ -306,10 +322,83 @@ class Audio(ProcessInput):
         return sd.query_hostapis()
 
 
-if __name__ == '__main__':
-    audio = Audio(None)
+def benchmark_offline(audio, n_gates: int = 1, interval: float = 2.0, timeout: float = 60.0):
+    '''
+        Trigger the model through the production path on an offline sink and
+        report real-time factor, underruns and gate-to-sound latency.
+        Parameters:
+            audio:      [Audio]
+                        Audio engine created with an OfflineSink
+            n_gates:    [int], optional
+                        Number of gate0 events to send [default: 1]
+            interval:   [float], optional
+                        Time between two gates (in seconds) [default: 2.0]
+            timeout:    [float], optional
+                        Maximum time to wait for the first generation [default: 60.0]
+    '''
+    import time
+    sink = audio._sink
+    model = audio._model
+    # Real-time factor of the first full generation
+    start = time.monotonic()
     audio.model_burn_in()
-    audio._signal.wait(4)
-    print('Starting play')
-    audio.play_model_block(None)
-    audio._signal.wait(1000)
+    while model._buffer.written < model._buffer.length and time.monotonic() - start < timeout:
+        time.sleep(0.001)
+    gen_time = time.monotonic() - start
+    duration = model._buffer.length * model._block_size / audio._sr
+    state = {'audio': {'event': config.events.gate0}}
+    latencies = []
+    for g in range(n_gates):
+        gate_time = time.monotonic()
+        # The gate is directly received by the audio process
+        audio._tracer.stamp('gate')
+        audio._tracer.stamp('wake')
+        audio.handle_signal_event(state)
+        time.sleep(interval)
+        sound_time = sink.first_sound(gate_time)
+        if sound_time is not None:
+            latencies.append(sound_time - gate_time)
+    if audio._cur_stream is not None:
+        audio._cur_stream.close()
+    sink.save()
+    report = sink.report()
+    report['generation_rtf'] = gen_time / duration
+    report['underruns'] = model.underruns
+    report['latency_mean'] = float(np.mean(latencies)) if len(latencies) > 0 else None
+    report['latency_max'] = float(np.max(latencies)) if len(latencies) > 0 else None
+    report['latency_stages'] = audio._tracer.percentiles()
+    report['cache'] = model.cache_stats()
+    report['source_pruning'] = model.pruning_report()
+    report['stage_cache'] = model.stage_cache_stats()
+    report['silence'] = model.silence_report()
+    report['trace_load_time'] = getattr(model._model, 'load_time', None)
+    return report
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Neurorack audio engine')
+    parser.add_argument('--offline',    type=str, default=None,     help='render to a WAV file ("null" to discard) instead of the sound card')
+    parser.add_argument('--device',     type=str, default='cuda',   help='device cuda or cpu')
+    parser.add_argument('--model_path', type=str, default=None,     help='path of the NSF checkpoint')
+    parser.add_argument('--gates',      type=int, default=1,        help='number of gates to trigger')
+    parser.add_argument('--interval',   type=float, default=2.0,    help='time between gates (in seconds)')
+    parser.add_argument('--speed',      type=float, default=1.0,    help='speed of the simulated clock (0 = free-running)')
+    args = parser.parse_args()
+    if args.offline is None:
+        audio = Audio(None)
+        audio.model_burn_in()
+        audio._signal.wait(4)
+        print('Starting play')
+        audio.play_model_block(None)
+        audio._signal.wait(1000)
+    else:
+        path = None if args.offline == 'null' else args.offline
+        sink = OfflineSink(path, speed=args.speed)
+        audio = Audio(None, sink=sink, model_args={'device': args.device, 'm_path': args.model_path})
+        report = benchmark_offline(audio, args.gates, args.interval)
+        for k, v in report.items():
+            print('{:16s} : {}'.format(k, v))
+        # Generation thread is never stopped
+        import os
+        os._exit(0)
@@ -0,0 +1,259 @@
+"""
+
+ ~ Neurorack project ~
+ Audio sink : Output backends for the audio engine
+
+ This file contains the output backends used by the Audio class.
+     - DeviceSink plays on the sound card through sounddevice
+     - OfflineSink drives the same callbacks at a simulated device clock
+       and renders them to a WAV file (or nowhere), to benchmark the
+       audio engine on machines without sound card
+
+ Author               :  Ninon Devis, Philippe Esling, Martin Vert
+                        <{devis, esling}@ircam.fr>
+
+ All authors contributed equally to the project and are listed aphabetically.
+
+"""
+
+import time
+import threading
+import numpy as np
+
+
+class AudioSink():
+    '''
+        The AudioSink class defines the interface of output backends.
+        Streams follow the sounddevice.OutputStream conventions: the callback
+        receives (outdata, frames, time, status) and raises CallbackStop to
+        end the stream.
+    '''
+
+    class CallbackStop(Exception):
+        ''' Raised by a callback to stop the stream '''
+
+    def __init__(self,
+                 samplerate: int = 22050):
+        '''
+            Constructor - Creates a new instance of the AudioSink class.
+            Parameters:
+                samplerate: [int], optional
+                            Sampling rate of the streams [default: 22050]
+        '''
+        self._sr = samplerate
+
+    def output_stream(self, callback: callable, blocksize: int = 512, channels: int = 1):
+        '''
+            Create an output stream (not started) calling back for each block.
+        '''
+        raise NotImplementedError
+
+
+class DeviceSink(AudioSink):
+    '''
+        The DeviceSink class plays streams on a sound card with sounddevice.
+    '''
+
+    def __init__(self,
+                 samplerate: int = 22050,
+                 device: int = 1):
+        '''
+            Constructor - Creates a new instance of the DeviceSink class.
+            Parameters:
+                samplerate: [int], optional
+                            Sampling rate of the streams [default: 22050]
+                device:     [int], optional
+                            Index of the sounddevice output [default: 1]
+        '''
+        super().__init__(samplerate)
+        import sounddevice as sd
+        self._sd = sd
+        self.CallbackStop = sd.CallbackStop
+        self._device = device
+        self.set_defaults()
+
+    def set_defaults(self):
+        '''
+            Sets default parameters for the soundevice library.
+        '''
+        self._sd.default.samplerate = self._sr
+        self._sd.default.device = self._device
+        self._sd.default.latency = 'low'
+        self._sd.default.dtype = 'float32'
+        self._sd.default.blocksize = 0
+        self._sd.default.clip_off = False
+        self._sd.default.dither_off = False
+        self._sd.default.never_drop_input = False
+
+    def output_stream(self, callback: callable, blocksize: int = 512, channels: int = 1):
+        return self._sd.OutputStream(callback=callback, blocksize=blocksize, channels=channels, samplerate=self._sr)
+
+
+class OfflineStatus():
+    '''
+        Callback flags of the offline streams (subset of sounddevice.CallbackFlags).
+    '''
+
+    def __init__(self):
+        self.output_underflow = False
+
+    def __bool__(self):
+        return self.output_underflow
+
+    def __str__(self):
+        return 'output underflow' if self.output_underflow else ''
+
+
+class OfflineTime():
+    '''
+        Timestamps given to the offline callbacks (simulated device clock).
+    '''
+
+    def __init__(self):
+        self.currentTime = 0.0
+        self.outputBufferDacTime = 0.0
+        self.inputBufferAdcTime = 0.0
+
+
+class OfflineStream():
+    '''
+        The OfflineStream class calls back at a simulated device clock.
+        A thread requests one block every blocksize / samplerate seconds
+        (divided by speed, or as fast as possible if speed is 0) and hands
+        the result to its sink.
+    '''
+
+    def __init__(self, sink, callback: callable, blocksize: int, channels: int):
+        self._sink = sink
+        self._callback = callback
+        self._blocksize = blocksize
+        self._outdata = np.zeros((blocksize, channels), dtype=np.float32)
+        self._thread = None
+        self.active = False
+
+    def start(self):
+        self.active = True
+        self._thread = threading.Thread(target=self.run)
+        self._thread.start()
+
+    def run(self):
+        sink = self._sink
+        period = self._blocksize / sink._sr
+        status = OfflineStatus()
+        cur_time = OfflineTime()
+        next_time = time.monotonic()
+        while self.active:
+            self._outdata.fill(0)
+            cur_time.currentTime = sink.frames / sink._sr
+            cur_time.outputBufferDacTime = cur_time.currentTime
+            start = time.monotonic()
+            try:
+                self._callback(self._outdata, self._blocksize, cur_time, status)
+            except sink.CallbackStop:
+                self.active = False
+            duration = time.monotonic() - start
+            sink.write(self._outdata, start, duration)
+            if sink.speed > 0:
+                next_time += period / sink.speed
+                wait = next_time - time.monotonic()
+                # The callback missed its deadline, as a device would report
+                status.output_underflow = wait < 0
+                if wait > 0:
+                    time.sleep(wait)
+                else:
+                    sink.xruns += 1
+                    next_time = time.monotonic()
+
+    def stop(self):
+        self.active = False
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def close(self):
+        self.stop()
+
+
+class OfflineSink(AudioSink):
+    '''
+        The OfflineSink class renders streams without sound card.
+        All blocks are concatenated on a simulated timeline and can be written
+        to a WAV file. Statistics on the callbacks allow to measure the
+        real-time behavior of the exact production code path.
+    '''
+
+    def __init__(self,
+                 path: str = None,
+                 samplerate: int = 22050,
+                 speed: float = 1.0):
+        '''
+            Constructor - Creates a new instance of the OfflineSink class.
+            Parameters:
+                path:       [str], optional
+                            WAV file to write on save (None for a null sink)
+                samplerate: [int], optional
+                            Sampling rate of the streams [default: 22050]
+                speed:      [float], optional
+                            Speed of the simulated clock (0 = as fast as possible) [default: 1.0]
+        '''
+        super().__init__(samplerate)
+        self._path = path
+        self.speed = speed
+        self.reset()
+
+    def reset(self):
+        ''' Clear the rendered audio and statistics '''
+        self._blocks = []
+        self.frames = 0
+        self.xruns = 0
+        self.callback_times = []
+        self.block_times = []
+        self.block_peaks = []
+
+    def output_stream(self, callback: callable, blocksize: int = 512, channels: int = 1):
+        return OfflineStream(self, callback, blocksize, channels)
+
+    def write(self, outdata, wall_time: float, duration: float):
+        ''' Append a block rendered by a stream '''
+        if self._path is not None:
+            self._blocks.append(outdata.copy())
+        self.frames += outdata.shape[0]
+        self.callback_times.append(duration)
+        self.block_times.append(wall_time)
+        self.block_peaks.append(float(np.max(np.abs(outdata))))
+
+    def first_sound(self, after: float, threshold: float = 1e-4):
+        '''
+            Wall time of the first non-silent block requested after a given time.
+            Returns None if no such block has been rendered yet.
+        '''
+        for cur_time, peak in zip(self.block_times, self.block_peaks):
+            if cur_time >= after and peak > threshold:
+                return cur_time
+        return None
+
+    def audio(self):
+        ''' Return the rendered audio (frames, channels) '''
+        if len(self._blocks) == 0:
+            return np.zeros((0, 1), dtype=np.float32)
+        return np.concatenate(self._blocks)
+
+    def save(self):
+        ''' Write the rendered audio to the WAV file '''
+        if self._path is None:
+            return
+        import soundfile as sf
+        sf.write(self._path, self.audio(), self._sr)
+
+    def report(self):
+        '''
+            Summary of the callback timings (in seconds) and clock overruns.
+        '''
+        period = (self.frames / max(len(self.callback_times), 1)) / self._sr
+        times = np.array(self.callback_times) if len(self.callback_times) > 0 else np.zeros(1)
+        return {
+            'blocks': len(self.callback_times),
+            'duration': self.frames / self._sr,
+            'callback_mean': float(np.mean(times)),
+            'callback_max': float(np.max(times)),
+            'callback_rtf': float(np.mean(times) / period) if period > 0 else 0.0,
+            'xruns': self.xruns}
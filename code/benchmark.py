@@ -0,0 +1,231 @@
+"""
+
+ ~ Neurorack project ~
+ Benchmark : Equivalence and timing of the model kernels
+
+ This script compares the optimised kernels of the NSF model with their
+ reference implementation, on the sizes met when generating impacts:
+     - window : one chunk with its context (as sent by the scheduler)
+     - sound  : a complete impact (301 frames)
+ Each benchmark reports the maximum absolute error against the reference
+ and the average time of both versions.
+
+ Usage:
+     python benchmark.py [names] --device cpu --repeat 10
+
+ Author               :  Ninon Devis, Philippe Esling, Martin Vert
+                        <{devis, esling}@ircam.fr>
+
+ All authors contributed equally to the project and are listed aphabetically.
+
+"""
+
+import time
+import torch
+import numpy as np
+from models.nsf import sinc_nsf
+from models.nsf import quantise
+
+# Typical lengths (in samples) of the signals inside the model
+block_size = 512
+lengths = {
+    'window': (25 + 15 + 1 + 6) * block_size,
+    'sound': 301 * block_size}
+
+# Registry of benchmarks {name: function(device, repeat)}
+benchmarks = {}
+
+
+def register(name: str):
+    '''
+        Decorator adding a benchmark function to the registry.
+    '''
+    def decorator(func):
+        benchmarks[name] = func
+        return func
+    return decorator
+
+
+def timeit(func: callable, device: str, repeat: int = 10):
+    '''
+        Average time (in seconds) of a function, after one warm-up call.
+    '''
+    with torch.no_grad():
+        func()
+        if device.startswith('cuda'):
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        for r in range(repeat):
+            func()
+        if device.startswith('cuda'):
+            torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeat
+
+
+def compare(name: str, reference: callable, optimised: callable, device: str, repeat: int = 10):
+    '''
+        Compare an optimised function with its reference.
+        Returns a row (name, max abs error, reference time, optimised time).
+    '''
+    with torch.no_grad():
+        error = (reference() - optimised()).abs().max().item()
+    t_ref = timeit(reference, device, repeat)
+    t_opt = timeit(optimised, device, repeat)
+    return (name, error, t_ref, t_opt)
+
+
+@register('fir')
+def bench_fir(device: str, repeat: int):
+    ''' TimeVarFIRFilter: unfold multiply-reduce against one roll per tap '''
+    layer = sinc_nsf.TimeVarFIRFilter().to(device)
+    rows = []
+    for size, length in lengths.items():
+        signal = torch.randn(1, length, 1, device=device)
+        coef = torch.randn(1, length, 31, device=device)
+        rows.append(compare('fir/' + size,
+                            lambda: layer.forward_roll(signal, coef),
+                            lambda: layer(signal, coef),
+                            device, repeat))
+    return rows
+
+
+@register('sinc')
+def bench_sinc(device: str, repeat: int):
+    ''' SincFilter: look-up table against exact coefficients '''
+    layer = sinc_nsf.SincFilter(31).to(device)
+    error = layer.enable_lut(device=device)
+    print('SincFilter LUT error bound: lp {:.2e}, hp {:.2e}'.format(error['lp'], error['hp']))
+    rows = []
+    for size, length in lengths.items():
+        cut_f = 0.5 + 0.4 * torch.sin(torch.linspace(0, 20, length, device=device)).view(1, -1, 1)
+        rows.append(compare('sinc/' + size,
+                            lambda: torch.cat(layer.forward_exact(cut_f), -1),
+                            lambda: torch.cat(layer(cut_f), -1),
+                            device, repeat))
+    return rows
+
+
+@register('movavg')
+def bench_movavg(device: str, repeat: int):
+    ''' MovingAverage: prefix sums against window-length convolution '''
+    rows = []
+    # hidden features (window of one block) and cut-off frequency (four blocks)
+    for dim, window in [(64, block_size), (1, 4 * block_size)]:
+        layer = sinc_nsf.MovingAverage(dim, window).to(device)
+        for size, length in lengths.items():
+            data = torch.randn(1, length, dim, device=device)
+            rows.append(compare('movavg{:d}x{:d}/'.format(dim, window) + size,
+                                lambda: layer.forward_conv(data),
+                                lambda: layer(data),
+                                device, repeat))
+    return rows
+
+
+@register('upsample')
+def bench_upsample(device: str, repeat: int):
+    ''' UpSampleLayer: fused up-sampling and smoothing against nearest up-sampling and two convolutions '''
+    layer = sinc_nsf.UpSampleLayer(64, block_size, True).to(device)
+    rows = []
+    for size, length in lengths.items():
+        frames = torch.randn(1, length // block_size, 64, device=device)
+
+        def reference():
+            up_sampled_data = layer.l_upsamp(frames.permute(0, 2, 1)).permute(0, 2, 1)
+            return layer.l_ave1.forward_conv(layer.l_ave2.forward_conv(up_sampled_data))
+        rows.append(compare('upsample/' + size, reference, lambda: layer(frames), device, repeat))
+    return rows
+
+
+@register('filter')
+def bench_filter(device: str, repeat: int):
+    ''' NeuralFilterBlock: channels-first layout against permutations around each layer '''
+    block = sinc_nsf.NeuralFilterBlock(1, 64).to(device)
+    rows = []
+    for size, length in lengths.items():
+        signal = torch.randn(1, length, 1, device=device)
+        context = torch.randn(1, length, 64, device=device)
+
+        def optimised():
+            return block.forward_cf(signal.transpose(1, 2), context.transpose(1, 2).contiguous()).transpose(1, 2)
+        rows.append(compare('filter/' + size, lambda: block(signal, context), optimised, device, repeat))
+    return rows
+
+
+@register('sine')
+def bench_sine(device: str, repeat: int):
+    ''' SineGen: harmonic phases from the fundamental phase (broadcast multiply-add) against one phase accumulation per harmonic '''
+    gen = sinc_nsf.SineGen(22050, harmonic_num=16).to(device)
+    rows = []
+    for size, length in lengths.items():
+        f0 = 200 + 150 * torch.sin(torch.linspace(0, 10, length, device=device)).view(1, -1, 1)
+        harmonics = torch.arange(1, gen.dim + 1, device=device)
+
+        def reference():
+            torch.manual_seed(0)
+            return gen._f02sine(f0 * harmonics)
+
+        def optimised():
+            torch.manual_seed(0)
+            offset = torch.rand(1, gen.dim, device=device)
+            offset[:, 0] = 0
+            phase = torch.zeros(1, 1, dtype=torch.float64, device=device)
+            return gen.harmonic_sines(f0, phase, offset)[0]
+        rows.append(compare('sine/' + size, reference, optimised, device, repeat))
+    return rows
+
+
+@register('branches')
+def bench_branches(device: str, repeat: int):
+    ''' FilterModuleHnSincNSF: harmonic and noise branches in parallel against one after the other '''
+    layer = sinc_nsf.FilterModuleHnSincNSF(1, 64).to(device)
+    print('Parallel branches on {:d} intra-op threads'.format(torch.get_num_threads()))
+    rows = []
+    for size, length in lengths.items():
+        har, noi = torch.randn(1, length, 1, device=device), torch.randn(1, length, 1, device=device)
+        context = torch.randn(1, length, 64, device=device)
+        cut_f = 0.5 + 0.4 * torch.rand(1, length, 1, device=device)
+
+        def run(parallel):
+            layer.parallel_branches = parallel
+            return layer(har, noi, context, cut_f)
+        rows.append(compare('branches/' + size, lambda: run(False), lambda: run(True), device, repeat))
+    return rows
+
+
+@register('int8')
+def bench_int8(device: str, repeat: int):
+    ''' NeuralFilterBlock: dynamic int8 dilated convs (CPU only) against float '''
+    block = sinc_nsf.NeuralFilterBlock(1, 64)
+    q_block = quantise.QuantisedFilterBlock(block)
+    q_block = torch.ao.quantization.quantize_dynamic(
+        q_block, {name: torch.ao.quantization.per_channel_dynamic_qconfig for name in q_block.quantised_layers()})
+    rows = []
+    for size, length in lengths.items():
+        signal = torch.randn(1, 1, length)
+        context = torch.randn(1, 64, length)
+        rows.append(compare('int8/' + size,
+                            lambda: block.forward_cf(signal, context),
+                            lambda: q_block.forward_cf(signal, context),
+                            'cpu', repeat))
+    return rows
+
+
+def print_rows(rows):
+    print('{:24s} {:>10s} {:>12s} {:>12s} {:>8s}'.format('benchmark', 'max error', 'reference', 'optimised', 'speedup'))
+    for name, error, t_ref, t_opt in rows:
+        print('{:24s} {:10.2e} {:10.2f}ms {:10.2f}ms {:7.2f}x'.format(
+            name, error, t_ref * 1e3, t_opt * 1e3, t_ref / t_opt))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Neurorack kernel benchmarks')
+    parser.add_argument('names',        type=str, nargs='*',            help='benchmarks to run (default: all)')
+    parser.add_argument('--device',     type=str, default='cpu',        help='device cuda or cpu')
+    parser.add_argument('--repeat',     type=int, default=10,           help='number of timed calls')
+    args = parser.parse_args()
+    torch.manual_seed(0)
+    rows = []
+    for name in (args.names if len(args.names) > 0 else benchmarks.keys()):
+        rows += benchmarks[name](args.device, args.repeat)
+    print_rows(rows)
@@ -44,6 +44,7 @@ class config:
         cv3         = 5
         cv4         = 6
         cv5         = 7
+        latency     = 8
 
     # Add the graphics classes
     colors = graph_cfg.colors
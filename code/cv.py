@@ -30,7 +30,8 @@ class CVChannels(ProcessInput):
     def __init__(self,
                  callback: callable,
                  i2c_addr=None,
-                 channels=None):
+                 channels=None,
+                 tracer=None):
         """
             Constructor - Creates a new instance of the CV class.
             Parameters:
@@ -40,6 +41,8 @@ class CVChannels(ProcessInput):
                             List of I2C addresses to find mapped CVs
                 channels:   [list], optional
                             List of channel references to read
+                tracer:     [LatencyTracer], optional
+                            Tracer timestamping the gate edges
         """
         super().__init__('cv')
         # Set signaling
@@ -48,6 +51,7 @@ class CVChannels(ProcessInput):
         if i2c_addr is None:
             i2c_addr = [0x48, 0x49]
         self._callback = callback
+        self._tracer = tracer
         self._signal = Event()
         # Configure I2C addresses and channels
         self._i2c_addresses = i2c_addr
@@ -78,6 +82,9 @@ class CVChannels(ProcessInput):
         cur_time = time.monotonic()
         if cur_state == 0:
             if value > self._ref + self._eps:
+                # Gate 0 triggers the sound
+                if cv_id == 0 and self._tracer is not None:
+                    self._tracer.stamp('gate')
                 state['cv'][cv_id] = cur_time
                 self._callback("gate", cv_id, value)
         else:
@@ -17,9 +17,10 @@ class config:
         size_big = 24
         size_large = 30
         size_small = 16
-        color_main = colors.main
-        color_alt = colors.alt
-        color_select = colors.select
+        # Nested classes cannot refer to each other (same as colors.*)
+        color_main = '#B80F0A'
+        color_alt = '#581845'
+        color_select = '#B8A9C9'
 
     class menu:
         mode_basic = 0
@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
 
+# Audio events are defined by the global configuration
+from config import config as global_config
+
+
 def model_play(state, signals, params):
     print('[Function] - Play model')
     state["audio"]["event"].value = 'model_play'
@@ -24,6 +28,12 @@ def model_benchmark(state, signal, params):
     pass
 
 
+def admin_latency(state, signals, params):
+    print('[Function] - Dump latency')
+    state["audio"]["event"] = global_config.events.latency
+    signals["audio"].set()
+
+
 def assign_cv(state, signal, params):
     pass
 
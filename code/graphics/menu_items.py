@@ -21,6 +21,7 @@ from .dialogs import ConfirmDialog
 from .graphics import Graphic, TextGraphic, SliderGraphic
 from .menu_functions import assign_cv, assign_button, assign_rotary
 from .menu_functions import model_play, model_select, model_reload, model_benchmark
+from .menu_functions import admin_latency
 
 
 class MenuItem(Graphic):
@@ -35,7 +36,8 @@ class MenuItem(Graphic):
         'model_benchmark': model_benchmark,
         'assign_cv': assign_cv,
         'assign_button': assign_button,
-        'assign_rotary': assign_rotary
+        'assign_rotary': assign_rotary,
+        'admin_latency': admin_latency
     }
 
     # region constructor
@@ -0,0 +1,146 @@
+"""
+
+ ~ Neurorack project ~
+ Latency : Tracing of the gate-to-sound latency
+
+ This file contains the latency tracer, which timestamps a trigger at each
+ hop between the CV process and the audio output.
+     - gate  : gate edge detected in CVChannels.handle_gate
+     - event : audio event set by Neurorack.callback_cv
+     - wake  : audio process woken up in Audio.callback
+     - sound : first non-silent block leaving the stream callback
+ The delays between hops are kept over a rolling window of triggers
+ to report their percentiles (p50 / p95 / p99).
+
+ Author               :  Ninon Devis, Philippe Esling, Martin Vert
+                        <{devis, esling}@ircam.fr>
+
+ All authors contributed equally to the project and are listed aphabetically.
+
+"""
+
+import time
+import collections
+import numpy as np
+from multiprocessing import Array
+
+
+class LatencyTracer():
+    '''
+        The LatencyTracer class records timestamps along the trigger path.
+        Timestamps are stored in a lock-free shared array, so that hops in
+        different processes (CV and audio) can be stamped without going
+        through the Manager (which would add its own latency).
+        The tracer must be created before the processes are started.
+    '''
+    hops = ['gate', 'event', 'wake', 'sound']
+    stages = ['callback', 'signal', 'render', 'device', 'total']
+
+    def __init__(self,
+                 window: int = 256,
+                 threshold: float = 1e-4):
+        '''
+            Constructor - Creates a new instance of the LatencyTracer class.
+            Parameters:
+                window:     [int], optional
+                            Number of triggers kept for the statistics [default: 256]
+                threshold:  [float], optional
+                            Amplitude above which a block is not silent [default: 1e-4]
+        '''
+        self._stamps = Array('d', len(self.hops), lock=False)
+        self._threshold = threshold
+        self._armed = False
+        self._dac_delay = 0.0
+        self._history = {s: collections.deque(maxlen=window) for s in self.stages}
+        self.count = 0
+
+    def stamp(self, hop: str):
+        '''
+            Timestamp a hop of the current trigger.
+            A gate starts a new trigger and clears the following hops.
+        '''
+        idx = self.hops.index(hop)
+        if idx == 0:
+            for h in range(1, len(self.hops)):
+                self._stamps[h] = 0.0
+        self._stamps[idx] = time.monotonic()
+
+    def arm(self):
+        '''
+            Wait for the first non-silent block of the current trigger.
+        '''
+        self._armed = True
+
+    def check_block(self, block, dac_delay: float = 0.0):
+        '''
+            Check a block leaving the stream callback (called from the
+            audio thread). The first non-silent block after arm() stamps
+            the sound hop and closes the trigger.
+            Parameters:
+                block:      [np.ndarray]
+                            Block of audio written to the output
+                dac_delay:  [float], optional
+                            Time between the callback and the DAC (in seconds)
+        '''
+        if not self._armed:
+            return
+        if np.max(np.abs(block)) <= self._threshold:
+            return
+        self._armed = False
+        self.stamp('sound')
+        self._dac_delay = max(dac_delay, 0.0)
+        self.complete()
+
+    def complete(self):
+        '''
+            Push the delays of the current trigger in the rolling window.
+            Stages with a missing hop (e.g. no gate when triggered from
+            the menu) are skipped.
+        '''
+        gate, event, wake, sound = self._stamps[:]
+        delays = {
+            'callback': (gate, event),
+            'signal': (event, wake),
+            'render': (wake, sound)}
+        for stage, (start, stop) in delays.items():
+            if start > 0 and stop >= start:
+                self._history[stage].append(stop - start)
+        self._history['device'].append(self._dac_delay)
+        first = [s for s in (gate, event, wake) if s > 0]
+        if len(first) > 0:
+            self._history['total'].append(sound - first[0] + self._dac_delay)
+        self.count += 1
+
+    def percentiles(self, q=(50, 95, 99)):
+        '''
+            Percentiles of the delay of each stage (in seconds).
+            Returns a dictionary {stage: {'p50': ..., 'p95': ..., 'p99': ...}}
+            Stages without any measure are set to None.
+        '''
+        stats = {}
+        for stage in self.stages:
+            values = list(self._history[stage])
+            if len(values) == 0:
+                stats[stage] = None
+                continue
+            stats[stage] = {'p%d' % p: float(v) for p, v in zip(q, np.percentile(values, q))}
+        return stats
+
+    def reset(self):
+        ''' Clear the statistics '''
+        for s in self.stages:
+            self._history[s].clear()
+        self.count = 0
+
+    def dump(self):
+        '''
+            Print the latency percentiles of each stage (in milliseconds).
+        '''
+        print('Latency over {:d} triggers (ms)'.format(self.count))
+        print('{:10s} {:>8s} {:>8s} {:>8s} {:>6s}'.format('stage', 'p50', 'p95', 'p99', 'n'))
+        for stage, stats in self.percentiles().items():
+            if stats is None:
+                print('{:10s} {:>8s} {:>8s} {:>8s} {:>6d}'.format(stage, '-', '-', '-', 0))
+                continue
+            print('{:10s} {:8.2f} {:8.2f} {:8.2f} {:6d}'.format(
+                stage, stats['p50'] * 1e3, stats['p95'] * 1e3, stats['p99'] * 1e3, len(self._history[stage])))
@@ -18,6 +18,7 @@ from rotary import Rotary
 from cv import CVChannels
 from audio import Audio
 from button import Button
+from latency import LatencyTracer
 import multiprocessing as mp
 from multiprocessing import Process, Manager, Queue, Value
 from ctypes import c_char_p
@@ -39,12 +40,14 @@ class Neurorack():
         self._N_CVs = 6
         # Init states of information
         self.init_state()
+        # Shared latency tracer (before any process is started)
+        self._tracer = LatencyTracer()
         # Create audio engine
-        self._audio = Audio(self.callback_audio)
+        self._audio = Audio(self.callback_audio, tracer=self._tracer)
         # Create rotary
         self._rotary = Rotary(self.callback_rotary)
         # Create CV channels
-        self._cvs = CVChannels(self.callback_cv)
+        self._cvs = CVChannels(self.callback_cv, tracer=self._tracer)
         # Perform GPIO cleanup
         GPIO.cleanup()
         # Need to import Screen after cleanup
@@ -149,6 +152,7 @@ class Neurorack():
         if type_cv == "gate":
             if cv_id == 0:
                 self._state['audio']['event'] = config.events.gate0
+                self._tracer.stamp('event')
                 self._signal_audio.set()
             else:
                 self._state['audio']['event'] = config.events.gate1
@@ -0,0 +1,134 @@
+"""
+
+ ~ Neurorack project ~
+ Block buffer : Preallocated block storage between generation and playback
+
+ This file contains the single-producer / single-consumer buffer holding
+ all the audio blocks of a sound, shared by the generation thread
+ (producer) and the sounddevice output callback (consumer).
+
+ Author               :  Ninon Devis, Philippe Esling, Martin Vert
+                        <{devis, esling}@ircam.fr>
+
+ All authors contributed equally to the project and are listed aphabetically.
+
+"""
+
+import numpy as np
+
+
+class BlockBuffer():
+    '''
+        The BlockBuffer class is a preallocated store of float32 audio blocks,
+        holding the whole stream (one slot per block). The producer publishes
+        blocks by moving its write cursor, which is only ever modified by the
+        producer, so that no lock is required and reading a block never
+        allocates memory. Published blocks stay resident and are overwritten
+        in place when the stream is regenerated (the producer is in charge of
+        not rewriting the blocks being played).
+    '''
+    # Status codes returned by read
+    ok          = 0
+    underrun    = 1
+    end         = 2
+
+    def __init__(self,
+                 length: int,
+                 block_size: int = 512):
+        '''
+            Constructor - Creates a new instance of the BlockBuffer class.
+            Parameters:
+                length:     [int]
+                            Length of the stream (in blocks)
+                block_size: [int], optional
+                            Number of samples per block [default: 512]
+        '''
+        self._length = length
+        self._block_size = block_size
+        self._data = np.zeros((length, block_size), dtype=np.float32)
+        # Blocks [0, _write) have been published by the producer
+        self._write = 0
+        # Number of blocks requested before being available
+        self.underruns = 0
+
+    @property
+    def length(self):
+        return self._length
+
+    @property
+    def written(self):
+        ''' Number of blocks published by the producer '''
+        return self._write
+
+    def write(self, block_idx: int, block):
+        '''
+            Copy a block in its slot (producer side).
+            The block is only visible to the consumer after a commit.
+            Already published blocks can be overwritten in place.
+        '''
+        np.copyto(self._data[block_idx], block)
+
+    def commit(self, block_idx: int):
+        '''
+            Publish all blocks up to block_idx (exclusive).
+        '''
+        if block_idx > self._write:
+            self._write = block_idx
+
+    def available(self, block_idx: int):
+        '''
+            Check if a block has been published.
+        '''
+        return block_idx < self._write
+
+    def block(self, block_idx: int):
+        '''
+            Return a view on the slot holding a given block.
+        '''
+        return self._data[block_idx]
+
+    def snapshot(self):
+        '''
+            Copy of the whole stream (None if it is not entirely published).
+        '''
+        if self._write < self._length:
+            return None
+        return self._data[:self._length].copy()
+
+    def read(self, block_idx: int, out):
+        '''
+            Copy a block into the output buffer (consumer side).
+            Returns:
+                BlockBuffer.ok        the block has been copied
+                BlockBuffer.underrun  the block is not produced yet (out is silenced)
+                BlockBuffer.end       the block is past the end of the stream
+        '''
+        if block_idx >= self._length:
+            return self.end
+        if not self.available(block_idx):
+            self.underruns += 1
+            out.fill(0)
+            return self.underrun
+        np.copyto(out, self._data[block_idx])
+        return self.ok
+
+    def gather(self, block_idx, out, status):
+        '''
+            Copy several blocks at once into the rows of out (consumer side),
+            for several playheads reading the same stream.
+            Parameters:
+                block_idx:  [np.ndarray]
+                            Indices of the blocks to read (int64)
+                out:        [np.ndarray]
+                            Output buffer (len(block_idx), block_size)
+                status:     [np.ndarray]
+                            Filled with the status of each read (see read)
+        '''
+        np.take(self._data, block_idx, axis=0, out=out, mode='clip')
+        status.fill(self.ok)
+        status[block_idx >= self._write] = self.underrun
+        status[block_idx >= self._length] = self.end
+        missing = status != self.ok
+        if missing.any():
+            out[missing] = 0
+            self.underruns += int(np.count_nonzero(status == self.underrun))
@@ -0,0 +1,81 @@
+"""
+
+ ~ Neurorack project ~
+ Feature store : Versioned features shared with the generation thread
+
+ This file contains the feature store, which holds the features rendered by
+ the generation thread. Each new version of the features (e.g. after a CV
+ change) is swapped in atomically with an increasing epoch, so that chunks
+ rendered from an older version can be recognized and dropped.
+
+ Author               :  Ninon Devis, Philippe Esling, Martin Vert
+                        <{devis, esling}@ircam.fr>
+
+ All authors contributed equally to the project and are listed aphabetically.
+
+"""
+
+import threading
+
+
+class FeatureStore():
+    '''
+        The FeatureStore class holds an (epoch, features) pair.
+        Features are never modified in place: writers build a new tensor
+        and swap it in, readers take a snapshot and keep using it for
+        the whole chunk. Each version can be tagged with a key describing
+        how it was built (e.g. for caching its rendering).
+    '''
+
+    def __init__(self,
+                 features=None):
+        '''
+            Constructor - Creates a new instance of the FeatureStore class.
+            Parameters:
+                features:   [torch.Tensor], optional
+                            Initial features (batch, frames, n_features)
+        '''
+        self._lock = threading.Lock()
+        # Replaced as a whole, so that readers never see a torn version
+        self._current = (0, features, None)
+
+    @property
+    def epoch(self):
+        return self._current[0]
+
+    @property
+    def features(self):
+        return self._current[1]
+
+    @property
+    def key(self):
+        return self._current[2]
+
+    def snapshot(self):
+        '''
+            Current (epoch, features) pair.
+        '''
+        epoch, features, _ = self._current
+        return epoch, features
+
+    def keyed_snapshot(self):
+        '''
+            Current (epoch, features, key) triple.
+        '''
+        return self._current
+
+    def swap(self, features, key=None):
+        '''
+            Publish a new version of the features.
+            Returns the epoch of this version.
+        '''
+        with self._lock:
+            epoch = self._current[0] + 1
+            self._current = (epoch, features, key)
+        return epoch
+
+    def is_current(self, epoch: int):
+        '''
+            Check that no version was published since a given epoch.
+        '''
+        return self._current[0] == epoch
@@ -0,0 +1,154 @@
+"""
+
+ ~ Neurorack project ~
+ Morph grid : Pre-rendered impacts over a grid of CV settings
+
+ This file contains the morph grid, which renders the impacts for a coarse
+ grid of CV values ahead of time. A trigger at any setting inside the grid
+ is then answered by a multilinear crossfade of the surrounding renders
+ (in the output domain), without running the model.
+ Settings outside of the grid axes are not answered (the model renders them).
+ Grids are saved on disk along with a signature of the model and of the
+ anchor features, so that they are rebuilt whenever one of them changes.
+
+ Author               :  Ninon Devis, Philippe Esling, Martin Vert
+                        <{devis, esling}@ircam.fr>
+
+ All authors contributed equally to the project and are listed aphabetically.
+
+"""
+
+import os
+import hashlib
+import itertools
+import numpy as np
+
+
+def model_signature(model, *args, features=()):
+    '''
+        Hash of the weights of a model, of any other description (grid
+        axes, ...) given as additional arguments and of the features of
+        the anchors (list of tensors).
+    '''
+    sha = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        sha.update(name.encode('utf-8'))
+        sha.update(tensor.detach().cpu().numpy().tobytes())
+    for ft in features:
+        sha.update(repr(tuple(ft.shape)).encode('utf-8'))
+        sha.update(ft.detach().cpu().numpy().tobytes())
+    for a in args:
+        sha.update(repr(a).encode('utf-8'))
+    return sha.hexdigest()
+
+
+class MorphGrid():
+    '''
+        The MorphGrid class holds one rendered sound per point of a regular
+        grid (one axis per CV). Sounds are stored as (blocks, block_size)
+        arrays, published in the BlockBuffer as the cached sounds.
+    '''
+
+    def __init__(self,
+                 axes: list,
+                 shape: tuple,
+                 signature: str,
+                 path: str = None):
+        '''
+            Constructor - Creates a new instance of the MorphGrid class.
+            Parameters:
+                axes:       [list]
+                            Increasing values of each CV on the grid
+                shape:      [tuple]
+                            Shape of each rendered sound (blocks, block_size)
+                signature:  [str]
+                            Signature of the model and anchor features (see model_signature)
+                path:       [str], optional
+                            File used to persist the grid
+        '''
+        self._axes = [np.asarray(a, dtype=np.float64) for a in axes]
+        self._shape = tuple(shape)
+        self._signature = signature
+        self._path = path
+        self._renders = None
+        self.ready = False
+
+    @property
+    def n_points(self):
+        return int(np.prod([len(a) for a in self._axes]))
+
+    @property
+    def nbytes(self):
+        return self.n_points * int(np.prod(self._shape)) * 4
+
+    def build(self, render: callable, stop=None):
+        '''
+            Render all points of the grid.
+            Parameters:
+                render:     [callable]
+                            Function of the CV values returning a sound of the grid shape
+                stop:       [Event], optional
+                            Interrupts the build when set
+            Returns False if the build was interrupted.
+        '''
+        renders = np.zeros(tuple(len(a) for a in self._axes) + self._shape, dtype=np.float32)
+        for idx in itertools.product(*[range(len(a)) for a in self._axes]):
+            if stop is not None and stop.is_set():
+                return False
+            values = [a[i] for a, i in zip(self._axes, idx)]
+            renders[idx] = render(*values)
+        self._renders = renders
+        self.ready = True
+        self.save()
+        return True
+
+    def save(self):
+        if self._path is None or not self.ready:
+            return
+        np.savez(self._path, signature=self._signature, renders=self._renders)
+
+    def load(self):
+        '''
+            Load the grid from disk if it matches the current signature.
+        '''
+        if self._path is None or not os.path.exists(self._path):
+            return False
+        with np.load(self._path) as data:
+            if str(data['signature']) != self._signature:
+                return False
+            renders = data['renders']
+        if renders.shape != tuple(len(a) for a in self._axes) + self._shape:
+            return False
+        self._renders = renders
+        self.ready = True
+        return True
+
+    def contains(self, values, tol: float = 1e-6):
+        '''
+            Check that CV values lie within the range of every axis.
+        '''
+        return all(a[0] - tol <= v <= a[-1] + tol for a, v in zip(self._axes, values))
+
+    def interpolate(self, values):
+        '''
+            Multilinear crossfade of the renders around a point of the grid.
+            Values must lie within the axes (see contains).
+        '''
+        if not self.contains(values):
+            raise ValueError('MorphGrid: values outside of the grid axes')
+        lower, frac = [], []
+        for a, v in zip(self._axes, values):
+            # Only removes rounding errors (see contains)
+            v = float(np.clip(v, a[0], a[-1]))
+            i = int(np.clip(np.searchsorted(a, v, side='right') - 1, 0, max(len(a) - 2, 0)))
+            lower.append(i)
+            frac.append(0.0 if len(a) < 2 else (v - a[i]) / (a[i + 1] - a[i]))
+        # Corners of the surrounding cell with a non-zero weight
+        corners, weights = [], []
+        for corner in itertools.product([0, 1], repeat=len(self._axes)):
+            w = np.prod([f if c else (1.0 - f) for c, f in zip(corner, frac)])
+            if w > 0:
+                corners.append([i + c for i, c in zip(lower, corner)])
+                weights.append(w)
+        corners = tuple(np.array(corners).T)
+        return np.tensordot(np.array(weights, dtype=np.float32), self._renders[corners], axes=1)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""
+distill.py for hn-sinc-NSF
+
+Knowledge distillation of a trained sinc_nsf.Model (teacher) into a
+smaller student sinc_nsf.Model, with fewer filter blocks, fewer dilated
+convs per block and fewer harmonics:
+ - the descriptor curves of a corpus of impacts (folder of wav files)
+   are rendered by the teacher, which gives the training targets
+ - the student is initialised with the teacher weights of the layers it
+   keeps (condition module, first blocks and convs, first harmonics)
+ - the student is trained on random segments of the descriptors to
+   match the teacher output, with the multi-resolution STFT loss of
+   sinc_nsf.Loss
+ - the student is reported on the anchor sounds, which must not be in
+   the corpus (held out): STFT distance to the teacher and real-time
+   factor on CPU, for both models
+
+Usage:
+ python -m models.nsf.distill model.th student.th --corpus impacts --blocks 3 --convs 6 --harmonics 8
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import time
+import random
+import argparse
+import torch
+
+from models.nsf import sinc_nsf
+from models.nsf.prune import report, print_report, weight_number
+
+__author__ = "Ninon Devis, Philippe Esling, Martin Vert"
+__email__ = "{devis, esling}@ircam.fr"
+
+
+def student_model(teacher, blocks=3, convs=6, harmonics=8):
+    """ student = student_model(teacher, blocks=3, convs=6, harmonics=8)
+    sinc_nsf.Model with blocks filter blocks of convs dilated convs and
+    harmonics harmonic overtones, initialised with the teacher weights
+    of the layers it keeps
+    """
+    mean_std = [p.detach().cpu().numpy() for p in
+                [teacher.input_mean, teacher.input_std,
+                 teacher.output_mean, teacher.output_std]]
+    student = sinc_nsf.Model(
+        teacher.input_dim, teacher.output_dim,
+        argparse.Namespace(sr=teacher.sampling_rate), mean_std,
+        hidden_dim=teacher.hidden_dim, filter_block_num=blocks,
+        cnn_num_in_block=convs, harmonic_num=harmonics)
+    # same names (and dilations) for the first blocks / convs, the
+    # merge of the harmonics keeps its first weights
+    teacher_state = teacher.state_dict()
+    state = student.state_dict()
+    for name, value in state.items():
+        if name in teacher_state:
+            state[name] = teacher_state[name][
+                tuple(slice(0, x) for x in value.shape)]
+    student.load_state_dict(state)
+    return student
+
+
+def render(model, features):
+    """ {name: output} of the model for each features (random seed 0)
+    """
+    outputs = {}
+    with torch.no_grad():
+        for name, ft in features.items():
+            torch.manual_seed(0)
+            outputs[name] = model(ft)
+    return outputs
+
+
+def distill(teacher, student, features, epochs=20, segment=64, lr=0.0003):
+    """ student = distill(teacher, student, features, ...)
+    train the student on random segments of the features (frames) to
+    match the output of the teacher
+    features: {name: features (batchsize=1, frames, dim)}
+    """
+    targets = render(teacher, features)
+    loss = sinc_nsf.Loss(None)
+    optimizer = torch.optim.Adam(
+        [p for p in student.parameters() if p.requires_grad], lr=lr)
+    names = list(features.keys())
+    up_sample = student.upsamp_rate
+    student.train()
+    for epoch in range(epochs):
+        random.shuffle(names)
+        total, start_time = 0, time.perf_counter()
+        for name in names:
+            frames = features[name].shape[1]
+            start = random.randint(0, max(frames - segment, 0))
+            stop = min(start + segment, frames)
+            output = student(features[name][:, start:stop])
+            target = targets[name][:, start * up_sample:stop * up_sample]
+            value = loss.compute(output, target)
+            optimizer.zero_grad()
+            value.backward()
+            optimizer.step()
+            total += value.item()
+        print('Epoch {:d} : loss {:.4f} ({:.1f}s)'.format(
+            epoch, total / len(names), time.perf_counter() - start_time))
+    student.eval()
+    return student
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Distill a NSF checkpoint into a smaller student')
+    parser.add_argument('model_path', type=str, help='teacher model (whole module)')
+    parser.add_argument('output_path', type=str, help='student model')
+    parser.add_argument('--blocks', type=int, default=3, help='filter blocks of the student (harmonic branch)')
+    parser.add_argument('--convs', type=int, default=6, help='dilated convs in each block of the student')
+    parser.add_argument('--harmonics', type=int, default=8, help='harmonic overtones of the student source')
+    parser.add_argument('--corpus', type=str, required=True, help='folder of the training impacts (wav), without the anchors')
+    parser.add_argument('--data', type=str, default='data', help='folder of the anchor sounds (report)')
+    parser.add_argument('--epochs', type=int, default=20, help='epochs over the corpus')
+    parser.add_argument('--segment', type=int, default=64, help='frames of the training segments')
+    parser.add_argument('--lr', type=float, default=0.0003, help='learning rate')
+    parser.add_argument('--rtf-budget', type=float, default=None, help='maximum real-time factor of the student on CPU')
+    args = parser.parse_args()
+    from models.nsf.quantise import anchor_features
+    # the corpus features are not cached with the anchor features
+    corpus = anchor_features(args.corpus, feature_path=None)
+    anchors = anchor_features(args.data)
+    if len(set(corpus) & set(anchors)) > 0:
+        parser.error('the anchors of the report are in the training corpus: ' + ', '.join(sorted(set(corpus) & set(anchors))))
+    teacher = torch.load(args.model_path, map_location='cpu')
+    teacher.eval()
+    student = student_model(teacher, args.blocks, args.convs, args.harmonics)
+    print('Weights : {:d} -> {:d}'.format(weight_number(teacher), weight_number(student)))
+    student = distill(teacher, student, corpus, args.epochs, args.segment, args.lr)
+    result = report(teacher, student, anchors)
+    print_report(result)
+    rtf = max(result['rtf'].values())
+    if args.rtf_budget is not None:
+        print('Student real-time factor {:.3f} : {:s} the budget {:.3f}'.format(
+            rtf, 'within' if rtf <= args.rtf_budget else 'above', args.rtf_budget))
+    torch.save(student, args.output_path)
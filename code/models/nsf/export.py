@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+export.py for hn-sinc-NSF
+
+TorchScript export of a sinc_nsf.Model (or optimise.InferenceModel) for
+the fixed chunk shapes sent by the scheduler. Each shape is traced once
+and saved next to the checkpoint (one file per device, as the traces
+record device constants), along with a signature of the weights, so that
+the next start only loads the traced modules. Inputs of any other shape
+fall back to the eager model, and each missing shape is reported once.
+
+Tracing records the path taken for the example input, hence it is only
+done with the default inference options (no stage cache, no parallel
+branches, no Nyquist pruning). The sinc look-up tables are traced if
+they are enabled before the export.
+
+Usage:
+ model = TracedChunks(model, [(1, 16, 7), (1, 47, 7)], 'model.th')
+ audio = model(features)
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import time
+import torch
+
+from models.morph_grid import model_signature
+
+__author__ = "Ninon Devis, Philippe Esling, Martin Vert"
+__email__ = "{devis, esling}@ircam.fr"
+
+
+def traceable(model):
+    """ reason = traceable(model)
+    None if the forward of the model only depends on the input shape,
+    otherwise the option preventing the export
+    """
+    if getattr(model, 'stage_cache', None) is not None:
+        return 'stage cache'
+    if model.m_filter.parallel_branches:
+        return 'parallel branches'
+    if model.m_source.nyquist_pruning:
+        return 'Nyquist pruning'
+    return None
+
+
+class TracedChunks():
+    """ Model with traced forwards for a set of input shapes
+    TracedChunks(model, shapes, path)
+    model: sinc_nsf.Model in eval mode
+    shapes: list of input shapes (batchsize, frames, dim)
+    path: checkpoint of the model, the traced modules are saved as
+          <path>.jit_<device>_<batchsize>x<frames>x<dim>.pt
+
+    Other attributes are those of the eager model.
+    load_time: time spent loading (or tracing) the modules
+    traced: shapes loaded from disk / traced at creation
+    misses: number of calls with each shape run by the eager model
+    """
+    def __init__(self, model, shapes, path):
+        self.model = model
+        self.modules = {}
+        self.traced = {'loaded': [], 'traced': []}
+        self.misses = {}
+        self.path = path
+        start = time.monotonic()
+        signature = model_signature(model, self.options(model))
+        for shape in sorted(set(tuple(s) for s in shapes)):
+            module = self.load(shape, signature)
+            if module is None:
+                module = self.trace(shape, signature)
+                self.traced['traced'].append(shape)
+            else:
+                self.traced['loaded'].append(shape)
+            self.modules[shape] = module
+        self.load_time = time.monotonic() - start
+
+    @staticmethod
+    def options(model):
+        """ options of the forward that change the traced graph
+        """
+        lut = model.m_filter.l_sinc_coef
+        lut = None if getattr(lut, 'lut_lp', None) is None \
+              else tuple(lut.lut_lp.shape)
+        device = str(next(model.parameters()).device)
+        return (type(model).__name__, lut, str(model.input_dim), device)
+
+    def file(self, shape):
+        return '{:s}.jit_{:s}_{:s}.pt'.format(
+            self.path, str(self.device()).replace(':', ''),
+            'x'.join(str(s) for s in shape))
+
+    def device(self):
+        return next(self.model.parameters()).device
+
+    def load(self, shape, signature):
+        """ traced module saved for this shape and signature (or None)
+        """
+        path = self.file(shape)
+        if not os.path.exists(path):
+            return None
+        extra = {'signature': ''}
+        try:
+            module = torch.jit.load(path, map_location=self.device(),
+                                    _extra_files=extra)
+        except RuntimeError:
+            return None
+        # (read back as bytes)
+        saved = extra['signature']
+        if isinstance(saved, bytes):
+            saved = saved.decode('utf-8')
+        if saved != signature:
+            return None
+        return module
+
+    def trace(self, shape, signature):
+        """ trace the model for one shape and save it
+        (the example is only used to record the operations)
+        """
+        example = torch.ones(shape, device=self.device())
+        # voiced F0 so that every branch is recorded
+        example[:, :, -1] = 100
+        with torch.no_grad():
+            module = torch.jit.trace(self.model, example, check_trace=False)
+        try:
+            torch.jit.save(module, self.file(shape),
+                           _extra_files={'signature': signature})
+        except (OSError, RuntimeError) as e:
+            print('Could not save the traced model: ' + str(e))
+        return module
+
+    def __call__(self, features):
+        shape = tuple(features.shape)
+        module = self.modules.get(shape)
+        if module is None:
+            if shape not in self.misses:
+                print('No traced module for the shape {:s}, running the eager model'.format(str(shape)))
+                self.misses[shape] = 0
+            self.misses[shape] += 1
+            return self.model(features)
+        return module(features)
+
+    def __getattr__(self, name):
+        # the other attributes (modules, options) come from the eager model
+        return getattr(self.__dict__['model'], name)
@@ -28,6 +28,63 @@ __email__ = "wangxin@nii.ac.jp"
 __copyright__ = "Copyright 2020, Xin Wang"
 
 
+def f_train_datasets(args, prj_conf):
+    """ trn_set, val_set = f_train_datasets(args, prj_conf)
+    data loaders of the training and validation sets (val_set can be
+    None), as used by the training process
+    """
+    params = {'batch_size':  args.batch_size,
+              'shuffle':  args.shuffle,
+              'num_workers': args.num_workers}
+    
+    # Load file list and create data loader
+    trn_lst = nii_list_tool.read_list_from_text(prj_conf.trn_list)
+    trn_set = nii_dset.NIIDataSetLoader(
+        prj_conf.trn_set_name, \
+        trn_lst,
+        prj_conf.input_dirs, \
+        prj_conf.input_exts, \
+        prj_conf.input_dims, \
+        prj_conf.input_reso, \
+        prj_conf.input_norm, \
+        prj_conf.output_dirs, \
+        prj_conf.output_exts, \
+        prj_conf.output_dims, \
+        prj_conf.output_reso, \
+        prj_conf.output_norm, \
+        './', 
+        params = params,
+        truncate_seq = prj_conf.truncate_seq, 
+        min_seq_len = prj_conf.minimum_len,
+        save_mean_std = True,
+        wav_samp_rate = prj_conf.wav_samp_rate)
+
+    if prj_conf.val_list is not None:
+        val_lst = nii_list_tool.read_list_from_text(prj_conf.val_list)
+        val_set = nii_dset.NIIDataSetLoader(
+            prj_conf.val_set_name,
+            val_lst,
+            prj_conf.input_dirs, \
+            prj_conf.input_exts, \
+            prj_conf.input_dims, \
+            prj_conf.input_reso, \
+            prj_conf.input_norm, \
+            prj_conf.output_dirs, \
+            prj_conf.output_exts, \
+            prj_conf.output_dims, \
+            prj_conf.output_reso, \
+            prj_conf.output_norm, \
+            './', \
+            params = params,
+            truncate_seq= prj_conf.truncate_seq, 
+            min_seq_len = prj_conf.minimum_len,
+            save_mean_std = False,
+            wav_samp_rate = prj_conf.wav_samp_rate)
+    else:
+        val_set = None
+    return trn_set, val_set
+
+
 def main():
     """ main(): the default wrapper for training and inference process
     Please prepare config.py and model.py
@@ -49,55 +106,7 @@ def main():
 
     # prepare data io    
     if not args.inference:
-        params = {'batch_size':  args.batch_size,
-                  'shuffle':  args.shuffle,
-                  'num_workers': args.num_workers}
-        
-        # Load file list and create data loader
-        trn_lst = nii_list_tool.read_list_from_text(prj_conf.trn_list)
-        trn_set = nii_dset.NIIDataSetLoader(
-            prj_conf.trn_set_name, \
-            trn_lst,
-            prj_conf.input_dirs, \
-            prj_conf.input_exts, \
-            prj_conf.input_dims, \
-            prj_conf.input_reso, \
-            prj_conf.input_norm, \
-            prj_conf.output_dirs, \
-            prj_conf.output_exts, \
-            prj_conf.output_dims, \
-            prj_conf.output_reso, \
-            prj_conf.output_norm, \
-            './', 
-            params = params,
-            truncate_seq = prj_conf.truncate_seq, 
-            min_seq_len = prj_conf.minimum_len,
-            save_mean_std = True,
-            wav_samp_rate = prj_conf.wav_samp_rate)
-
-        if prj_conf.val_list is not None:
-            val_lst = nii_list_tool.read_list_from_text(prj_conf.val_list)
-            val_set = nii_dset.NIIDataSetLoader(
-                prj_conf.val_set_name,
-                val_lst,
-                prj_conf.input_dirs, \
-                prj_conf.input_exts, \
-                prj_conf.input_dims, \
-                prj_conf.input_reso, \
-                prj_conf.input_norm, \
-                prj_conf.output_dirs, \
-                prj_conf.output_exts, \
-                prj_conf.output_dims, \
-                prj_conf.output_reso, \
-                prj_conf.output_norm, \
-                './', \
-                params = params,
-                truncate_seq= prj_conf.truncate_seq, 
-                min_seq_len = prj_conf.minimum_len,
-                save_mean_std = False,
-                wav_samp_rate = prj_conf.wav_samp_rate)
-        else:
-            val_set = None
+        trn_set, val_set = f_train_datasets(args, prj_conf)
 
         # initialize the model and loss function
         model = prj_model.Model(trn_set.get_in_dim(), \
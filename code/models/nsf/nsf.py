@@ -324,6 +324,32 @@ class SineGen(torch_nn.Module):
         return  sines
     
     
+    def harmonic_sines(self, f0, phase, offset):
+        """ sines, phase = harmonic_sines(f0, phase, offset)
+        input f0: tensor(batchsize, length, 1), in Hz
+        input phase: tensor(batchsize, 1), float64 phase of the fundamental
+                     before the first step (in cycles)
+        input offset: tensor(batchsize, dim), initial phase of each 
+                      harmonic (in cycles)
+        output sines: tensor(batchsize, length, dim)
+        output phase: tensor(batchsize, 1), phase after the last step
+        
+        The phase of the k-th harmonic is k * phi + offset_k, with phi 
+        the phase of the fundamental, which is accumulated only once 
+        (in float64, wrapped to [0, 1)). The harmonics are then given by
+        one broadcast multiply-add and one sin.
+        Passing the returned phase to the next call continues the sines
+        without discontinuity.
+        """
+        rad_values = f0[:, :, 0].double() / self.sampling_rate
+        phi = (torch.cumsum(rad_values, dim=1) + phase) % 1
+        harmonics = torch.arange(1, self.dim + 1, dtype=f0.dtype, 
+                                 device=f0.device)
+        # (batchsize, length, dim) phases, in cycles
+        i_phase = torch.addcmul(offset.to(f0.dtype).unsqueeze(1), 
+                                phi.to(f0.dtype).unsqueeze(-1), harmonics)
+        return torch.sin(i_phase.mul_(2 * np.pi)), phi[:, -1:]
+    
     def forward(self, f0):
         """ sine_tensor, uv = forward(f0)
         input F0: tensor(batchsize=1, length, dim=1)
@@ -332,16 +358,26 @@ class SineGen(torch_nn.Module):
         output uv: tensor(batchsize=1, length, 1)
         """
         with torch.no_grad():
-            phase_buf = torch.zeros(f0.shape[0], f0.shape[1], self.dim, \
-                                    device=f0.device)
-            # fundamental component
-            phase_buf[:, :, 0] = f0[:, :, 0]
-            for idx in np.arange(self.harmonic_num):
-                # idx + 2: the (idx+1)-th overtone, (idx+2)-th harmonic
-                phase_buf[:, :, idx+1] = phase_buf[:, :, 0] * (idx+2)
-                
-            # generate sine waveforms
-            sine_waves = self._f02sine(phase_buf) * self.sine_amp
+            if self.flag_for_pulse:
+                phase_buf = torch.zeros(f0.shape[0], f0.shape[1], self.dim, \
+                                        device=f0.device)
+                # fundamental component
+                phase_buf[:, :, 0] = f0[:, :, 0]
+                for idx in np.arange(self.harmonic_num):
+                    # idx + 2: the (idx+1)-th overtone, (idx+2)-th harmonic
+                    phase_buf[:, :, idx+1] = phase_buf[:, :, 0] * (idx+2)
+                    
+                # generate sine waveforms
+                sine_waves = self._f02sine(phase_buf) * self.sine_amp
+            else:
+                # initial phase noise (no noise for fundamental component)
+                rand_ini = torch.rand(f0.shape[0], self.dim, \
+                                      device = f0.device)
+                rand_ini[:, 0] = 0
+                phase = torch.zeros(f0.shape[0], 1, dtype=torch.float64, \
+                                    device = f0.device)
+                sine_waves = self.harmonic_sines(f0, phase, rand_ini)[0] \
+                             * self.sine_amp
             
             # generate uv signal
             #uv = torch.ones(f0.shape)
@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+"""
+optimise.py for hn-sinc-NSF
+
+Offline optimisation of a trained sinc_nsf.Model for inference:
+ - the input normalisation is folded into the first condition conv
+   (weights divided by std, bias shifted, padding with the mean, which
+   is zero once normalised); only the F0 column used by l_upsamp_f0_hi
+   is still normalised, at frame-level
+ - the scale of each NeuralFilterBlock is folded into l_ff_2
+ - the up-sampling of F0 (Upsample + Identity placeholders) is replaced
+   by a single repeat
+ - training-only parameters (input / output mean and std) are dropped
+   and no parameter requires grad
+
+The optimised module produces the same output as the trained one (up to
+float rounding) and is saved as a whole module, as the checkpoints are.
+It keeps the sub-modules used by the rest of the code (m_cond, m_source,
+m_filter) but cannot be used by the StreamingModel.
+
+Usage:
+ python -m models.nsf.optimise model.th model_inference.th
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import copy
+import torch
+import torch.nn as torch_nn
+
+from models.nsf import sinc_nsf
+
+__author__ = "Ninon Devis, Philippe Esling, Martin Vert"
+__email__ = "{devis, esling}@ircam.fr"
+
+
+class FoldedConv1d(sinc_nsf.Conv1dKeepLength):
+    """ Conv1dKeepLength applied to un-normalised data
+    FoldedConv1d(layer, mean, std)
+    layer: Conv1dKeepLength applied to (data - mean) / std
+
+    weight' = weight / std
+    bias' = bias - sum(weight' * mean)
+    and the data is padded with the mean instead of zeros
+    """
+    def __init__(self, layer, mean, std):
+        super(FoldedConv1d, self).__init__(
+            layer.in_channels, layer.out_channels, layer.dilation[0],
+            layer.kernel_size[0], layer.causal, layer.stride[0],
+            layer.groups, True, isinstance(layer.l_ac, torch_nn.Tanh),
+            layer.pad_mode)
+        with torch.no_grad():
+            weight = layer.weight / std.view(1, -1, 1)
+            bias = torch.zeros_like(self.bias) if layer.bias is None \
+                   else layer.bias
+            self.weight.copy_(weight)
+            self.bias.copy_(bias - (weight * mean.view(1, -1, 1)).sum((1, 2)))
+        self.register_buffer('pad_value', mean.detach().clone())
+
+    def forward(self, data):
+        x = data.transpose(1, 2)
+        pad_value = self.pad_value.view(1, -1, 1).expand(x.shape[0], -1, -1)
+        x = torch.cat((pad_value.expand(-1, -1, self.pad_le), x,
+                       pad_value.expand(-1, -1, self.pad_ri)), dim=2)
+        output = self.l_ac(torch_nn.Conv1d.forward(self, x))
+        return output.transpose(1, 2)
+
+
+class InferenceFilterBlock(sinc_nsf.NeuralFilterBlock):
+    """ NeuralFilterBlock with its scale folded into l_ff_2
+    """
+    def __init__(self, block):
+        super(InferenceFilterBlock, self).__init__(
+            block.signal_size, block.hidden_size, block.kernel_size,
+            block.conv_num)
+        # the layers of a pruned block have other sizes / dilations
+        for name in ['l_ff_1', 'l_convs', 'l_ff_2', 'l_ff_3']:
+            setattr(self, name, copy.deepcopy(getattr(block, name)))
+        self.dilation_s = block.dilation_s
+        self.load_state_dict(block.state_dict())
+        with torch.no_grad():
+            self.l_ff_2.weight.mul_(block.scale)
+        del self.scale
+
+    def forward(self, signal, context):
+        return self.forward_cf(signal.transpose(1, 2),
+                               context.transpose(1, 2)).transpose(1, 2)
+
+    def forward_cf(self, signal, context):
+        """ channels-first forward (see NeuralFilterBlock.forward_cf)
+        """
+        tmp_hidden = self.l_ff_1_tanh(self.pointwise(self.l_ff_1, signal))
+        for l_conv in self.l_convs:
+            tmp_hidden = tmp_hidden + l_conv.forward_cf(tmp_hidden) + context
+        tmp_hidden = self.l_ff_2_tanh(self.pointwise(self.l_ff_2, tmp_hidden))
+        tmp_hidden = self.l_ff_3_tanh(self.pointwise(self.l_ff_3, tmp_hidden))
+        return tmp_hidden + signal
+
+
+class InferenceCondModule(sinc_nsf.CondModuleHnSincNSF):
+    """ CondModuleHnSincNSF taking un-normalised features
+    InferenceCondModule(m_cond, mean, std)
+    m_cond: trained condition module
+    mean, std: normalisation of the input features
+    """
+    def __init__(self, m_cond, mean, std):
+        super(InferenceCondModule, self).__init__(
+            m_cond.input_dim, m_cond.output_dim, m_cond.up_sample,
+            cnn_kernel_s=m_cond.cnn_kernel_s,
+            voiced_threshold=m_cond.voiced_threshold)
+        # (the hidden sizes of a pruned module differ from output_dim)
+        self.l_conv1ds = copy.deepcopy(m_cond.l_conv1ds)
+        self.load_state_dict(m_cond.state_dict())
+        self.l_conv1ds[0] = FoldedConv1d(self.l_conv1ds[0], mean, std)
+        # F0 is directly repeated
+        del self.l_upsamp_F0
+        self.register_buffer('f0_mean', mean[-1:].detach().clone())
+        self.register_buffer('f0_std', std[-1:].detach().clone())
+
+    def forward(self, feature, f0):
+        """ spec, f0 = forward(self, feature, f0)
+        feature: (batchsize, length, dim), not normalised
+        f0: (batchsize, length, dim=1), which should be F0 at frame-level
+        """
+        tmp = feature
+        for l_conv in self.l_conv1ds:
+            tmp = l_conv(tmp)
+        tmp = self.l_upsamp(tmp)
+
+        # concatenat normed F0 with hidden spectral features
+        f0_norm = (feature[:, :, -1:] - self.f0_mean) / self.f0_std
+        context = torch.cat((tmp[:, :, 0:self.output_dim-1], \
+                             self.l_upsamp_f0_hi(f0_norm)), dim=2)
+        hidden_cut_f = tmp[:, :, self.output_dim-1:]
+
+        # directly up-sample F0 without smoothing
+        f0_upsamp = torch.repeat_interleave(f0, self.up_sample, dim=1)
+
+        # get and smooth the cut-off-frequency
+        cut_f = self.get_cut_f(hidden_cut_f, f0_upsamp)
+        cut_f_smoothed = self.l_cut_f_smooth(cut_f)
+        return context, f0_upsamp, cut_f_smoothed, hidden_cut_f
+
+
+class InferenceModel(sinc_nsf.Model):
+    """ Inference-only sinc_nsf.Model
+    InferenceModel(model)
+    model: trained sinc_nsf.Model (left unchanged)
+    """
+    # configurations copied from the trained model
+    config = ['input_dim', 'output_dim', 'sine_amp', 'noise_std',
+              'hidden_dim', 'upsamp_rate', 'sampling_rate', 'cnn_kernel_s',
+              'filter_block_num', 'cnn_num_in_block', 'harmonic_num',
+              'sinc_order']
+
+    def __init__(self, model):
+        # Model.__init__ would create the modules from the arguments
+        torch_nn.Module.__init__(self)
+        for name in self.config:
+            setattr(self, name, getattr(model, name))
+        self.m_cond = InferenceCondModule(model.m_cond, model.input_mean,
+                                          model.input_std)
+        self.m_source = copy.deepcopy(model.m_source)
+        self.m_filter = copy.deepcopy(model.m_filter)
+        self.m_filter.l_har_blocks = torch_nn.ModuleList(
+            [InferenceFilterBlock(b) for b in model.m_filter.l_har_blocks])
+        self.m_filter.l_noi_blocks = torch_nn.ModuleList(
+            [InferenceFilterBlock(b) for b in model.m_filter.l_noi_blocks])
+        for p in self.parameters():
+            p.requires_grad = False
+        self.eval()
+
+    def forward(self, x):
+        """ output = forward(x)
+        x (batchsize=1, length, dim), not normalised, F0 as last dim
+        output (batchsize=1, length)
+        """
+        f0 = x[:, :, -1:]
+        cond_feat, f0_upsamped, cut_f, hid_cut_f = self.cached_stage(
+            'cond', x, lambda: self.m_cond(x, f0))
+        har_source, noi_source, uv = self.cached_stage(
+            'source', f0, lambda: self.m_source(f0_upsamped))
+        output = self.m_filter(har_source, noi_source, cond_feat, cut_f)
+        return output.squeeze(-1)
+
+
+def optimise(model):
+    """ inference_model = optimise(model)
+    inference-only copy of a trained sinc_nsf.Model
+    """
+    with torch.no_grad():
+        return InferenceModel(model)
+
+
+def compare(model, inference_model, features, repeat=3):
+    """ error, time, inference_time = compare(model, inference_model, ...)
+    maximum absolute difference of the outputs for the same random seed,
+    and average time of the forward of both models
+    """
+    import time
+    times = []
+    outputs = []
+    with torch.no_grad():
+        for m in [model, inference_model]:
+            torch.manual_seed(0)
+            outputs.append(m(features))
+            start = time.perf_counter()
+            for r in range(repeat):
+                m(features)
+            times.append((time.perf_counter() - start) / repeat)
+    error = (outputs[0] - outputs[1]).abs().max().item()
+    return error, times[0], times[1]
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Optimise a NSF checkpoint for inference')
+    parser.add_argument('model_path', type=str, help='trained model (whole module)')
+    parser.add_argument('output_path', type=str, help='inference-only model')
+    parser.add_argument('--frames', type=int, default=47, help='frames of the test features')
+    args = parser.parse_args()
+    # classes of the saved module must be importable (not __main__)
+    from models.nsf.optimise import optimise, compare
+    model = torch.load(args.model_path, map_location='cpu')
+    model.eval()
+    inference_model = optimise(model)
+    # test features around the normalisation statistics
+    torch.manual_seed(0)
+    features = model.input_mean + model.input_std * 0.5 * torch.randn(1, args.frames, model.input_dim)
+    features[:, :, -1] = features[:, :, -1].abs()
+    error, t_model, t_inference = compare(model, inference_model, features)
+    print('Max error : {:.2e}, forward : {:.3f}s -> {:.3f}s'.format(error, t_model, t_inference))
+    torch.save(inference_model, args.output_path)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+"""
+prune.py for hn-sinc-NSF
+
+Structured pruning of a trained sinc_nsf.Model, following "Diet deep
+generative audio models with structured lottery" (Esling et al., 2020):
+units are ranked by the magnitude of their weights (normalised per
+layer) and the lowest ones are physically removed, so that the pruned
+model is a smaller dense model (not sparse weights).
+
+ - hidden channels of the neural filter: the hidden_dim channels are
+   shared by all the filter blocks and by the context computed by the
+   condition module, they are removed everywhere at once; the F0
+   channel of the context (last one) is always kept
+ - dilated convs of each filter block: the convs with the smallest
+   weights are removed (with their addition of the context)
+ - hidden channels between the convs of the condition module; the
+   channel giving the cut-off frequency (last output) is always kept
+
+The pruned model can be fine-tuned with the training process of main.py
+(f_train_wrapper), and is saved as a whole module, as the checkpoints.
+
+Usage:
+ python -m models.nsf.prune model.th model_pruned.th --hidden 48 --drop-convs 2
+ (fine-tuning) add --finetune and the options of main.py
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import sys
+import copy
+import time
+import argparse
+import importlib
+import torch
+import torch.nn as torch_nn
+
+from models.nsf import sinc_nsf
+
+__author__ = "Ninon Devis, Philippe Esling, Martin Vert"
+__email__ = "{devis, esling}@ircam.fr"
+
+
+def unit_norms(weight, dim):
+    """ L2 norm of the weights of each unit along dim, divided by their
+    mean so that all the layers have the same importance
+    """
+    dims = [x for x in range(weight.ndim) if x != dim]
+    norms = weight.detach().pow(2).sum(dims).sqrt()
+    return norms / norms.mean()
+
+
+def slice_conv(layer, out_idx=None, in_idx=None):
+    """ Conv1dKeepLength with the output / input channels out_idx / in_idx
+    """
+    weight = layer.weight
+    if out_idx is not None:
+        weight = weight[out_idx]
+    if in_idx is not None:
+        weight = weight[:, in_idx]
+    new_layer = sinc_nsf.Conv1dKeepLength(
+        weight.shape[1], weight.shape[0], layer.dilation[0],
+        layer.kernel_size[0], layer.causal, layer.stride[0], layer.groups,
+        layer.bias is not None, isinstance(layer.l_ac, torch_nn.Tanh),
+        layer.pad_mode)
+    new_layer.weight.data.copy_(weight)
+    if layer.bias is not None:
+        bias = layer.bias if out_idx is None else layer.bias[out_idx]
+        new_layer.bias.data.copy_(bias)
+    return new_layer
+
+
+def slice_linear(layer, out_idx=None, in_idx=None):
+    """ Linear layer with the output / input units out_idx / in_idx
+    """
+    weight = layer.weight
+    if out_idx is not None:
+        weight = weight[out_idx]
+    if in_idx is not None:
+        weight = weight[:, in_idx]
+    new_layer = torch_nn.Linear(weight.shape[1], weight.shape[0],
+                                bias=layer.bias is not None)
+    new_layer.weight.data.copy_(weight)
+    if layer.bias is not None:
+        bias = layer.bias if out_idx is None else layer.bias[out_idx]
+        new_layer.bias.data.copy_(bias)
+    return new_layer
+
+
+def top_units(scores, num, kept=()):
+    """ sorted indices of the num units with the highest scores,
+    including the units in kept
+    """
+    scores = scores.clone()
+    scores[list(kept)] = float('inf')
+    return torch.sort(torch.topk(scores, num).indices).values
+
+
+def filter_channel_scores(model):
+    """ importance of the hidden channels shared by the filter blocks
+    and the context of the condition module
+    """
+    scores = 0
+    for block in list(model.m_filter.l_har_blocks) + \
+                 list(model.m_filter.l_noi_blocks):
+        scores = scores + unit_norms(block.l_ff_1.weight, 0) \
+                 + unit_norms(block.l_ff_2.weight, 1)
+        for l_conv in block.l_convs:
+            scores = scores + unit_norms(l_conv.weight, 0) \
+                     + unit_norms(l_conv.weight, 1)
+    # the last channel of the context is F0 (not a conv output)
+    l_last = model.m_cond.l_conv1ds[-1]
+    scores[:-1] = scores[:-1] + unit_norms(l_last.weight, 0)[:-1]
+    return scores
+
+
+def prune_block(block, keep, drop_convs):
+    """ prune the hidden channels (keep) and the drop_convs convs with the
+    smallest weights of a NeuralFilterBlock (in place)
+    """
+    block.l_ff_1 = slice_linear(block.l_ff_1, out_idx=keep)
+    block.l_ff_2 = slice_linear(block.l_ff_2, in_idx=keep)
+    norms = torch.stack([l_conv.weight.detach().norm()
+                         for l_conv in block.l_convs])
+    convs = top_units(norms, max(len(block.l_convs) - drop_convs, 1))
+    block.l_convs = torch_nn.ModuleList(
+        [slice_conv(block.l_convs[x], keep, keep) for x in convs])
+    block.dilation_s = [block.dilation_s[x] for x in convs]
+    block.conv_num = len(block.l_convs)
+    block.hidden_size = len(keep)
+
+
+def prune_cond(m_cond, keep, cond_hidden):
+    """ prune the outputs of the condition module (context channels keep,
+    the cut-off frequency channel is the last one) and its hidden
+    channels to cond_hidden (in place)
+    """
+    l_convs = list(m_cond.l_conv1ds)
+    l_convs[-1] = slice_conv(l_convs[-1], out_idx=keep)
+    if cond_hidden is not None:
+        for x in range(len(l_convs) - 1):
+            scores = unit_norms(l_convs[x].weight, 0) \
+                     + unit_norms(l_convs[x+1].weight, 1)
+            hidden = top_units(scores, cond_hidden)
+            l_convs[x] = slice_conv(l_convs[x], out_idx=hidden)
+            l_convs[x+1] = slice_conv(l_convs[x+1], in_idx=hidden)
+    m_cond.l_conv1ds = torch_nn.ModuleList(l_convs)
+    m_cond.output_dim = len(keep)
+    m_cond.l_upsamp = sinc_nsf.UpSampleLayer(m_cond.output_dim,
+                                             m_cond.up_sample, True)
+
+
+def prune(model, hidden=48, cond_hidden=None, drop_convs=0):
+    """ pruned_model = prune(model, hidden=48, cond_hidden=None, drop_convs=0)
+    model: trained sinc_nsf.Model (unchanged)
+    hidden: number of hidden channels kept in the neural filter
+    cond_hidden: number of hidden channels kept between the convs of the
+                 condition module (None: unchanged)
+    drop_convs: number of dilated convs removed from each filter block
+    """
+    pruned = copy.deepcopy(model)
+    with torch.no_grad():
+        scores = filter_channel_scores(pruned)
+        # the last channel is F0 in the context, cut_f in m_cond
+        keep = top_units(scores, hidden, kept=[len(scores) - 1])
+        for block in list(pruned.m_filter.l_har_blocks) + \
+                     list(pruned.m_filter.l_noi_blocks):
+            prune_block(block, keep, drop_convs)
+        prune_cond(pruned.m_cond, keep, cond_hidden)
+    pruned.hidden_dim = len(keep)
+    pruned.m_filter.hidden_size = len(keep)
+    pruned.eval()
+    return pruned
+
+
+def weight_number(model):
+    return sum(p.numel() for p in model.parameters())
+
+
+def report(reference, model, features, repeat=1):
+    """ report = report(reference, model, features, repeat=1)
+    features: {name: features (batchsize=1, frames, dim)}
+    distance: multi-resolution STFT distance (sinc_nsf.Loss) to the
+              output of the reference model, same random seed
+    rtf: real-time factor on the current device (time / duration)
+    """
+    loss = sinc_nsf.Loss(None)
+    result = {'distance': {}, 'rtf': {}, 'rtf_reference': {}}
+    with torch.no_grad():
+        for name, ft in features.items():
+            outputs = []
+            for key, m in [('rtf_reference', reference), ('rtf', model)]:
+                torch.manual_seed(0)
+                outputs.append(m(ft))
+                start = time.perf_counter()
+                for r in range(repeat):
+                    m(ft)
+                duration = outputs[-1].shape[-1] / m.sampling_rate
+                result[key][name] = \
+                    (time.perf_counter() - start) / repeat / duration
+            result['distance'][name] = \
+                loss.compute(outputs[1], outputs[0]).item()
+    return result
+
+
+def print_report(result):
+    print('{:48s} {:>9s} {:>9s} {:>9s}'.format(
+        'anchor', 'distance', 'rtf ref', 'rtf'))
+    for name in result['distance']:
+        print('{:48s} {:9.4f} {:9.4f} {:9.4f}'.format(
+            name, result['distance'][name], result['rtf_reference'][name],
+            result['rtf'][name]))
+
+
+def finetune(model, args):
+    """ fine-tune a pruned model with f_train_wrapper, using the data
+    and options of main.py (args from nii_arg_parse)
+    """
+    import core_scripts.op_manager.op_manager as nii_op_wrapper
+    import core_scripts.nn_manager.nn_manager as nii_nn_wrapper
+    import core_scripts.startup_config as nii_startup
+    from models.nsf.main import f_train_datasets
+
+    prj_conf = importlib.import_module(args.module_config)
+    nii_startup.set_random_seed(args.seed)
+    use_cuda = not args.no_cuda and torch.cuda.is_available()
+    device = torch.device("cuda" if use_cuda else "cpu")
+    trn_set, val_set = f_train_datasets(args, prj_conf)
+    # the normalisation of the trained model is kept
+    model.train()
+    nii_nn_wrapper.f_train_wrapper(args, model, sinc_nsf.Loss(args), device,
+                                   nii_op_wrapper.OptimizerWrapper(model, args),
+                                   trn_set, val_set, None)
+    model.eval()
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Structured pruning of a NSF checkpoint')
+    parser.add_argument('model_path', type=str, help='trained model (whole module)')
+    parser.add_argument('output_path', type=str, help='pruned model')
+    parser.add_argument('--hidden', type=int, default=48, help='hidden channels kept in the filter')
+    parser.add_argument('--cond-hidden', type=int, default=None, help='hidden channels kept in the condition module')
+    parser.add_argument('--drop-convs', type=int, default=0, help='dilated convs removed from each filter block')
+    parser.add_argument('--finetune', action='store_true', help='fine-tune with the options of main.py')
+    parser.add_argument('--data', type=str, default='data', help='folder of the anchor sounds')
+    args, train_argv = parser.parse_known_args()
+    from models.nsf.quantise import anchor_features
+    model = torch.load(args.model_path, map_location='cpu')
+    model.eval()
+    pruned = prune(model, args.hidden, args.cond_hidden, args.drop_convs)
+    print('Weights : {:d} -> {:d}'.format(weight_number(model), weight_number(pruned)))
+    if args.finetune:
+        import core_scripts.config_parse.arg_parse as nii_arg_parse
+        sys.argv = sys.argv[:1] + train_argv
+        pruned = finetune(pruned, nii_arg_parse.f_args_parsed())
+        pruned = pruned.cpu()
+    print_report(report(model, pruned, anchor_features(args.data)))
+    torch.save(pruned, args.output_path)
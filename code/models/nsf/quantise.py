@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+"""
+quantise.py for hn-sinc-NSF
+
+Dynamic int8 quantisation of the neural filter blocks of a trained
+sinc_nsf.Model, for CPU inference:
+ - the model is first optimised for inference (see optimise.py)
+ - each dilated conv of the filter blocks is computed as a single Linear
+   layer over its stacked taps, whose outputs are shifted and summed
+   (PyTorch only quantises Linear layers dynamically)
+ - these Linear layers get int8 weights (one scale per output channel)
+   and their inputs are quantised on the fly; l_ff_1, l_ff_2 and l_ff_3
+   (about 1% of the weights of a block) and the condition / source
+   modules stay in float: the input of l_ff_2 is the sum of all the
+   residual branches, whose range is too wide for 8 bits
+
+The quantised model is checked against the float model on the anchor
+sounds (data/*.wav): both render each sound with the same random seed,
+and the multi-resolution STFT distance of sinc_nsf.Loss between the two
+outputs must stay below a threshold, otherwise no model is written.
+The default threshold is calibrated on same-seed renders of the impact
+model on the anchors: the float model with TapConv1d layers (dtype=None)
+is about 1e-8 away (float rounding), and with its filter weights rounded
+to bfloat16 (8-bit mantissa) it is 0.012 to 0.014 away. The threshold
+0.05 allows about 4 times this rounding. (Renders with different random
+seeds are 1.0 to 4.9 apart, hence are not a valid bound.)
+
+Usage:
+ python -m models.nsf.quantise model.th model_int8.th --threshold 0.05
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import sys
+import glob
+import copy
+import torch
+import torch.nn as torch_nn
+
+from models.nsf import sinc_nsf
+from models.nsf import optimise
+
+__author__ = "Ninon Devis, Philippe Esling, Martin Vert"
+__email__ = "{devis, esling}@ircam.fr"
+
+
+class TapConv1d(torch_nn.Module):
+    """ Conv1dKeepLength computed by a Linear layer over its taps
+    TapConv1d(layer)
+    layer: Conv1dKeepLength (stride 1, one group, zero padding)
+
+    output[t] = sum_k W_k data[t - shift_k], shift_k = pad_le - k * dilation
+    the products W_k data of all the taps are given by one Linear layer,
+    then shifted and summed
+    Input tensor:  (batchsize, length, dim_in)
+    Output tensor: (batchsize, length, dim_out)
+    """
+    def __init__(self, layer):
+        super(TapConv1d, self).__init__()
+        if layer.stride[0] != 1 or layer.groups != 1 or \
+           layer.pad_mode != 'constant':
+            raise ValueError("TapConv1d: only stride 1, one group and "
+                             "zero padding are supported")
+        self.out_channels = layer.out_channels
+        kernel_s, dilation_s = layer.kernel_size[0], layer.dilation[0]
+        self.shifts = [layer.pad_le - k * dilation_s for k in range(kernel_s)]
+        self.l_taps = torch_nn.Linear(layer.in_channels,
+                                      layer.out_channels * kernel_s,
+                                      bias=False)
+        with torch.no_grad():
+            # (dim_out, dim_in, kernel_s) -> (kernel_s * dim_out, dim_in)
+            self.l_taps.weight.copy_(
+                layer.weight.permute(2, 0, 1).reshape(-1, layer.in_channels))
+        if layer.bias is None:
+            self.bias = None
+        else:
+            self.bias = torch_nn.Parameter(layer.bias.detach().clone(),
+                                           requires_grad=False)
+        self.l_ac = copy.deepcopy(layer.l_ac)
+
+    def forward(self, data):
+        taps = self.l_taps(data)
+        length = data.shape[1]
+        # start from the tap without shift (if any)
+        order = sorted(range(len(self.shifts)), 
+                       key=lambda k: abs(self.shifts[k]))
+        output = None
+        for k in order:
+            shift = self.shifts[k]
+            tap = taps[:, :, k * self.out_channels:(k+1) * self.out_channels]
+            if output is None:
+                if shift == 0:
+                    output = tap.contiguous()
+                    continue
+                output = taps.new_zeros(tap.shape)
+            if abs(shift) < length:
+                output[:, max(shift, 0):length + min(shift, 0)] += \
+                    tap[:, max(-shift, 0):length - max(shift, 0)]
+        if self.bias is not None:
+            output = output + self.bias
+        return self.l_ac(output)
+
+
+class QuantisedFilterBlock(torch_nn.Module):
+    """ NeuralFilterBlock working on (batchsize, length, dim) data, with
+    the dilated convs as TapConv1d and the scale folded into l_ff_2
+    QuantisedFilterBlock(block)
+    block: NeuralFilterBlock or optimise.InferenceFilterBlock
+
+    The Linear layers to quantise are listed by quantised_layers()
+    """
+    def __init__(self, block):
+        super(QuantisedFilterBlock, self).__init__()
+        self.l_ff_1 = copy.deepcopy(block.l_ff_1)
+        self.l_ff_1_tanh = torch_nn.Tanh()
+        self.l_convs = torch_nn.ModuleList(
+            [TapConv1d(l_conv) for l_conv in block.l_convs])
+        self.l_ff_2 = copy.deepcopy(block.l_ff_2)
+        self.l_ff_2_tanh = torch_nn.Tanh()
+        self.l_ff_3 = copy.deepcopy(block.l_ff_3)
+        self.l_ff_3_tanh = torch_nn.Tanh()
+        # InferenceFilterBlock has no scale (already in l_ff_2)
+        if hasattr(block, 'scale'):
+            with torch.no_grad():
+                self.l_ff_2.weight.mul_(block.scale)
+
+    def quantised_layers(self):
+        """ names of the Linear layers with int8 weights
+        """
+        return ['l_convs.{:d}.l_taps'.format(x)
+                for x in range(len(self.l_convs))]
+
+    def forward(self, signal, context):
+        """
+        Assume: signal (batchsize=1, length, signal_size)
+                context (batchsize=1, length, hidden_size)
+        Output: (batchsize=1, length, signal_size)
+        """
+        tmp_hidden = self.l_ff_1_tanh(self.l_ff_1(signal))
+        for l_conv in self.l_convs:
+            tmp_hidden = tmp_hidden + l_conv(tmp_hidden) + context
+        tmp_hidden = self.l_ff_2_tanh(self.l_ff_2(tmp_hidden))
+        tmp_hidden = self.l_ff_3_tanh(self.l_ff_3(tmp_hidden))
+        return tmp_hidden + signal
+
+    def forward_cf(self, signal, context):
+        """ channels-first interface used by FilterModuleHnSincNSF.branch
+        (the transpositions are views, the block runs channels-last)
+        """
+        return self.forward(signal.transpose(1, 2),
+                            context.transpose(1, 2)).transpose(1, 2)
+
+
+def quantise(model, dtype=torch.qint8):
+    """ quantised_model = quantise(model, dtype=torch.qint8)
+    model: trained sinc_nsf.Model or optimise.InferenceModel (unchanged)
+    dtype: torch.qint8, or None for the float model with TapConv1d
+           layers (same output as the model, up to float rounding)
+    """
+    with torch.no_grad():
+        if isinstance(model, optimise.InferenceModel):
+            q_model = copy.deepcopy(model)
+        else:
+            q_model = optimise.optimise(model)
+        m_filter = q_model.m_filter
+        names = []
+        for branch in ['l_har_blocks', 'l_noi_blocks']:
+            l_blocks = torch_nn.ModuleList(
+                [QuantisedFilterBlock(b) for b in getattr(m_filter, branch)])
+            setattr(m_filter, branch, l_blocks)
+            names += ['m_filter.{:s}.{:d}.{:s}'.format(branch, idx, name)
+                      for idx, block in enumerate(l_blocks)
+                      for name in block.quantised_layers()]
+        if dtype is not None:
+            # one scale per output channel of the weights
+            qconfig = torch.ao.quantization.per_channel_dynamic_qconfig
+            q_model = torch.ao.quantization.quantize_dynamic(
+                q_model, {name: qconfig for name in names}, dtype=dtype)
+    q_model.eval()
+    return q_model
+
+
+def anchor_features(data_path='data', feature_path='models'):
+    """ {wav: features} of the anchor sounds data_path/*.wav
+    features are cached as in NSF.features_loading
+    (feature_path/features_interp<wav>.th), or computed without being
+    cached if feature_path is None (other sounds than the anchors)
+    """
+    features = {}
+    for wav in sorted(glob.glob(os.path.join(data_path, '*.wav'))):
+        wav = os.path.basename(wav)
+        path = None
+        if feature_path is not None:
+            path = os.path.join(feature_path, 'features_interp' + wav + '.th')
+        if path is None or not os.path.exists(path):
+            # librosa is only needed for new anchors
+            import librosa
+            from models.nsf_impacts import spectral_features
+            y, sr = librosa.load(os.path.join(data_path, wav))
+            ft = torch.tensor(spectral_features(y, sr)).unsqueeze(0).float()
+            if path is None:
+                features[wav] = ft
+                continue
+            torch.save(ft, path)
+        features[wav] = torch.load(path, map_location='cpu')
+    return features
+
+
+def quality_gate(model, q_model, features, threshold):
+    """ passed, distances = quality_gate(model, q_model, features, threshold)
+    distances: {wav: multi-resolution STFT distance (sinc_nsf.Loss)
+                between the outputs of both models, same random seed}
+    passed: all the distances are below the threshold
+    """
+    loss = sinc_nsf.Loss(None)
+    distances = {}
+    with torch.no_grad():
+        for wav, ft in features.items():
+            outputs = []
+            for m in [model, q_model]:
+                torch.manual_seed(0)
+                outputs.append(m(ft))
+            distances[wav] = loss.compute(outputs[1], outputs[0]).item()
+    passed = all(d <= threshold for d in distances.values())
+    return passed, distances
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Quantise the filter blocks of a NSF checkpoint to int8')
+    parser.add_argument('model_path', type=str, help='trained model (whole module)')
+    parser.add_argument('output_path', type=str, help='quantised model')
+    parser.add_argument('--threshold', type=float, default=0.05, help='maximum STFT distance to the float model (same seed)')
+    parser.add_argument('--data', type=str, default='data', help='folder of the anchor sounds')
+    args = parser.parse_args()
+    # classes of the saved module must be importable (not __main__)
+    from models.nsf.quantise import quantise, quality_gate, anchor_features
+    model = torch.load(args.model_path, map_location='cpu')
+    model.eval()
+    q_model = quantise(model)
+    passed, distances = quality_gate(model, q_model, anchor_features(args.data), args.threshold)
+    for wav, distance in distances.items():
+        print('{:48s} {:.4f}'.format(wav, distance))
+    if not passed:
+        print('Quantised model above the threshold {:.4f}, not saved'.format(args.threshold))
+        sys.exit(1)
+    torch.save(q_model, args.output_path)
+    print('Saved ' + args.output_path)
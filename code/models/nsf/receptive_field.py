@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+receptive_field.py for hn-sinc-NSF
+
+Computes how much past (left) and future (right) input each module of a
+sinc_nsf.Model needs to produce one output step.
+
+Contexts are expressed both in frames (layers running at frame-level, in
+the condition module) and in samples (layers running at wave-level), as
+the two are only related by the up-sampling rate of the model.
+
+Usage:
+ fields = model_receptive_field(model)
+ fields['total'].to_frames(model.upsamp_rate)  -> (left_frames, right_frames)
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import numpy as np
+
+__author__ = "Ninon Devis, Philippe Esling, Martin Vert"
+__email__ = "{devis, esling}@ircam.fr"
+
+
+class ReceptiveField():
+    """ Left / right context of a module
+    left, right: context at wave-level (samples)
+    left_frames, right_frames: context at frame-level (frames)
+    stateful: output also depends on a state accumulated since the
+              beginning of the signal (e.g. the phase of sine sources),
+              which no finite context can reproduce
+    """
+    def __init__(self, left=0, right=0, left_frames=0, right_frames=0,
+                 stateful=False):
+        self.left = left
+        self.right = right
+        self.left_frames = left_frames
+        self.right_frames = right_frames
+        self.stateful = stateful
+
+    def __add__(self, other):
+        """ serial composition (one module after the other)
+        """
+        return ReceptiveField(self.left + other.left,
+                              self.right + other.right,
+                              self.left_frames + other.left_frames,
+                              self.right_frames + other.right_frames,
+                              self.stateful or other.stateful)
+
+    def __or__(self, other):
+        """ parallel composition (branches merged at the same step)
+        """
+        return ReceptiveField(max(self.left, other.left),
+                              max(self.right, other.right),
+                              max(self.left_frames, other.left_frames),
+                              max(self.right_frames, other.right_frames),
+                              self.stateful or other.stateful)
+
+    def to_frames(self, up_sample):
+        """ (left_frames, right_frames) = to_frames(up_sample)
+        total context in frames of input features, rounding the
+        wave-level context up to complete frames
+        """
+        left = self.left_frames + int(np.ceil(self.left / up_sample))
+        right = self.right_frames + int(np.ceil(self.right / up_sample))
+        return left, right
+
+    def __repr__(self):
+        return "ReceptiveField(samples=({:d}, {:d}), frames=({:d}, {:d}){:s})"\
+            .format(self.left, self.right, self.left_frames,
+                    self.right_frames, ", stateful" if self.stateful else "")
+
+
+def conv_receptive_field(layer, frame_level=False):
+    """ context of a Conv1dKeepLength (or MovingAverage) layer
+    """
+    if frame_level:
+        return ReceptiveField(left_frames=layer.pad_le,
+                              right_frames=layer.pad_ri)
+    return ReceptiveField(layer.pad_le, layer.pad_ri)
+
+
+def upsample_receptive_field(layer):
+    """ context of an UpSampleLayer (nearest up-sampling + smoothing)
+    """
+    field = ReceptiveField()
+    for l_ave in [layer.l_ave2, layer.l_ave1]:
+        if hasattr(l_ave, 'pad_le'):
+            field = field + conv_receptive_field(l_ave)
+    return field
+
+
+def filter_block_receptive_field(block):
+    """ context of a NeuralFilterBlock (causal dilated convolutions)
+    """
+    field = ReceptiveField()
+    for l_conv in block.l_convs:
+        field = field + conv_receptive_field(l_conv)
+    return field
+
+
+def model_receptive_field(model):
+    """ fields = model_receptive_field(model)
+    Returns a dictionary of ReceptiveField for the modules of a
+    sinc_nsf.Model, and their composition as 'total'
+    """
+    m_cond = model.m_cond
+    m_filter = model.m_filter
+    fields = {}
+    # condition module
+    fields['m_cond.l_conv1ds'] = ReceptiveField()
+    for l_conv in m_cond.l_conv1ds:
+        fields['m_cond.l_conv1ds'] = fields['m_cond.l_conv1ds'] + \
+            conv_receptive_field(l_conv, frame_level=True)
+    fields['m_cond.l_upsamp'] = upsample_receptive_field(m_cond.l_upsamp)
+    fields['m_cond.l_upsamp_f0_hi'] = \
+        upsample_receptive_field(m_cond.l_upsamp_f0_hi)
+    fields['m_cond.l_cut_f_smooth'] = \
+        conv_receptive_field(m_cond.l_cut_f_smooth)
+    hidden = fields['m_cond.l_conv1ds'] + fields['m_cond.l_upsamp']
+    context = hidden | fields['m_cond.l_upsamp_f0_hi']
+    cut_f = hidden + fields['m_cond.l_cut_f_smooth']
+    # source module (sine phases are accumulated over the whole signal)
+    fields['m_source'] = ReceptiveField(stateful=True)
+    # filter module
+    har_blocks = ReceptiveField()
+    for idx, block in enumerate(m_filter.l_har_blocks):
+        fields['m_filter.l_har_blocks.%d' % idx] = \
+            filter_block_receptive_field(block)
+        har_blocks = har_blocks + fields['m_filter.l_har_blocks.%d' % idx]
+    noi_blocks = ReceptiveField()
+    for idx, block in enumerate(m_filter.l_noi_blocks):
+        fields['m_filter.l_noi_blocks.%d' % idx] = \
+            filter_block_receptive_field(block)
+        noi_blocks = noi_blocks + fields['m_filter.l_noi_blocks.%d' % idx]
+    fields['m_filter.l_tv_filtering'] = \
+        ReceptiveField(m_filter.l_sinc_coef.order - 1, 0)
+    # every step of the filter blocks adds the context
+    # the cut-off frequency is only used at the output step
+    blocks = (har_blocks | noi_blocks) + fields['m_filter.l_tv_filtering']
+    fields['total'] = (blocks + (context | fields['m_source'])) | cut_f
+    return fields
+
+
+def print_receptive_field(model):
+    """ print the receptive field of each module of a sinc_nsf.Model
+    """
+    fields = model_receptive_field(model)
+    for name, field in fields.items():
+        print("{:s}: {:s}".format(name, str(field)))
+    left, right = fields['total'].to_frames(model.upsamp_rate)
+    print("Total context: {:d} frames left, {:d} frames right".format(
+        left, right))
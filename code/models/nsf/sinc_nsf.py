@@ -11,6 +11,8 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import sys
+import threading
+import concurrent.futures
 import numpy as np
 import torch
 import torch.nn as torch_nn
@@ -100,6 +102,15 @@ class Conv1dKeepLength(torch_nn.Conv1d):
         output = self.l_ac(super(Conv1dKeepLength, self).forward(x))
         return output.permute(0, 2, 1)
 
+    def forward_cf(self, x):
+        """ channels-first forward
+        Input tensor:  (batchsize=1, dim_in, length)
+        Output tensor: (batchsize=1, dim_out, length)
+        """
+        x = torch_nn_func.pad(x, (self.pad_le, self.pad_ri), 
+                              mode = self.pad_mode)
+        return self.l_ac(super(Conv1dKeepLength, self).forward(x))
+
 # 
 # Moving average
 class MovingAverage(Conv1dKeepLength):
@@ -120,8 +131,103 @@ class MovingAverage(Conv1dKeepLength):
             p.requires_grad = False
             
     def forward(self, data):
+        """ prefix-sum moving average (cost independent of window_len)
+        data: (batchsize=1, length, dim)
+        output: (batchsize=1, length, dim)
+        """
+        x = torch_nn_func.pad(data.permute(0, 2, 1).unsqueeze(2), \
+                              (self.pad_le, self.pad_ri, 0, 0),
+                              mode = self.pad_mode).squeeze(2)
+        return self.forward_valid(x).permute(0, 2, 1)
+
+    def forward_conv(self, data):
+        """ Reference implementation of forward (window_len-tap conv)
+        """
         return super(MovingAverage, self).forward(data)
 
+    def forward_valid(self, x):
+        """ output = forward_valid(self, x)
+        moving average over the valid steps (no padding)
+        x: (batchsize=1, dim, length)
+        output: (batchsize=1, dim, length - window_len + 1)
+
+        x is cut in blocks of window_len steps, hence a window starting
+        at step r of block q is the end of block q and the start of block
+        q + 1: output = total[q] - prefix[q, r] + prefix[q + 1, r]
+        (prefix sums stay within a block, so that float32 is as accurate
+        as the convolution)
+        """
+        window_len = self.kernel_size[0]
+        output_len = x.shape[2] - window_len + 1
+        n_blocks = x.shape[2] // window_len + 1
+        x = torch_nn_func.pad(x, (0, n_blocks * window_len - x.shape[2]))
+        blocks = x.view(x.shape[0], x.shape[1], n_blocks, window_len)
+        # exclusive prefix sums within each block
+        prefix = torch.cumsum(blocks, dim=3) - blocks
+        total = prefix[:, :, :, -1:] + blocks[:, :, :, -1:]
+        output = prefix[:, :, 1:] - prefix[:, :, :-1] + total[:, :, :-1]
+        output = output.reshape(x.shape[0], x.shape[1], -1)[:, :, :output_len]
+        # all the weights are equal to 1/window_len
+        return output * self.weight[:, :, 0]
+
+    def forward_upsampled(self, data, up_sampling_factor):
+        """ output = forward_upsampled(self, data, up_sampling_factor)
+        moving average of the nearest up-sampled data, computed directly
+        from the frames (the up-sampled data is not created)
+        data: (batchsize=1, length, dim)
+        output: (batchsize=1, length * up_sampling_factor, dim)
+
+        Padding the up-sampled signal is the same as up-sampling the
+        frames padded with ceil(pad / factor) frames. With S the factor,
+        X the prefix sums of the frames and x the frames, the window
+        starting at step q * S + r ends at step (q + k) * S + r2, where
+        k = (r + window_len) // S and r2 = (r + window_len) % S, hence
+           sum = S * (X[q + k] - X[q]) + r2 * x[q + k] - r * x[q]
+        k takes at most two values over the phases r.
+        """
+        factor = up_sampling_factor
+        window_len = self.kernel_size[0]
+        length = data.shape[1]
+        ext_le = -(-self.pad_le // factor)
+        ext_ri = -(-self.pad_ri // factor)
+        k_min = window_len // factor
+        # (batchsize=1, dim, ext_le + length + ext_ri) padded frames
+        frames = torch_nn_func.pad(data.permute(0, 2, 1).unsqueeze(2), \
+                                   (ext_le, ext_ri, 0, 0),
+                                   mode = self.pad_mode).squeeze(2)
+        # back to (batchsize=1, length, dim), with (unused) zero frames 
+        # so that q + k stays in range for every q
+        n_frames = length + ext_le
+        frames = torch_nn_func.pad(frames.permute(0, 2, 1), 
+                                   (0, 0, 0, n_frames + k_min + 1 
+                                    - frames.shape[2]))
+        # weights are all equal to 1/window_len
+        frames = frames * self.weight[:, 0, 0]
+        cumsum = torch_nn_func.pad(torch.cumsum(frames.double(), dim=1),
+                                   (0, 0, 1, 0))
+
+        phases = torch.arange(factor, dtype=data.dtype, device=data.device)
+        ends = phases + window_len - k_min * factor
+        # phases [0, split) end in frame q + k_min, others in q + k_min + 1
+        split = factor - window_len % factor
+        output = []
+        for k, sl in [(k_min, slice(0, split)), 
+                      (k_min + 1, slice(split, factor))]:
+            if sl.start == sl.stop:
+                continue
+            sums = ((cumsum[:, k:k+n_frames] - cumsum[:, :n_frames]) \
+                    * factor).to(data.dtype)
+            output.append(sums.unsqueeze(2)
+                + (ends[sl] - (k - k_min) * factor).view(1, 1, -1, 1)
+                * frames[:, k:k+n_frames].unsqueeze(2)
+                - phases[sl].view(1, 1, -1, 1)
+                * frames[:, :n_frames].unsqueeze(2))
+        # (batchsize=1, n_frames * factor, dim), cropped to the windows
+        # starting at the first step of the signal
+        output = torch.cat(output, dim=2).flatten(1, 2)
+        start = ext_le * factor - self.pad_le
+        return output[:, start:start + length * factor]
+
 # 
 # FIR filter layer
 class TimeInvFIRFilter(Conv1dKeepLength):
@@ -176,21 +282,55 @@ class TimeVarFIRFilter(torch_nn.Module):
     Note: filter coef (0, n, :) is only used to compute the output 
           at (0, n, 1)
     """
+    # number of output steps computed at once (bounds the temporary
+    # memory to chunk_size * filter_order values)
+    chunk_size = 16384
+
     def __init__(self):
         super(TimeVarFIRFilter, self).__init__()
     
-    def forward(self, signal, f_coef):
+    def forward(self, signal, f_coef, history=None):
         """ 
         Filter coefs: (batchsize=1, signal_length, filter_order = K)
         Signal:       (batchsize=1, signal_length, 1)
+        history:      (batchsize=1, filter_order-1, 1) samples preceding
+                      the signal (default: zeros)
         
         Output:       (batchsize=1, signal_length, 1)
         
         For n in [1, sequence_length):
           output(0, n, 1)= \sum_{k=1}^{K} signal(0, n-k, 1)*coef(0, n, k)
-          
-        This method may be not efficient:
-        
+
+        The K past samples of each step are read from a strided view
+        (unfold) of the left-padded signal, and multiplied-reduced with
+        the coefficients over chunks of chunk_size steps
+        """
+        signal_l = signal.shape[1]
+        order_k = f_coef.shape[-1]
+
+        # pad to (batchsize=1, filter_order-1 + signal_length, dim)
+        if history is None:
+            padded_signal = torch_nn_func.pad(signal, (0, 0, order_k - 1, 0))
+        else:
+            padded_signal = torch.cat((history, signal), dim=1)
+        # (batchsize=1, signal_length, dim, filter_order), no copy
+        # frames[:, n, :, j] = signal[:, n - (K-1) + j, :]
+        frames = padded_signal.unfold(1, order_k, 1)
+
+        y = torch.empty_like(signal)
+        for start in range(0, signal_l, self.chunk_size):
+            stop = min(start + self.chunk_size, signal_l)
+            # coef k is applied to signal(n-k), i.e. to frame index K-1-k
+            y[:, start:stop] = torch.einsum(
+                'bldk,blk->bld', frames[:, start:stop].flip(-1),
+                f_coef[:, start:stop])
+        # done
+        return y
+
+    def forward_roll(self, signal, f_coef):
+        """ 
+        Reference implementation of forward (one torch.roll per tap)
+
         Suppose signal [x_1, ..., x_N], filter [a_1, ..., a_K]
         output         [y_1, y_2, y_3, ..., y_N, *, * ... *]
                = a_1 * [x_1, x_2, x_3, ..., x_N,   0, ...,   0]
@@ -238,6 +378,9 @@ class SincFilter(torch_nn.Module):
         plt.plot(w, 20*np.log10(np.abs(h2)))
         plt.plot([cut_f * np.pi, cut_f * np.pi], [-100, 0])
     """
+    # range of the cut-off frequency given by the condition module
+    lut_range = (0.1, 0.9)
+
     def __init__(self, filter_order):
         super(SincFilter, self).__init__()
         # Make the filter oder an odd number
@@ -245,6 +388,9 @@ class SincFilter(torch_nn.Module):
         # 
         self.half_k = (filter_order - 1) // 2
         self.order = self.half_k * 2 +1
+        # look-up tables of coefficients (see enable_lut)
+        self.register_buffer('lut_lp', None, persistent=False)
+        self.register_buffer('lut_hp', None, persistent=False)
         
     def hamming_w(self, n_index):
         """ prepare hamming window for each time step
@@ -283,6 +429,76 @@ class SincFilter(torch_nn.Module):
     
         lp_coef: low-pass filter coefs  (batchsize, length, filter_order)
         hp_coef: high-pass filter coefs (batchsize, length, filter_order)
+
+        coefficients are interpolated from look-up tables if enabled
+        """
+        # models loaded from older pickles do not have the attribute
+        if getattr(self, 'lut_lp', None) is not None:
+            return self.forward_lut(cut_f)
+        return self.forward_exact(cut_f)
+
+    def forward_lut(self, cut_f):
+        """ lp_coef, hp_coef = forward_lut(self, cut_f)
+        linear interpolation of the tables built by enable_lut
+        (cut_f is clipped to lut_range)
+        """
+        f_min, f_max = self.lut_range
+        n_points = self.lut_lp.shape[0]
+        pos = (cut_f[:, :, 0].clamp(f_min, f_max) - f_min) \
+              * ((n_points - 1) / (f_max - f_min))
+        idx = pos.long().clamp(max=n_points - 2)
+        frac = (pos - idx).unsqueeze(-1)
+        lp_coef = torch.lerp(self.lut_lp[idx], self.lut_lp[idx + 1], frac)
+        hp_coef = torch.lerp(self.lut_hp[idx], self.lut_hp[idx + 1], frac)
+        return lp_coef, hp_coef
+
+    def enable_lut(self, n_points=4096, device=None):
+        """ error = enable_lut(self, n_points, device=None)
+        precompute normalized coefficients over n_points cut-off values
+        in lut_range (tables are not saved in the state_dict)
+        device: device of the tables, i.e. of the model (default: device
+                of the current tables, or cpu as the layer has no 
+                parameter to give the device of the model)
+        Returns the maximum absolute error of the interpolated coefficients
+        against the exact ones (see lut_error)
+        """
+        if device is None:
+            device = self.lut_device()
+        grid = torch.linspace(self.lut_range[0], self.lut_range[1], 
+                              n_points, device=device, dtype=torch.float64)
+        with torch.no_grad():
+            lp_coef, hp_coef = self.forward_exact(grid.view(1, -1, 1))
+        self.register_buffer('lut_lp', lp_coef[0].float(), persistent=False)
+        self.register_buffer('lut_hp', hp_coef[0].float(), persistent=False)
+        return self.lut_error()
+
+    def disable_lut(self):
+        self.lut_lp = None
+        self.lut_hp = None
+
+    def lut_device(self):
+        if getattr(self, 'lut_lp', None) is not None:
+            return self.lut_lp.device
+        return torch.device('cpu')
+
+    def lut_error(self, n_test=100003):
+        """ error = lut_error(self, n_test)
+        maximum absolute error of the LUT coefficients against the exact
+        ones, over n_test cut-off values in lut_range
+        (dictionary {'lp': error, 'hp': error})
+        """
+        cut_f = torch.linspace(self.lut_range[0], self.lut_range[1], 
+                               n_test, device=self.lut_device())
+        with torch.no_grad():
+            lp_ref, hp_ref = self.forward_exact(
+                cut_f.view(1, -1, 1).double())
+            lp_coef, hp_coef = self.forward_lut(cut_f.view(1, -1, 1))
+        return {'lp': (lp_coef.double() - lp_ref).abs().max().item(),
+                'hp': (hp_coef.double() - hp_ref).abs().max().item()}
+
+    def forward_exact(self, cut_f):
+        """ lp_coef, hp_coef = forward_exact(self, cut_f)
+        coefficients computed for every time step
         """
         # create the filter order index
         with torch.no_grad():   
@@ -348,6 +564,13 @@ class UpSampleLayer(torch_nn.Module):
         return
     
     def forward(self, x):
+        # the first moving average is fused with the up-sampling
+        if isinstance(self.l_ave2, MovingAverage):
+            return self.l_ave1(self.l_ave2.forward_upsampled(
+                x, self.scale_factor))
+        return self.forward_reference(x)
+
+    def forward_reference(self, x):
         # permute to (batchsize=1, dim, length)
         up_sampled_data = self.l_upsamp(x.permute(0, 2, 1))
 
@@ -416,6 +639,36 @@ class NeuralFilterBlock(torch_nn.Module):
         output_signal = tmp_hidden + signal
         
         return output_signal
+
+    def forward_cf(self, signal, context):
+        """ channels-first forward
+        Assume: signal (batchsize=1, signal_size, length)
+                context (batchsize=1, hidden_size, length)
+        Output: (batchsize=1, signal_size, length)
+
+        The Linear layers are applied as 1x1 convolutions with their 
+        own weights, hence the block is computed without permutation
+        """
+        # expand dimension
+        tmp_hidden = self.l_ff_1_tanh(self.pointwise(self.l_ff_1, signal))
+        
+        # loop over dilated convs
+        for l_conv in self.l_convs:
+            tmp_hidden = tmp_hidden + l_conv.forward_cf(tmp_hidden) + context
+
+        tmp_hidden = tmp_hidden * self.scale
+        
+        # compress the dimesion and skip-add
+        tmp_hidden = self.l_ff_2_tanh(self.pointwise(self.l_ff_2, tmp_hidden))
+        tmp_hidden = self.l_ff_3_tanh(self.pointwise(self.l_ff_3, tmp_hidden))
+        return tmp_hidden + signal
+
+    @staticmethod
+    def pointwise(l_linear, x):
+        """ Linear layer over channels-first data (1x1 convolution)
+        """
+        return torch_nn_func.conv1d(x, l_linear.weight.unsqueeze(2), 
+                                    l_linear.bias)
     
 # 
 # Sine waveform generator
@@ -518,24 +771,76 @@ class SineGen(torch_nn.Module):
         return  sines
     
     
-    def forward(self, f0):
-        """ sine_tensor, uv = forward(f0)
+    def harmonic_sines(self, f0, phase, offset):
+        """ sines, phase = harmonic_sines(f0, phase, offset)
+        input f0: tensor(batchsize, length, 1), in Hz
+        input phase: tensor(batchsize, 1), float64 phase of the fundamental
+                     before the first step (in cycles)
+        input offset: tensor(batchsize, n), initial phase of each 
+                      harmonic (in cycles), for the first n harmonics
+        output sines: tensor(batchsize, length, n)
+        output phase: tensor(batchsize, 1), phase after the last step
+        
+        The phase of the k-th harmonic is k * phi + offset_k, with phi 
+        the phase of the fundamental, which is accumulated only once 
+        (in float64, wrapped to [0, 1)). The harmonics are then given by
+        one broadcast multiply-add and one sin.
+        Passing the returned phase to the next call continues the sines
+        without discontinuity.
+        """
+        rad_values = f0[:, :, 0].double() / self.sampling_rate
+        phi = (torch.cumsum(rad_values, dim=1) + phase) % 1
+        harmonics = torch.arange(1, offset.shape[1] + 1, dtype=f0.dtype, 
+                                 device=f0.device)
+        # (batchsize, length, n) phases, in cycles
+        i_phase = torch.addcmul(offset.to(f0.dtype).unsqueeze(1), 
+                                phi.to(f0.dtype).unsqueeze(-1), harmonics)
+        return torch.sin(i_phase.mul_(2 * np.pi)), phi[:, -1:]
+
+    def active_harmonics(self, f0):
+        """ number of harmonics below the Nyquist frequency at one voiced
+        step at least, given by the lowest voiced F0 (the harmonics above
+        are above the Nyquist frequency at every step)
+        input F0: tensor(batchsize, length, dim=1)
+        (the fundamental is always kept)
+        """
+        voiced = f0[f0 > self.voiced_threshold]
+        if voiced.numel() == 0:
+            return 1
+        n_harmonics = np.ceil(self.sampling_rate / 2 / voiced.min().item()) - 1
+        return int(min(self.dim, max(1, n_harmonics)))
+    
+    def forward(self, f0, n_harmonics=None):
+        """ sine_tensor, uv = forward(f0, n_harmonics=None)
         input F0: tensor(batchsize=1, length, dim=1)
                   f0 for unvoiced steps should be 0
-        output sine_tensor: tensor(batchsize=1, length, dim)
+        n_harmonics: only generate the first n harmonics (default: dim)
+        output sine_tensor: tensor(batchsize=1, length, n_harmonics)
         output uv: tensor(batchsize=1, length, 1)
         """
+        if n_harmonics is None:
+            n_harmonics = self.dim
         with torch.no_grad():
-            f0_buf = torch.zeros(f0.shape[0], f0.shape[1], self.dim, \
-                                    device=f0.device)
-            # fundamental component
-            f0_buf[:, :, 0] = f0[:, :, 0]
-            for idx in np.arange(self.harmonic_num):
-                # idx + 2: the (idx+1)-th overtone, (idx+2)-th harmonic
-                f0_buf[:, :, idx+1] = f0_buf[:, :, 0] * (idx+2)
-                
-            # generate sine waveforms
-            sine_waves = self._f02sine(f0_buf) * self.sine_amp
+            if self.flag_for_pulse:
+                f0_buf = torch.zeros(f0.shape[0], f0.shape[1], self.dim, \
+                                        device=f0.device)
+                # fundamental component
+                f0_buf[:, :, 0] = f0[:, :, 0]
+                for idx in np.arange(self.harmonic_num):
+                    # idx + 2: the (idx+1)-th overtone, (idx+2)-th harmonic
+                    f0_buf[:, :, idx+1] = f0_buf[:, :, 0] * (idx+2)
+                    
+                # generate sine waveforms
+                sine_waves = self._f02sine(f0_buf) * self.sine_amp
+            else:
+                # initial phase noise (no noise for fundamental component)
+                rand_ini = torch.rand(f0.shape[0], self.dim, \
+                                      device = f0.device)
+                rand_ini[:, 0] = 0
+                phase = torch.zeros(f0.shape[0], 1, dtype=torch.float64, \
+                                    device = f0.device)
+                sine_waves = self.harmonic_sines(
+                    f0, phase, rand_ini[:, :n_harmonics])[0] * self.sine_amp
             
             # generate uv signal
             #uv = torch.ones(f0.shape)
@@ -702,20 +1007,50 @@ class SourceModuleHnNSF(torch_nn.Module):
         self.l_linear = torch_nn.Linear(harmonic_num+1, 1)
         self.l_tanh = torch_nn.Tanh()
 
+    # skip the harmonics above the Nyquist frequency (they only alias)
+    nyquist_pruning = False
+
     def forward(self, x):
         """
         Sine_source, noise_source = SourceModuleHnNSF(F0_sampled)
         F0_sampled (batchsize, length, 1)
         Sine_source (batchsize, length, 1)
         noise_source (batchsize, length 1)
+
+        with nyquist_pruning, only the harmonics below the Nyquist 
+        frequency over the whole input are generated
         """
         # source for harmonic branch
-        sine_wavs, uv, _ = self.l_sin_gen(x)
-        sine_merge = self.l_tanh(self.l_linear(sine_wavs))
+        n_harmonics = None
+        if self.nyquist_pruning:
+            n_harmonics = self.l_sin_gen.active_harmonics(x)
+        sine_wavs, uv, _ = self.l_sin_gen(x, n_harmonics)
+        sine_merge = self.merge(sine_wavs, uv)
 
         # source for noise branch, in the same shape as uv
         noise = torch.randn_like(uv) * self.sine_amp / 3
         return sine_merge, noise, uv
+
+    def merge(self, sine_wavs, uv):
+        """ merge the first harmonics into a single excitation
+        sine_wavs (batchsize, length, n_harmonics)
+        uv (batchsize, length, 1)
+        Sine_source (batchsize, length, 1)
+
+        The additive noise of the missing harmonics is replaced by a
+        single noise with the same distribution after l_linear
+        """
+        n_harmonics = sine_wavs.shape[-1]
+        weight = self.l_linear.weight
+        if n_harmonics == weight.shape[1]:
+            return self.l_tanh(self.l_linear(sine_wavs))
+        sine_merge = torch_nn_func.linear(sine_wavs, weight[:, :n_harmonics],
+                                          self.l_linear.bias)
+        gen = self.l_sin_gen
+        noise_amp = uv * gen.noise_std + (1 - uv) * gen.sine_amp / 3
+        sine_merge = sine_merge + noise_amp * torch.randn_like(uv) \
+                     * weight[:, n_harmonics:].norm()
+        return self.l_tanh(sine_merge)
         
         
 # For Filter module
@@ -767,22 +1102,62 @@ class FilterModuleHnSincNSF(torch_nn.Module):
         # done
         
 
+    # run the harmonic and noise branches concurrently (see forward)
+    parallel_branches = False
+    # worker thread shared by all filter modules
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    @classmethod
+    def executor(cls):
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix='nsf_branch')
+        return cls._executor
+
+    def branch(self, l_blocks, component, cond_feat, f_coef):
+        """ output = branch(l_blocks, component, cond_feat, f_coef)
+        filter blocks and time-variant filtering of one branch
+        component: (batchsize, length, dim=1)
+        cond_feat: (batchsize, hidden_size, length), channels-first
+        f_coef: (batchsize, length, sinc_order)
+        """
+        # the filter blocks work on channels-first data 
+        # (batchsize, dim, length)
+        component = component.transpose(1, 2)
+        for l_block in l_blocks:
+            component = l_block.forward_cf(component, cond_feat)
+        # back to (batchsize, length, dim) for time-variant filtering
+        return self.l_tv_filtering(component.transpose(1, 2), f_coef)
+
     def forward(self, har_component, noi_component, cond_feat, cut_f):
         """
+        with parallel_branches, the noise branch runs in a worker thread
+        while the harmonic branch runs in the calling thread (torch ops
+        release the GIL)
         """
-        # harmonic component
-        for l_har_block in self.l_har_blocks:
-            har_component = l_har_block(har_component, cond_feat)
-        # noise componebt
-        for l_noi_block in self.l_noi_blocks:
-            noi_component = l_noi_block(noi_component, cond_feat)
+        cond_feat = cond_feat.transpose(1, 2).contiguous()
         
         # get sinc filter coefficients
         lp_coef, hp_coef = self.l_sinc_coef(cut_f)
 
-        # time-variant filtering
-        har_signal = self.l_tv_filtering(har_component, lp_coef)
-        noi_signal = self.l_tv_filtering(noi_component, hp_coef)
+        if self.parallel_branches:
+            # grad mode is thread-local
+            grad_mode = torch.is_grad_enabled()
+            def noise_branch():
+                with torch.set_grad_enabled(grad_mode):
+                    return self.branch(self.l_noi_blocks, noi_component, 
+                                       cond_feat, hp_coef)
+            noi_signal = self.executor().submit(noise_branch)
+            har_signal = self.branch(self.l_har_blocks, har_component, 
+                                     cond_feat, lp_coef)
+            noi_signal = noi_signal.result()
+        else:
+            har_signal = self.branch(self.l_har_blocks, har_component, 
+                                     cond_feat, lp_coef)
+            noi_signal = self.branch(self.l_noi_blocks, noi_component, 
+                                     cond_feat, hp_coef)
 
         # get output 
         return har_signal + noi_signal
@@ -793,7 +1168,14 @@ class FilterModuleHnSincNSF(torch_nn.Module):
 class Model(torch_nn.Module):
     """ Model definition
     """
-    def __init__(self, in_dim, out_dim, args, mean_std=None):
+    def __init__(self, in_dim, out_dim, args, mean_std=None, 
+                 hidden_dim=64, filter_block_num=5, cnn_num_in_block=10,
+                 harmonic_num=16):
+        """ 
+        hidden_dim, filter_block_num, cnn_num_in_block, harmonic_num: 
+          size of the model (default: configuration of the trained 
+          models), smaller for a student model (see distill.py)
+        """
         super(Model, self).__init__()
         out_dim = 1
         torch.manual_seed(1)
@@ -813,7 +1195,7 @@ class Model(torch_nn.Module):
         # standard deviation of Gaussian noise for additive noise
         self.noise_std = 0.003
         # dimension of hidden features in filter blocks
-        self.hidden_dim = 64
+        self.hidden_dim = hidden_dim
         # upsampling rate on input acoustic features (16kHz * 5ms = 80)
         # assume input_reso has the same value
         self.upsamp_rate = 512 #prj_conf.input_reso[0]
@@ -823,11 +1205,11 @@ class Model(torch_nn.Module):
         self.cnn_kernel_s = 3
         # number of filter blocks (for harmonic branch)
         # noise branch only uses 1 block
-        self.filter_block_num = 5
+        self.filter_block_num = filter_block_num
         # number of dilated CNN in each filter block
-        self.cnn_num_in_block = 10
+        self.cnn_num_in_block = cnn_num_in_block
         # number of harmonic overtones in source
-        self.harmonic_num = 16
+        self.harmonic_num = harmonic_num
         # order of sinc-windowed-FIR-filter
         self.sinc_order = 31
 
@@ -893,6 +1275,17 @@ class Model(torch_nn.Module):
         """
         return y * self.output_std + self.output_mean
     
+    # cache of the module outputs, used for inference (see stage_cache.py)
+    stage_cache = None
+
+    def cached_stage(self, stage, data, compute):
+        """ outputs of compute(), reused from the stage cache when the 
+        input slice data of the stage is unchanged
+        """
+        if self.stage_cache is None or self.training:
+            return compute()
+        return self.stage_cache.cached(stage, data, compute)
+
     def forward(self, x):
         """ definition of forward method 
         Assume x (batchsize=1, length, dim)
@@ -906,11 +1299,13 @@ class Model(torch_nn.Module):
         # condition module
         # feature-to-filter-block, f0-up-sampled, cut-off-f-for-sinc,
         #  hidden-feature-for-cut-off-f
-        cond_feat, f0_upsamped, cut_f, hid_cut_f = self.m_cond(feat, f0)
+        cond_feat, f0_upsamped, cut_f, hid_cut_f = self.cached_stage(
+            'cond', x, lambda: self.m_cond(feat, f0))
 
-        # source module
+        # source module (only depends on F0)
         # harmonic-source, noise-source (for noise branch), uv
-        har_source, noi_source, uv = self.m_source(f0_upsamped)
+        har_source, noi_source, uv = self.cached_stage(
+            'source', f0, lambda: self.m_source(f0_upsamped))
         
         # neural filter module (including sinc-based FIR filtering)
         # output
@@ -974,14 +1369,12 @@ class Loss():
             window = self.win(frame_len).to(output.device)
             x_stft = torch.stft(output, fft_p, frame_shift, frame_len, \
                                 window=window, onesided=True,
-                                pad_mode="constant")
+                                pad_mode="constant", return_complex=True)
             y_stft = torch.stft(target, fft_p, frame_shift, frame_len, \
                                 window=window, onesided=True,
-                                pad_mode="constant")
-            x_sp_amp = torch.log(torch.norm(x_stft, 2, -1).pow(2) + \
-                                   self.amp_floor)
-            y_sp_amp = torch.log(torch.norm(y_stft, 2, -1).pow(2) + \
-                                   self.amp_floor)
+                                pad_mode="constant", return_complex=True)
+            x_sp_amp = torch.log(x_stft.abs().pow(2) + self.amp_floor)
+            y_sp_amp = torch.log(y_stft.abs().pow(2) + self.amp_floor)
             loss += self.loss(x_sp_amp, y_sp_amp)
         
         # A norm on cut_f, which forces sinc-cut-off-frequency
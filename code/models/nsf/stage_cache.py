@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+stage_cache.py for hn-sinc-NSF
+
+Cache of the outputs of the modules of a sinc_nsf.Model, keyed by a hash
+of the input slice each module depends on:
+ - source module: F0 column only
+ - condition module: all the input features
+
+When only some descriptors change (e.g. rolloff, flatness and bandwidth
+in the interpolations), the harmonic / noise sources are reused instead of
+being generated again. Cached sources keep the random phases and noise
+drawn when they were first generated.
+
+Usage:
+ model.stage_cache = StageCache(64)
+ output = model(features)
+ model.stage_cache.stats()
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import hashlib
+import threading
+import collections
+import torch
+
+__author__ = "Ninon Devis, Philippe Esling, Martin Vert"
+__email__ = "{devis, esling}@ircam.fr"
+
+
+class StageCache():
+    """ LRU cache of module outputs
+    StageCache(max_entries=64)
+    max_entries: number of outputs kept (over all stages)
+    """
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = collections.Counter()
+        self._misses = collections.Counter()
+
+    @staticmethod
+    def key(stage, data):
+        """ key = key(stage, data)
+        hash of a stage name and of the content, shape and type of data
+        """
+        sha = hashlib.sha1(stage.encode('utf-8'))
+        sha.update(repr((tuple(data.shape), str(data.dtype))).encode('utf-8'))
+        sha.update(data.detach().contiguous().cpu().numpy().tobytes())
+        return sha.hexdigest()
+
+    def cached(self, stage, data, compute):
+        """ outputs = cached(stage, data, compute)
+        outputs of compute() for the given input slice, reused if the
+        same slice was already seen by this stage
+        """
+        key = self.key(stage, data)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self._hits[stage] += 1
+                return self._entries[key]
+            self._misses[stage] += 1
+        outputs = compute()
+        with self._lock:
+            self._entries[key] = outputs
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return outputs
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """ hits and misses of each stage
+        """
+        with self._lock:
+            return {stage: {'hits': self._hits[stage],
+                            'misses': self._misses[stage]}
+                    for stage in set(self._hits) | set(self._misses)}
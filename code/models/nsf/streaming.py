@@ -0,0 +1,381 @@
+#!/usr/bin/env python
+"""
+streaming.py for hn-sinc-NSF
+
+Stateful streaming inference over a trained sinc_nsf.Model.
+Frame-level features are pushed chunk by chunk, and every layer keeps
+the history it needs (convolution inputs, moving-average windows, sine
+phases), so that each call only computes the samples of the new frames.
+
+The condition module is not causal (kernel-3 convolutions and centered
+moving averages), hence the output lags behind the input by the look-ahead
+of these layers. Calling flush() at the end of the stream applies the same
+right padding as the offline forward, so that the concatenation of all
+outputs matches Model.forward(features) for the same source signals.
+
+Usage:
+ stream = StreamingModel(model)
+ audio = [stream.push(chunk) for chunk in features.split(15, dim=1)]
+ audio.append(stream.flush())
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import numpy as np
+import torch
+import torch.nn as torch_nn
+import torch.nn.functional as torch_nn_func
+
+__author__ = "Ninon Devis, Philippe Esling, Martin Vert"
+__email__ = "{devis, esling}@ircam.fr"
+
+
+##############
+# Streaming building blocks
+# All tensors are (batchsize, length, dim), as in sinc_nsf.py
+
+class StreamConv():
+    """ Streaming wrapper over a Conv1dKeepLength (or MovingAverage)
+    Keeps the last dilation * (kernel - 1) input steps between calls.
+    The left padding of the offline layer is used to initialize the
+    history, and flush() feeds its right padding.
+    """
+    def __init__(self, layer):
+        self.layer = layer
+        self.receptive = layer.dilation[0] * (layer.kernel_size[0] - 1)
+        self.replicate = (layer.pad_mode == 'replicate')
+        self.history = None
+
+    def reset(self):
+        self.history = None
+
+    def _pad(self, data, length):
+        # padding values, either zeros or replicated boundary step
+        if self.replicate:
+            return data.expand(-1, -1, length)
+        return torch.zeros(data.shape[0], data.shape[1], length,
+                           dtype=data.dtype, device=data.device)
+
+    def push(self, data):
+        x = data.permute(0, 2, 1)
+        if self.history is None and x.shape[2] == 0:
+            return data.new_zeros(data.shape[0], 0, self.layer.out_channels)
+        if self.history is None:
+            self.history = self._pad(x[:, :, :1], self.layer.pad_le)
+        buf = torch.cat((self.history, x), dim=2)
+        if buf.shape[2] <= self.receptive:
+            self.history = buf
+            return data.new_zeros(data.shape[0], 0, self.layer.out_channels)
+        self.history = buf[:, :, buf.shape[2] - self.receptive:]
+        if hasattr(self.layer, 'forward_valid'):
+            # moving average from prefix sums
+            return self.layer.forward_valid(buf).permute(0, 2, 1)
+        # valid convolution (Conv1dKeepLength is created with padding=0)
+        output = self.layer.l_ac(torch_nn.Conv1d.forward(self.layer, buf))
+        return output.permute(0, 2, 1)
+
+    def flush(self):
+        if self.history is None or self.layer.pad_ri == 0:
+            return None
+        pad = self._pad(self.history[:, :, -1:], self.layer.pad_ri)
+        return self.push(pad.permute(0, 2, 1))
+
+
+class StreamUpSample():
+    """ Streaming nearest up-sampling (stateless)
+    """
+    def __init__(self, factor):
+        self.factor = factor
+
+    def reset(self):
+        pass
+
+    def push(self, data):
+        return torch.repeat_interleave(data, self.factor, dim=1)
+
+    def flush(self):
+        return None
+
+
+class StreamChain():
+    """ Sequence of streaming stages
+    flush() propagates the tail of each stage through the next ones
+    """
+    def __init__(self, stages):
+        self.stages = stages
+
+    def reset(self):
+        for stage in self.stages:
+            stage.reset()
+
+    def push(self, data):
+        for stage in self.stages:
+            data = stage.push(data)
+        return data
+
+    def flush(self):
+        data = None
+        for stage in self.stages:
+            if data is not None:
+                data = stage.push(data)
+            tail = stage.flush()
+            if tail is not None:
+                data = tail if data is None else torch.cat((data, tail), 1)
+        return data
+
+
+class StreamFifo():
+    """ Pending samples of one branch, consumed in aligned steps
+    """
+    def __init__(self):
+        self.data = None
+
+    def reset(self):
+        self.data = None
+
+    def __len__(self):
+        return 0 if self.data is None else self.data.shape[1]
+
+    def append(self, data):
+        if data is None or data.shape[1] == 0:
+            return
+        self.data = data if self.data is None \
+            else torch.cat((self.data, data), dim=1)
+
+    def pop(self, length):
+        out = self.data[:, :length]
+        self.data = self.data[:, length:]
+        return out
+
+
+class StreamSineGen():
+    """ Streaming version of SineGen (flag_for_pulse=False)
+    The phase of the fundamental and the initial phase of each harmonic
+    are carried between calls (see SineGen.harmonic_sines).
+    """
+    def __init__(self, sine_gen):
+        self.gen = sine_gen
+        self.phase = None
+        self.offset = None
+
+    def reset(self):
+        self.phase = None
+        self.offset = None
+
+    def push(self, f0, n_harmonics=None):
+        gen = self.gen
+        if n_harmonics is None:
+            n_harmonics = gen.dim
+        with torch.no_grad():
+            # initial phase noise (no noise for fundamental component)
+            if self.phase is None:
+                self.offset = torch.rand(f0.shape[0], gen.dim,
+                                         device=f0.device)
+                self.offset[:, 0] = 0
+                self.phase = torch.zeros(f0.shape[0], 1, 
+                                         dtype=torch.float64,
+                                         device=f0.device)
+            sine_waves, self.phase = gen.harmonic_sines(
+                f0, self.phase, self.offset[:, :n_harmonics])
+            sine_waves = sine_waves * gen.sine_amp
+            # uv and additive noise, as in SineGen.forward
+            uv = gen._f02uv(f0)
+            noise_amp = uv * gen.noise_std + (1 - uv) * gen.sine_amp / 3
+            noise = noise_amp * torch.randn_like(sine_waves)
+            sine_waves = sine_waves * uv + noise
+        return sine_waves
+
+
+class StreamNeuralFilterBlock():
+    """ Streaming version of NeuralFilterBlock (causal d-convs)
+    """
+    def __init__(self, block):
+        self.block = block
+        self.convs = [StreamConv(l_conv) for l_conv in block.l_convs]
+
+    def reset(self):
+        for conv in self.convs:
+            conv.reset()
+
+    def push(self, signal, context):
+        block = self.block
+        tmp_hidden = block.l_ff_1_tanh(block.l_ff_1(signal))
+        for conv in self.convs:
+            tmp_hidden = tmp_hidden + conv.push(tmp_hidden) + context
+        tmp_hidden = tmp_hidden * block.scale
+        tmp_hidden = block.l_ff_2_tanh(block.l_ff_2(tmp_hidden))
+        tmp_hidden = block.l_ff_3_tanh(block.l_ff_3(tmp_hidden))
+        return tmp_hidden + signal
+
+
+class StreamTimeVarFIR():
+    """ Streaming time-variant FIR filtering (keeps order-1 past samples)
+    """
+    def __init__(self, tv_filter):
+        self.tv_filter = tv_filter
+        self.history = None
+
+    def reset(self):
+        self.history = None
+
+    def push(self, signal, f_coef):
+        order_k = f_coef.shape[-1]
+        if self.history is None:
+            self.history = torch.zeros_like(signal[:, 0:1, :]).expand(
+                -1, order_k - 1, -1)
+        history = self.history
+        buf = torch.cat((history, signal), dim=1)
+        self.history = buf[:, buf.shape[1] - (order_k - 1):, :]
+        return self.tv_filter(signal, f_coef, history)
+
+
+##############
+# Streaming model
+
+class StreamingModel():
+    """ Stateful streaming inference for sinc_nsf.Model
+
+    StreamingModel(model)
+    push(features): features (batchsize, frames, dim) at frame-level
+                    returns the newly available waveform (batchsize, length)
+    flush(): terminates the stream and returns the remaining waveform
+    reset(): starts a new stream
+    """
+    def __init__(self, model):
+        if not hasattr(model, 'input_mean'):
+            raise ValueError("StreamingModel needs the trained model "
+                             "(inference-only models fold the input "
+                             "normalisation, see optimise.py)")
+        self.model = model
+        m_cond = model.m_cond
+        m_filter = model.m_filter
+        self.up_sample = m_cond.up_sample
+        self.output_dim = m_cond.output_dim
+        # condition module
+        self.s_conv = StreamChain([StreamConv(l) for l in m_cond.l_conv1ds])
+        self.s_hidden = StreamChain([
+            StreamUpSample(self.up_sample),
+            StreamConv(m_cond.l_upsamp.l_ave2),
+            StreamConv(m_cond.l_upsamp.l_ave1)])
+        self.s_f0_hi = StreamChain([
+            StreamUpSample(self.up_sample),
+            StreamConv(m_cond.l_upsamp_f0_hi.l_ave2),
+            StreamConv(m_cond.l_upsamp_f0_hi.l_ave1)])
+        self.s_f0 = StreamUpSample(self.up_sample)
+        self.s_cut_f = StreamChain([StreamConv(m_cond.l_cut_f_smooth)])
+        # source module
+        self.s_sine = StreamSineGen(model.m_source.l_sin_gen)
+        # filter module
+        self.s_har_blocks = [StreamNeuralFilterBlock(b)
+                             for b in m_filter.l_har_blocks]
+        self.s_noi_blocks = [StreamNeuralFilterBlock(b)
+                             for b in m_filter.l_noi_blocks]
+        self.s_har_fir = StreamTimeVarFIR(m_filter.l_tv_filtering)
+        self.s_noi_fir = StreamTimeVarFIR(m_filter.l_tv_filtering)
+        # aligned branches
+        self.q_hidden = StreamFifo()
+        self.q_f0_hi = StreamFifo()
+        self.q_f0_cut = StreamFifo()
+        self.q_f0_src = StreamFifo()
+        self.q_context = StreamFifo()
+        self.q_cut_f = StreamFifo()
+
+    def reset(self):
+        for stage in [self.s_conv, self.s_hidden, self.s_f0_hi,
+                      self.s_cut_f, self.s_sine, self.s_har_fir,
+                      self.s_noi_fir] + self.s_har_blocks + self.s_noi_blocks:
+            stage.reset()
+        for fifo in [self.q_hidden, self.q_f0_hi, self.q_f0_cut,
+                     self.q_f0_src, self.q_context, self.q_cut_f]:
+            fifo.reset()
+
+    def _cond(self, hidden, f0_hi, f0_up):
+        """ Align the condition branches and smooth the cut-off frequency
+        """
+        self.q_hidden.append(hidden)
+        self.q_f0_hi.append(f0_hi)
+        self.q_f0_cut.append(f0_up)
+        length = min(len(self.q_hidden), len(self.q_f0_hi),
+                     len(self.q_f0_cut))
+        if length == 0:
+            return None
+        tmp = self.q_hidden.pop(length)
+        context = torch.cat((tmp[:, :, 0:self.output_dim-1],
+                             self.q_f0_hi.pop(length)), dim=2)
+        self.q_context.append(context)
+        return self.model.m_cond.get_cut_f(tmp[:, :, self.output_dim-1:],
+                                           self.q_f0_cut.pop(length))
+
+    def _filter(self):
+        """ Render all samples for which every branch is available
+        """
+        length = min(len(self.q_context), len(self.q_cut_f),
+                     len(self.q_f0_src))
+        if length == 0:
+            return None
+        context = self.q_context.pop(length)
+        cut_f = self.q_cut_f.pop(length)
+        f0_up = self.q_f0_src.pop(length)
+        # source module
+        m_source = self.model.m_source
+        n_harmonics = None
+        if m_source.nyquist_pruning:
+            n_harmonics = m_source.l_sin_gen.active_harmonics(f0_up)
+        sine_wavs = self.s_sine.push(f0_up, n_harmonics)
+        har_component = m_source.merge(sine_wavs,
+                                       m_source.l_sin_gen._f02uv(f0_up))
+        noi_component = torch.randn_like(f0_up) * m_source.sine_amp / 3
+        # filter module
+        for s_block in self.s_har_blocks:
+            har_component = s_block.push(har_component, context)
+        for s_block in self.s_noi_blocks:
+            noi_component = s_block.push(noi_component, context)
+        lp_coef, hp_coef = self.model.m_filter.l_sinc_coef(cut_f)
+        har_signal = self.s_har_fir.push(har_component, lp_coef)
+        noi_signal = self.s_noi_fir.push(noi_component, hp_coef)
+        return (har_signal + noi_signal).squeeze(-1)
+
+    def _step(self, hidden, f0_hi, f0_up):
+        cut_f = self._cond(hidden, f0_hi, f0_up)
+        if cut_f is not None:
+            self.q_cut_f.append(self.s_cut_f.push(cut_f))
+        self.q_f0_src.append(f0_up)
+        return self._filter()
+
+    def _empty(self, x):
+        return x.new_zeros(x.shape[0], 0)
+
+    def push(self, x):
+        """ audio = push(x)
+        x: frame-level features (batchsize, frames, dim), F0 as last dim
+        audio: (batchsize, length) waveform that can be rendered so far
+        """
+        with torch.no_grad():
+            f0 = x[:, :, -1:]
+            feat = self.model.normalize_input(x)
+            hidden = self.s_hidden.push(self.s_conv.push(feat))
+            f0_hi = self.s_f0_hi.push(feat[:, :, -1:])
+            f0_up = self.s_f0.push(f0)
+            output = self._step(hidden, f0_hi, f0_up)
+        return self._empty(x) if output is None else output
+
+    def flush(self):
+        """ audio = flush()
+        Apply the right padding of the offline model and return the
+        remaining waveform. The stream must be reset afterwards.
+        """
+        with torch.no_grad():
+            tail = self.s_conv.flush()
+            hidden = self.s_hidden.push(tail) if tail is not None else None
+            tail = self.s_hidden.flush()
+            if tail is not None:
+                hidden = tail if hidden is None \
+                    else torch.cat((hidden, tail), dim=1)
+            output = self._step(hidden, self.s_f0_hi.flush(), None)
+            tail = self.s_cut_f.flush()
+            self.q_cut_f.append(tail)
+            last = self._filter()
+            outputs = [o for o in [output, last] if o is not None]
+        if len(outputs) == 0:
+            return torch.zeros(1, 0)
+        return torch.cat(outputs, dim=1)
@@ -10,8 +10,21 @@ import tqdm
 import soundfile as sf
 import threading
 from multiprocessing import Event, Process
-from torch2trt import torch2trt
-from torch2trt import TRTModule
+from models.block_buffer import BlockBuffer
+from models.nsf.streaming import StreamingModel
+from models.nsf.stage_cache import StageCache
+from models.nsf.export import TracedChunks, traceable
+from models.scheduler import ChunkScheduler, RegenerationScheduler
+from models.feature_store import FeatureStore
+from models.render_cache import RenderCache, quantise_cv, cv_key
+from models.morph_grid import MorphGrid, model_signature
+from models.speculative import CVTrend
+try:
+    from torch2trt import torch2trt
+    from torch2trt import TRTModule
+except ImportError:
+    # TensorRT is only available on the Jetson
+    torch2trt = None
 
 def spectral_features(y, sr):
     features = [None] * 7
@@ -31,30 +44,92 @@ def spectral_features(y, sr):
     return features
 
 
+def silent_spans(rms, threshold: float):
+    '''
+        Spans of consecutive frames (start, stop) where the RMS descriptor is
+        below the threshold (the last one is the silent tail, if any).
+    '''
+    silent = np.concatenate(([False], np.asarray(rms) < threshold, [False]))
+    edges = np.flatnonzero(silent[1:] != silent[:-1])
+    return [(int(start), int(stop)) for start, stop in zip(edges[0::2], edges[1::2])]
+
+
 class NSF:
     m_path = "/home/martin/Desktop/Impact-Synth-Hardware/code/models/model_nsf_sinc_ema_impacts_waveform_5.0.th"
     # m_path = "/home/hime/Work/Neurorack/Impact-Synth-Hardware/code/models/model_nsf_sinc_ema_impacts_waveform_5.0.th"
     trt_path = "/home/martin/Desktop/Impact-Synth-Hardware/code/models/model_trt_5.0.th"
     f_pass = 1
 
-    def __init__(self):
+    def __init__(self, streaming: bool = False, context=(0, 0), lookahead: int = 1, device: str = 'cuda', m_path: str = None,
+                 cache_budget: int = 64 * 2**20, cv_step: float = 0.05,
+                 morph_grid: tuple = None, morph_range: tuple = (0.0, 2.0),
+                 speculative: int = 0, sinc_lut: int = 0, nyquist_pruning: bool = False,
+                 stage_cache: int = 0, silence_db: float = None, parallel_branches: bool = False,
+                 traced: bool = False):
         # Testing NSF
         print('Creating empty NSF')
         self._model = None
+        self._device = device
+        if m_path is not None:
+            self.m_path = m_path
+        # Frames of (left, right) context of each chunk, or 'receptive_field' for the
+        # exact context of the model (about 3x the compute) [default: n_blocks + 1 window]
+        self._context = context
+        self._scheduler = None
+        # Chunks skipped after the playhead when regenerating
+        self._block_lookahead = lookahead
+        # Use the stateful streaming model instead of overlapping windows
+        self._streaming = streaming
+        self._stream = None
         self._wav_file = 'reference_impact.wav'
         self._n_blocks = 15
-        self._n_batch = 1
+        # Batch of the current features and of the speculative neighbours
+        self._n_batch = 1 + speculative
+        # Points of the sinc coefficients look-up table [default: exact coefficients]
+        self._sinc_lut = sinc_lut
+        # Skip the source harmonics above the Nyquist frequency in each chunk
+        self._nyquist_pruning = nyquist_pruning
+        # Entries of the cache of module outputs [default: disabled]
+        self._stage_cache = stage_cache
+        # Chunks whose RMS stays below this level (dBFS) are not rendered [default: disabled]
+        self._silence_db = silence_db
+        self._silence = {'chunks': 0, 'skipped': 0, 'skipped_frames': 0, 'skipped_peak': 0.0}
+        # Run the harmonic and noise filter branches concurrently
+        self._parallel_branches = parallel_branches
+        # Use TorchScript modules traced for the chunk shapes (cached next to the checkpoint)
+        self._traced = traced
         self._thread = None
         self._last_gen_block = 0
         self._last_request_block = -1
-        self._block_lookahead = 1
+        # Positions of the voices playing along with the most recent one
+        self._playheads = ()
+        self._regen = None
         self._last_val = None
         self._current_chunk = None
         self._next_chunk = None
-        self._generated_queue = []
+        self._block_size = 512
+        self._sr = 22050
+        self._buffer = None
+        self._fade_in = np.linspace(0, 1, self._block_size, dtype=np.float32)
+        self._fade_out = np.linspace(1, 0, self._block_size, dtype=np.float32)
         self._generate_end = False
         self._generate_signal = Event()
-        self._features = None
+        # Versioned features (swapped by the interpolations)
+        self._store = FeatureStore()
+        # Rendered sounds keyed by the quantised CVs (step in volts)
+        self._cache = RenderCache(cache_budget)
+        self._cv_step = cv_step
+        self._anchors = ()
+        self._pass_epoch = None
+        # Points of the pre-rendered grid (alpha, cv3, cv4, cv5) [default: disabled]
+        self._grid_points = morph_grid
+        self._grid_range = morph_range
+        self._grid = None
+        self._grid_query = None
+        # Predicted CV settings rendered along with the current ones
+        self._trend = CVTrend()
+        self._spec = None
+        self._spec_pass = None
         self._features_list = None
 
     def dummy_features(self, wav):
@@ -65,16 +140,29 @@ class NSF:
     def preload(self):
         torch.backends.cudnn.benchmark = True
         #if (not os.path.exists(self.trt_path)):
-        self._model = torch.load(self.m_path, map_location="cuda")
-        self._model = self._model.cuda()
+        self._model = torch.load(self.m_path, map_location=self._device)
+        self._model = self._model.to(self._device)
         #else:
         #    self._model = TRTModule()
         #    self._model.load_state_dict(torch.load(self.trt_path))
         #    self._model = self._model.cuda()
         self._model.eval()
         print("NSF model loaded")
+        if self._sinc_lut > 0:
+            error = self._model.m_filter.l_sinc_coef.enable_lut(self._sinc_lut, self._device)
+            print('Sinc LUT ({:d} points) error : lp {:.2e}, hp {:.2e}'.format(self._sinc_lut, error['lp'], error['hp']))
         self.features_loading()
-        self._features = self._features_list[0]
+        self._store.swap(self._features_list[0])
+        self._buffer = BlockBuffer(self.stream_length(), self._block_size)
+        self.set_scheduler()
+        if self._nyquist_pruning:
+            self._model.m_source.nyquist_pruning = True
+            print('Nyquist pruning : {:.1%} of the source harmonics skipped'.format(self.pruning_report()['saved']))
+        if self._stage_cache > 0:
+            self._model.stage_cache = StageCache(self._stage_cache)
+        self._model.m_filter.parallel_branches = self._parallel_branches
+        if self._traced:
+            self.trace_model()
         tmp_features = []
         for b in range(self._n_batch):
             tmp_features.append(self._features[:, (b*self._n_blocks):((b+1)*self._n_blocks)+1, :])
@@ -86,9 +174,6 @@ class NSF:
             with torch.no_grad():
                 cur_blocks = self._model(tmp_features).squeeze().cpu()#.numpy()
             print('Time : ' + str(time.monotonic() - cur_time))
-        # for b in range(self._n_blocks):
-        #    self._generated_queue.append(cur_blocks[(b * 512):((b+1)*512)])
-        #    self._last_gen_block = self._n_blocks
         #if (not os.path.exists(self.trt_path)):
         #    print("Switching model to TRT")
         #    self._model = torch2trt(self._model, [tmp_features])
@@ -96,10 +181,12 @@ class NSF:
         #    torch.save(self._model.state_dict(), self.trt_path)
         # print(len(self._features))
         self.start_generation_thread_full()
+        if self._grid_points is not None:
+            self.start_morph_grid()
 
     def generate_random(self, length=200):
         print('Generating random length ' + str(length))
-        features = [torch.randn(1, length, 1).cuda()] * 7
+        features = [torch.randn(1, length, 1).to(self._device)] * 7
         with torch.no_grad():
             audio = self._model(features)
         return audio.squeeze().detach().cpu().numpy()
@@ -109,8 +196,253 @@ class NSF:
             audio = self._model(features)
         return audio.squeeze().detach().cpu().numpy()
 
+    @property
+    def _features(self):
+        ''' Current version of the features (see FeatureStore) '''
+        return self._store.features
+
+    def stream_length(self):
+        '''
+            Number of blocks generated for the current features.
+        '''
+        n_chunks = (self._features.shape[1] - 1) // self._n_blocks
+        return n_chunks * self._n_blocks
+
+    def set_scheduler(self):
+        '''
+            Plan the chunk windows, either with a user-defined context or
+            (opt-in) with the context required by the receptive field of the model.
+        '''
+        n_frames = self._features.shape[1]
+        if self._context == 'receptive_field':
+            self._scheduler = ChunkScheduler.from_model(self._model, n_frames, self._n_blocks, self._block_size)
+        else:
+            self._scheduler = ChunkScheduler(n_frames, self._n_blocks, self._block_size, *self._context)
+        print('Chunk context : {:d} frames left, {:d} frames right ({:.2f}x cost)'.format(
+            self._scheduler.left, self._scheduler.right, self._scheduler.cost()))
+
+    @property
+    def underruns(self):
+        return self._buffer.underruns
+
+    def cache_stats(self):
+        ''' Counters of the render cache (see RenderCache.stats) '''
+        return self._cache.stats()
+
+    def stage_cache_stats(self):
+        ''' Hits and misses of the module outputs cache (see StageCache.stats) '''
+        if self._model is None or self._model.stage_cache is None:
+            return None
+        return self._model.stage_cache.stats()
+
+    def chunk_shapes(self):
+        '''
+            Input shapes of the chunk windows planned by the scheduler, for the
+            batch sizes that are rendered: the current features alone (batch 1)
+            or with 1 to n_batch - 1 speculative neighbours (those not cached
+            yet), plus the preload pass (n_batch, n_blocks + 1 frames).
+        '''
+        frames = set()
+        for block_id in range(0, self.stream_length(), self._n_blocks):
+            (in_start, in_stop), _ = self._scheduler.window(block_id)
+            frames.add(in_stop - in_start)
+        shapes = {(self._n_batch, self._n_blocks + 1)}
+        shapes |= {(b, f) for b in range(1, self._n_batch + 1) for f in frames}
+        return [(b, f, self._features.shape[2]) for b, f in sorted(shapes)]
+
+    def trace_model(self):
+        '''
+            Replace the model by its TorchScript traces for the chunk shapes
+            (other shapes still run the eager model).
+        '''
+        reason = traceable(self._model)
+        if reason is not None:
+            print('Model not traced (incompatible with the ' + reason + ')')
+            return
+        self._model = TracedChunks(self._model, self.chunk_shapes(), self.m_path)
+        print('Traced model : {:d} shapes loaded, {:d} traced in {:.2f}s'.format(
+            len(self._model.traced['loaded']), len(self._model.traced['traced']), self._model.load_time))
+
+    def pruning_report(self):
+        '''
+            Harmonics of the source module kept by the Nyquist pruning in the
+            chunk windows of the anchor sounds: a window only skips the
+            harmonics above the Nyquist frequency for its lowest voiced F0
+            (see SineGen.active_harmonics). Returns the share of harmonics
+            skipped, for each anchor and over the whole anchor set.
+        '''
+        source = self._model.m_source
+        n_harmonics = source.l_sin_gen.dim
+        report = {'anchors': {}}
+        total, active = 0, 0
+        for name, features in zip(self._anchors, self._features_list):
+            a_total, a_active = 0, 0
+            for block_id in range(0, self.stream_length(), self._n_blocks):
+                (in_start, in_stop), _ = self._scheduler.window(block_id)
+                f0 = features[:, in_start:in_stop, -1:]
+                a_total += n_harmonics * f0.shape[1]
+                a_active += source.l_sin_gen.active_harmonics(f0) * f0.shape[1]
+            report['anchors'][name] = 1 - a_active / a_total
+            total += a_total
+            active += a_active
+        report['saved'] = 1 - active / total
+        return report
+
+    def is_silent(self, window):
+        '''
+            Check whether the RMS descriptor of a window of features (with its
+            context) stays below the silence level, and count skipped chunks.
+        '''
+        if self._silence_db is None:
+            return False
+        self._silence['chunks'] += 1
+        peak = window[:, :, 0].max().item()
+        if peak >= 10 ** (self._silence_db / 20):
+            return False
+        self._silence['skipped'] += 1
+        self._silence['skipped_frames'] += self._n_blocks
+        self._silence['skipped_peak'] = max(self._silence['skipped_peak'], peak)
+        return True
+
+    def silence_report(self):
+        '''
+            Near-silent spans of the current features and chunks skipped so far.
+            The loudest skipped frame is given in dB relative to the peak of the
+            current sound, to check that no audible content was dropped.
+        '''
+        report = dict(self._silence)
+        if self._silence_db is None:
+            return report
+        rms = self._features[0, :, 0].cpu().numpy()
+        report['spans'] = silent_spans(rms, 10 ** (self._silence_db / 20))
+        report['skipped_peak_db'] = None
+        if report['skipped'] > 0:
+            report['skipped_peak_db'] = float(20 * np.log10(max(report['skipped_peak'], 1e-10) / rms.max()))
+        return report
+
+    def start_morph_grid(self):
+        '''
+            Load or build (in the background) the grid of pre-rendered sounds.
+            The grid is built once the first generation is complete.
+        '''
+        axes = [np.linspace(0, 1, self._grid_points[0])]
+        # A single point leaves the descriptor unscaled
+        axes += [np.linspace(self._grid_range[0], self._grid_range[1], n) if n > 1 else np.ones(1)
+                 for n in self._grid_points[1:]]
+        shape = (self._buffer.length, self._block_size)
+        signature = model_signature(self._model, [a.tolist() for a in axes], shape, features=self._features_list)
+        path = "models/morph_grid_" + signature[:16] + ".npz"
+        self._grid = MorphGrid(axes, shape, signature, path)
+        threading.Thread(target=self.build_morph_grid, args=(self._grid,)).start()
+
+    def build_morph_grid(self, grid):
+        if grid.load():
+            print('Morph grid loaded')
+            return
+        while self._buffer.written < self._buffer.length:
+            time.sleep(0.1)
+        print('Building morph grid ({:d} points, {:.1f}MB)'.format(grid.n_points, grid.nbytes / 2**20))
+        cur_time = time.monotonic()
+        n_samples = self._buffer.length * self._block_size
+
+        def render(alpha, cv3, cv4, cv5):
+            audio = self.generate(self.final_features(alpha, cv3, cv4, cv5))
+            return audio[:n_samples].reshape(-1, self._block_size)
+
+        grid.build(render)
+        print('Morph grid built in {:.1f}s'.format(time.monotonic() - cur_time))
+
+    def grid_sound(self):
+        '''
+            Crossfade of the grid renders around the settings of the current
+            features (epoch, blocks), without running the model.
+            Returns None if the current settings are not within the grid.
+        '''
+        query = self._grid_query
+        if query is None or self._grid is None or not self._grid.ready:
+            return None
+        epoch, values = query
+        if not self._store.is_current(epoch) or not self._grid.contains(values):
+            return None
+        return epoch, self._grid.interpolate(values)
+
+    def restored_sound(self):
+        '''
+            Sound of the current features rendered beforehand, from the
+            cache or else from the morph grid (None if neither has it).
+        '''
+        restored = self.cached_sound()
+        if restored is None:
+            restored = self.grid_sound()
+        return restored
+
+    def cached_sound(self):
+        '''
+            Rendering of the current features from the cache
+            (epoch, blocks), or None on a cache miss.
+        '''
+        epoch, features, key = self._store.keyed_snapshot()
+        audio = self._cache.get(key)
+        if audio is None:
+            return None
+        return epoch, audio
+
+    def restored_chunk(self, audio, gen_block):
+        '''
+            Samples of the chunk starting at gen_block in a whole sound
+            (length, block_size), with its overlap as in render_window.
+        '''
+        chunk = np.zeros((self._n_blocks + 1) * self._block_size, dtype=np.float32)
+        blocks = audio[gen_block:(gen_block + self._n_blocks + 1)].reshape(-1)
+        chunk[:len(blocks)] = blocks
+        return chunk
+
+    def restore_pass(self, epoch, audio):
+        '''
+            Publish a sound rendered beforehand (see restored_sound) chunk by chunk,
+            in the order of a regeneration pass and with the same crossfades,
+            so that the blocks under the playheads are not rewritten.
+            Returns False if the pass was interrupted by a new signal.
+        '''
+        # Blocks not published yet are not being played
+        for b in range(self._buffer.written, self._buffer.length):
+            self._buffer.write(b, audio[b])
+        self._buffer.commit(self._buffer.length)
+        regen = RegenerationScheduler(self._buffer.length, self._n_blocks, self._block_lookahead)
+        regen.restart(self._last_request_block)
+        while True:
+            if self._generate_signal.is_set() or not self._store.is_current(epoch):
+                return False
+            gen_block = regen.next(self._last_request_block, self._playheads)
+            if gen_block is None:
+                return True
+            if gen_block == RegenerationScheduler.wait:
+                time.sleep(self._block_size / self._sr)
+                continue
+            self.overwrite_chunk(gen_block, self.restored_chunk(audio, gen_block))
+
+    def store_cached(self, epoch):
+        '''
+            Keep the rendering of the current features, if the whole
+            sound has been rendered from the version of a given epoch.
+        '''
+        cur_epoch, features, key = self._store.keyed_snapshot()
+        if key is None or cur_epoch != epoch:
+            return
+        audio = self._buffer.snapshot()
+        if audio is not None:
+            self._cache.put(key, audio)
+        if self._spec_pass is not None:
+            for spec_key, spec_audio in zip(self._spec_pass[0], self._spec_pass[2]):
+                self._cache.put(spec_key, spec_audio)
+        self._spec_pass = None
+
     def start_generation_thread_full(self):
-        self._thread = threading.Thread(target=self.generate_thread_full, args=(1,))
+        if self._streaming:
+            self._stream = StreamingModel(self._model)
+            self._thread = threading.Thread(target=self.generate_thread_stream, args=(1,))
+        else:
+            self._thread = threading.Thread(target=self.generate_thread_full, args=(1,))
         self._thread.start()
 
     def signal_start_stream(self):
@@ -119,20 +451,32 @@ class NSF:
         # Signal the generation thread
         # self._generate_signal.set()
         
-    def generate_block(self, block_id):
-        cur_feats = self._features[:, block_id:(block_id + self._n_blocks + 1), :]
-        # print(cur_feats.shape)
+    def render_window(self, block_id, features):
+        '''
+            Render the chunk starting at block_id for a batch of features.
+            Returns the samples of the chunk and its overlap (batch, samples).
+        '''
+        # Send the chunk with the context planned by the scheduler
+        (in_start, in_stop), (crop_start, crop_stop) = self._scheduler.window(block_id)
+        cur_feats = features[:, in_start:in_stop, :]
+        if self.is_silent(cur_feats):
+            # Silent chunk (faded out by the crossfade with the previous one)
+            return np.zeros((features.shape[0], crop_stop - crop_start), dtype=np.float32)
         with torch.no_grad():
-            cur_audio = self._model(cur_feats).squeeze().detach().cpu().numpy()
+            cur_audio = self._model(cur_feats).detach().cpu().numpy()
+        return cur_audio.reshape(features.shape[0], -1)[:, crop_start:crop_stop]
+
+    def generate_block(self, block_id, features=None, cur_audio=None):
+        if cur_audio is None:
+            if features is None:
+                features = self._features
+            cur_audio = self.render_window(block_id, features)[0]
         if self._last_val is not None:
-            cur_audio[:512] = (self._last_val * np.linspace(1, 0, 512)) + (cur_audio[:512] * np.linspace(0, 1, 512))
+            cur_audio[:512] = (self._last_val * self._fade_out) + (cur_audio[:512] * self._fade_in)
         self._last_val = cur_audio[-512:]
         cur_audio = cur_audio[:-512]
-        block_audio = []
-        # print('CV ' + str(cv_id) + ' going active')
-        for b in range(self._n_blocks):
-            block_audio.append(cur_audio[(b * 512):((b+1)*512)])
-        return block_audio
+        # View the chunk as (n_blocks, block_size) without copying
+        return cur_audio.reshape(self._n_blocks, self._block_size)
     
     def generate_thread_full(self, args):
         # First do a full generation
@@ -143,46 +487,186 @@ class NSF:
                 # print('Generated full')
                 break
             # Generate a new block
+            # (a chunk rendered from a previous version is still published,
+            # it is crossfaded with the next one and regenerated afterwards)
             cur_audio = self.generate_block(self._last_gen_block)
-            # Append blocks to queue
+            # Write blocks to the buffer and publish them
             for b in range(self._n_blocks):
-                self._generated_queue.append(cur_audio[b])
+                self._buffer.write(self._last_gen_block + b, cur_audio[b])
             self._last_gen_block += self._n_blocks
+            self._buffer.commit(self._last_gen_block)
         # Then switch to block-wise mode
         self.generate_thread_block(args)
     
     def generate_thread_block(self, args):
-        self._generate_signal.clear()
+        # A signal received during the full generation starts a pass
+        self._regen = RegenerationScheduler(self._buffer.length, self._n_blocks, self._block_lookahead)
         while True:
-            # We have generated the full queue
-            if (self._last_gen_block + self._n_blocks + 1) > self._features.shape[1]:
+            gen_block = self._regen.next(self._last_request_block, self._playheads)
+            # We have regenerated the full queue
+            if gen_block is None:
+                if self._pass_epoch is not None:
+                    self.store_cached(self._pass_epoch)
+                    self._pass_epoch = None
                 self._generate_end = True
                 # print('Generate thread going to sleep')
                 self._generate_signal.wait()
-            # Waking up to generate
+            # Waking up to generate (restart from the playhead)
             if self._generate_signal.is_set():
                 self._generate_signal.clear()
-                self._last_gen_block = 0
-            # Infer which block to generate
-            # gen_block = (self.last_request_block // self._n_blocks) * self.n_blocks
-            # gen_block += (self.block_lookahead * self._n_blocks)
-            gen_block = self._last_gen_block
-            if gen_block == 0:
-                self._last_val = None
-            else:
-                self._last_val = self._generated_queue[gen_block]
-            if gen_block + self._n_blocks > len(self._generated_queue):
+                self._generate_end = False
+                self._spec_pass = None
+                restored = self.restored_sound()
+                if restored is not None:
+                    self._regen.cancel()
+                    self.restore_pass(*restored)
+                    continue
+                self._pass_epoch = self._store.epoch
+                self.start_speculation(self._pass_epoch)
+                self._regen.restart(self._last_request_block)
                 continue
-            cur_audio = self.generate_block(self._last_gen_block)
-            # Change blocks to queue
-            for b in range(self._n_blocks):
-                self._generated_queue[gen_block+b] = cur_audio[b]
-            if gen_block + self._n_blocks < len(self._generated_queue):
-                n_block = self._generated_queue[gen_block + self._n_blocks]
-                self._generated_queue[gen_block + self._n_blocks] = (self._last_val * np.linspace(1, 0, 512)) + (n_block * np.linspace(0, 1, 512))
-            #print('Finished update from ' + str(gen_block) + ' to ' + str(gen_block + self._n_blocks))
-            self._last_gen_block += self._n_blocks
-                          
+            # Remaining chunks are being played
+            if gen_block == RegenerationScheduler.wait:
+                time.sleep(self._block_size / self._sr)
+                continue
+            self.regenerate_chunk(gen_block)
+
+    def regenerate_chunk(self, gen_block):
+        '''
+            Overwrite a chunk of the buffer, crossfading with the blocks
+            around it (which may have been rendered from other features).
+        '''
+        if gen_block + self._n_blocks > self._buffer.written:
+            return
+        epoch, features = self._store.snapshot()
+        spec_pass = self._spec_pass
+        if spec_pass is not None:
+            features = torch.cat((features, spec_pass[1]))
+        batch_audio = self.render_window(gen_block, features)
+        # Drop the chunk if the features changed while rendering
+        # (the new version restarts a regeneration pass)
+        if not self._store.is_current(epoch):
+            return
+        if spec_pass is not None:
+            self.write_speculative(spec_pass[2], gen_block, batch_audio[1:])
+        self.overwrite_chunk(gen_block, batch_audio[0])
+        #print('Finished update from ' + str(gen_block) + ' to ' + str(gen_block + self._n_blocks))
+
+    def overwrite_chunk(self, gen_block, cur_audio):
+        '''
+            Write the samples of a chunk and its overlap in the buffer,
+            crossfading with the blocks around it.
+        '''
+        if gen_block == 0:
+            self._last_val = None
+        else:
+            self._last_val = self._buffer.block(gen_block).copy()
+        cur_audio = self.generate_block(gen_block, cur_audio=cur_audio)
+        # Overwrite blocks in the buffer
+        for b in range(self._n_blocks):
+            self._buffer.write(gen_block + b, cur_audio[b])
+        if gen_block + self._n_blocks < self._buffer.written:
+            n_block = self._buffer.block(gen_block + self._n_blocks)
+            self._buffer.write(gen_block + self._n_blocks, (self._last_val * self._fade_out) + (n_block * self._fade_in))
+
+    def speculate(self, mode, cv_list, epoch):
+        '''
+            Predict the next CV settings from the trend of the scalar CVs,
+            and prepare their features for the pass of a given epoch.
+        '''
+        scalars = [i for i, cv in enumerate(cv_list) if np.isscalar(cv)]
+        self._trend.push([cv_list[i] for i in scalars])
+        self._spec = None
+        if self._n_batch < 2:
+            return
+        keys, feats = [], []
+        for values in self._trend.predict(self._n_batch - 1, self._cv_step):
+            cvs = list(cv_list)
+            for i, v in zip(scalars, values):
+                cvs[i] = float(v)
+            key = cv_key(self._anchors, mode, cvs, self._cv_step)
+            if key in self._cache:
+                continue
+            keys.append(key)
+            feats.append(self.mode_features(mode, cvs))
+        if len(keys) > 0:
+            self._spec = (epoch, keys, torch.cat(feats))
+
+    def start_speculation(self, epoch):
+        '''
+            Render the predicted neighbours during the pass of a given epoch.
+            Their sounds start from the current buffer and follow the same
+            crossfades as the buffer itself.
+        '''
+        spec = self._spec
+        if spec is None or spec[0] != epoch:
+            return
+        audio = self._buffer.snapshot()
+        if audio is None:
+            return
+        self._spec_pass = (spec[1], spec[2], np.repeat(audio[np.newaxis], len(spec[1]), axis=0))
+
+    def write_speculative(self, blocks, gen_block, batch_audio):
+        '''
+            Write a chunk of the neighbours in their sounds (see regenerate_chunk).
+        '''
+        n_samples = self._n_blocks * self._block_size
+        chunk = batch_audio[:, :n_samples].reshape(len(blocks), self._n_blocks, self._block_size)
+        tail = batch_audio[:, n_samples:(n_samples + self._block_size)]
+        if gen_block > 0:
+            chunk[:, 0] = (blocks[:, gen_block] * self._fade_out) + (chunk[:, 0] * self._fade_in)
+        blocks[:, gen_block:(gen_block + self._n_blocks)] = chunk
+        if gen_block + self._n_blocks < blocks.shape[1]:
+            blocks[:, gen_block + self._n_blocks] = (tail * self._fade_out) + (blocks[:, gen_block + self._n_blocks] * self._fade_in)
+
+    def publish_pending(self, pending, cur_block):
+        '''
+            Write all complete blocks of pending samples to the buffer.
+            Returns the remaining samples and the next block to write.
+        '''
+        n_full = min(len(pending) // self._block_size, self._buffer.length - cur_block)
+        for b in range(n_full):
+            self._buffer.write(cur_block + b, pending[(b * self._block_size):((b + 1) * self._block_size)])
+        self._buffer.commit(cur_block + n_full)
+        return pending[(n_full * self._block_size):], cur_block + n_full
+
+    def generate_stream(self):
+        '''
+            Render the current features with the streaming model.
+            Each chunk only computes its own samples, so that blocks are exact
+            continuations of each other and need no crossfade.
+            Returns False if the generation was interrupted by a new signal.
+        '''
+        epoch, features = self._store.snapshot()
+        restored = self.restored_sound()
+        if restored is not None:
+            return self.restore_pass(*restored)
+        self._stream.reset()
+        pending = np.zeros(0, dtype=np.float32)
+        cur_block = 0
+        for start in range(0, features.shape[1], self._n_blocks):
+            if self._generate_signal.is_set() or not self._store.is_current(epoch):
+                return False
+            with torch.no_grad():
+                cur_audio = self._stream.push(features[:, start:(start + self._n_blocks), :])
+            pending = np.concatenate((pending, cur_audio.squeeze(0).cpu().numpy()))
+            pending, cur_block = self.publish_pending(pending, cur_block)
+        # Remaining samples (right padding of the condition module)
+        with torch.no_grad():
+            cur_audio = self._stream.flush()
+        pending = np.concatenate((pending, cur_audio.squeeze(0).cpu().numpy()))
+        self.publish_pending(pending, cur_block)
+        self.store_cached(epoch)
+        return True
+
+    def generate_thread_stream(self, args):
+        while True:
+            self._generate_signal.clear()
+            if self.generate_stream():
+                self._generate_end = True
+                self._generate_signal.wait()
+            self._generate_end = False
+
     def request_block_direct(self, block_idx):
         print('Request block : ' + str(block_idx))
         print(len(self._features))
@@ -195,16 +679,18 @@ class NSF:
             print('Block generated')
         return self._current_chunk[block_idx % self._n_blocks]
     
-    def request_block_threaded(self, block_idx):
-        # print('Request block : ' + str(block_idx))
-        # Update requested block
-        self._last_request_block = block_idx
-        # Signal the generation thread
-        # self._generate_signal.set()
-        # Check if we have ended
-        if len(self._generated_queue) <= block_idx:
-            return None
-        return self._generated_queue[block_idx]
+    def request_voices(self, voices, out):
+        '''
+            Mix the blocks of all playing voices into the output buffer.
+            The most recent voice drives the regeneration after CV changes,
+            the blocks played by the other voices are kept until they are heard.
+            Returns False when no voice is left.
+        '''
+        playhead = voices.mix(self._buffer, out)
+        playheads = voices.playheads()
+        self._playheads = playheads[playheads != playhead]
+        self._last_request_block = playhead if playhead >= 0 else self._buffer.length
+        return playhead >= 0
 
     def features_loading(self):
         wav_list = ['dce_synth_one_shot_bumper_G#min.wav', 'SH_FFX_123BPM_IMPACT_01.wav',
@@ -213,11 +699,11 @@ class NSF:
             if not os.path.exists("models/features_interp" + str(wav) + ".th"):
                 y, sr = librosa.load("data/" + wav)
                 features = spectral_features(y, sr)
-                features = torch.tensor(features).unsqueeze(0).cuda().float()
+                features = torch.tensor(features).unsqueeze(0).float()
                 torch.save(features, "models/features_interp" + str(wav) + ".th")
         feats = []
         for wav in wav_list:
-            ft = torch.load("models/features_interp" + str(wav) + ".th")
+            ft = torch.load("models/features_interp" + str(wav) + ".th", map_location=self._device)
             feats.append(ft)
         # Create sounds list
         snd_list = [] * 4
@@ -231,10 +717,13 @@ class NSF:
         for i in range(len(snd_list)):
             snd_list[i] = snd_list[i][:, :min_size, :]
         self._features_list = snd_list
+        self._anchors = tuple(wav_list[:len(snd_list)])
 
     def interp_duo(self, cv_list):
         # Simulate CVs
         # cv_list = [random.sample(range(-4, 4), 1)[0]] * 4
+        cv_list = [quantise_cv(x, self._cv_step) for x in cv_list]
+        key = cv_key(self._anchors, 'duo', cv_list, self._cv_step)
         cv_list = [(x + 4) / 8 for x in cv_list]
         print(cv_list)
         snd_1 = self._features_list[0]
@@ -245,40 +734,72 @@ class NSF:
         x_interp = snd_1.clone()
         for i, alpha in zip(feats_list, cv_list):
             x_interp[:, :, i] = (1 - alpha) * snd_2[:, :, i] + alpha * snd_1[:, :, i]
-        self._features = x_interp
+        self._store.swap(x_interp, key)
         print(torch.mean(self._features, dim=(0, 1)))
         print('End of interpolate')
         self._generate_signal.set()
 
-    def interp_trio(self, cv_list):
-        # Simulate CVs
-        # cv_list = [random.sample(range(-4, 4), 1)[0]] * 4
+    def trio_features(self, cv_list):
+        '''
+            Features mixing the anchors with weights given by the CVs.
+        '''
         cv_list = [(x + 4) / 8 for x in cv_list]
         cv_sum = sum(cv_list)
         if abs(2 - cv_sum) < 0.1:
             cv_list = [1, 0, 0, 0]
-        print(cv_list)
         # Run through CV values
         interp = torch.zeros_like(self._features_list[0])
         for i, snd in enumerate(self._features_list):
             interp += snd * cv_list[i] / cv_sum
-        self._features = interp
+        return interp
+
+    def mode_features(self, mode, cv_list):
+        '''
+            Features of an interpolation mode ('trio' or 'final') for a set of CVs.
+        '''
+        if mode == 'trio':
+            return self.trio_features(cv_list)
+        return self.final_features((cv_list[0] + 4) / 8, *cv_list[1:])
+
+    def interp_trio(self, cv_list):
+        # Simulate CVs
+        # cv_list = [random.sample(range(-4, 4), 1)[0]] * 4
+        cv_list = [quantise_cv(x, self._cv_step) for x in cv_list]
+        key = cv_key(self._anchors, 'trio', cv_list, self._cv_step)
+        print(cv_list)
+        epoch = self._store.swap(self.trio_features(cv_list), key)
+        self.speculate('trio', cv_list, epoch)
         print('End of interpolate')
         self._generate_signal.set()
         
+    def final_features(self, alpha, cv3, cv4, cv5):
+        '''
+            Features morphed between the first two anchors (alpha in [0, 1]),
+            with descriptors 2 to 4 scaled by cv3 to cv5 (scalars or curves).
+        '''
+        # Run through CV values
+        interp = (1 - alpha) * self._features_list[0] + (alpha * self._features_list[1])
+        interp[:, :, 2] = interp[:, :, 2] * torch.tensor(cv3).unsqueeze(0).to(self._device)
+        interp[:, :, 3] = interp[:, :, 3] * torch.tensor(cv4).unsqueeze(0).to(self._device)
+        interp[:, :, 4] = interp[:, :, 4] * torch.tensor(cv5).unsqueeze(0).to(self._device)
+        return interp
+
     def interp_final(self, cv_control, cv3, cv4, cv5):
         print('Interpolating sounds')
         print(cv_control)
         print(cv3)
         print(cv4)
         print(cv5)
+        # Quantised values are rendered, so that a cached sound matches its key
+        cv_control, cv3, cv4, cv5 = [quantise_cv(x, self._cv_step) for x in (cv_control, cv3, cv4, cv5)]
+        key = cv_key(self._anchors, 'final', [cv_control, cv3, cv4, cv5], self._cv_step)
         alpha = (cv_control + 4) / 8
-        # Run through CV values
-        interp = (1 - alpha) * self._features_list[0] + (alpha * self._features_list[1])
-        interp[:, :, 2] = interp[:, :, 2] * torch.tensor(cv3).unsqueeze(0).cuda()
-        interp[:, :, 3] = interp[:, :, 3] * torch.tensor(cv4).unsqueeze(0).cuda()
-        interp[:, :, 4] = interp[:, :, 4] * torch.tensor(cv5).unsqueeze(0).cuda()
-        self._features = interp
+        interp = self.final_features(alpha, cv3, cv4, cv5)
+        epoch = self._store.swap(interp, key)
+        # Constant scalers can be answered by the morph grid
+        if all(np.isscalar(cv) or np.ptp(cv) == 0 for cv in (cv3, cv4, cv5)):
+            self._grid_query = (epoch, [alpha] + [cv if np.isscalar(cv) else cv[0] for cv in (cv3, cv4, cv5)])
+        self.speculate('final', [cv_control, cv3, cv4, cv5], epoch)
         print('End of interpolate')
         self._generate_signal.set()
         
@@ -0,0 +1,124 @@
+"""
+
+ ~ Neurorack project ~
+ Render cache : Memory of the impacts already generated
+
+ This file contains the render cache, which keeps the audio generated for
+ the most recent CV settings. Keys are built from the quantised CV values
+ (scalars or full CV buffers) and the set of anchor sounds, so that a gate
+ repeated at the same settings plays from memory instead of running the
+ model again. Entries are evicted in least-recently-used order once the
+ memory budget is exceeded.
+
+ Author               :  Ninon Devis, Philippe Esling, Martin Vert
+                        <{devis, esling}@ircam.fr>
+
+ All authors contributed equally to the project and are listed aphabetically.
+
+"""
+
+import threading
+import collections
+import numpy as np
+
+
+def quantise_cv(value, step: float = 0.05):
+    '''
+        Quantise a CV value (scalar or buffer of values) to a given step.
+        Returns the quantised value, with the same type as the input.
+    '''
+    if np.isscalar(value):
+        return float(np.round(value / step) * step)
+    return (np.round(np.asarray(value, dtype=np.float64) / step) * step).tolist()
+
+
+def cv_key(anchors: tuple, mode: str, cv_list: list, step: float = 0.05):
+    '''
+        Build the cache key of a set of (already quantised) CV values.
+        Buffers are hashed through their bytes, to keep keys small.
+    '''
+    key = [anchors, mode]
+    for cv in cv_list:
+        steps = np.round(np.asarray(cv, dtype=np.float64) / step).astype(np.int32)
+        key.append(steps.item() if steps.ndim == 0 else (steps.shape, steps.tobytes()))
+    return tuple(key)
+
+
+class RenderCache():
+    '''
+        The RenderCache class is a LRU dictionary of rendered sounds
+        (numpy arrays) bounded by a memory budget in bytes.
+        Hits and misses are counted to help sizing the budget.
+    '''
+
+    def __init__(self,
+                 budget: int = 64 * 2**20):
+        '''
+            Constructor - Creates a new instance of the RenderCache class.
+            Parameters:
+                budget:     [int], optional
+                            Maximum memory used by the entries (in bytes) [default: 64MB]
+        '''
+        self._budget = budget
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        '''
+            Return the sound stored for a key (None on a miss).
+        '''
+        if key is None:
+            return None
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, key, audio):
+        '''
+            Store a copy of a sound, evicting the least recently used ones.
+        '''
+        if key is None or audio.nbytes > self._budget:
+            return
+        audio = audio.copy()
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key).nbytes
+            self._entries[key] = audio
+            self.nbytes += audio.nbytes
+            while self.nbytes > self._budget:
+                _, old = self._entries.popitem(last=False)
+                self.nbytes -= old.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        '''
+            Counters of the cache (hit rate is None before any request).
+        '''
+        requests = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self.nbytes,
+            'budget': self._budget,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': (self.hits / requests) if requests > 0 else None}
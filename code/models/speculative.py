@@ -0,0 +1,99 @@
+"""
+
+ ~ Neurorack project ~
+ Speculative : Prediction of the next CV settings
+
+ This file contains the CV trend tracker used for speculative rendering.
+ The model renders the current CV settings along with a few predicted
+ neighbours in the same (batched) forward pass, and the predictions are
+ stored in the render cache, so that the audio is already waiting when
+ the CV lands on one of them.
+
+ Author               :  Ninon Devis, Philippe Esling, Martin Vert
+                        <{devis, esling}@ircam.fr>
+
+ All authors contributed equally to the project and are listed aphabetically.
+
+"""
+
+import collections
+import numpy as np
+
+
+class CVTrend():
+    '''
+        The CVTrend class keeps the recent values of a set of scalar CVs and
+        extrapolates their trend. When the CVs do not move, the neighbours
+        move one CV at a time by a few quantisation steps around the current
+        values, among the CVs that moved recently (the others stay fixed).
+    '''
+
+    def __init__(self,
+                 history: int = 8):
+        '''
+            Constructor - Creates a new instance of the CVTrend class.
+            Parameters:
+                history:    [int], optional
+                            Number of CV values kept [default: 8]
+        '''
+        self._values = collections.deque(maxlen=history)
+
+    def push(self, values):
+        '''
+            Record a new set of CV values (the history is cleared if the
+            number of CVs changes).
+        '''
+        values = np.asarray(values, dtype=np.float64)
+        if len(self._values) > 0 and self._values[-1].shape != values.shape:
+            self._values.clear()
+        self._values.append(values)
+
+    def slope(self):
+        '''
+            Average change of the CVs between two consecutive values.
+        '''
+        if len(self._values) < 2:
+            return None
+        return (self._values[-1] - self._values[0]) / (len(self._values) - 1)
+
+    def active(self):
+        '''
+            Indices of the CVs that moved in the history, by decreasing
+            range of motion (all CVs if none of them moved).
+        '''
+        history = np.array(self._values)
+        motion = np.ptp(history, axis=0)
+        active = np.flatnonzero(motion > 0)
+        if len(active) == 0:
+            return np.arange(history.shape[1])
+        return active[np.argsort(-motion[active], kind='stable')]
+
+    def predict(self, n: int, step: float = 0.05):
+        '''
+            Predict up to n neighbours of the current CV values, quantised to
+            the given step, in decreasing order of likelihood.
+        '''
+        if len(self._values) == 0 or n < 1:
+            return []
+        current = self._values[-1]
+        slope = self.slope()
+        candidates = []
+        if slope is None or np.max(np.abs(slope)) < step:
+            # No trend: closest steps on both sides of one active CV at a time
+            for k in range(1, n + 1):
+                for i in self.active():
+                    for sign in [1, -1]:
+                        values = current.copy()
+                        values[i] += sign * k * step
+                        candidates.append(values)
+        else:
+            candidates = [current + (k * slope) for k in range(1, n + 1)]
+        neighbours = []
+        for values in candidates:
+            values = np.round(values / step) * step
+            if np.allclose(values, current) or any(np.allclose(values, v) for v in neighbours):
+                continue
+            neighbours.append(values)
+            if len(neighbours) == n:
+                break
+        return neighbours
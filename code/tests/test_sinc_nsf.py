@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+"""
+test_sinc_nsf.py for hn-sinc-NSF
+
+Checks of the optimised layers of sinc_nsf.py against their reference
+implementations (kept in the same classes), and of the streaming model
+against the offline forward:
+ - TimeVarFIRFilter.forward (unfold) / forward_roll, with and without
+   the history of a previous chunk
+ - SincFilter look-up tables / exact coefficients
+ - MovingAverage prefix sums / convolution, and the up-sampling fused
+   with the first moving average
+ - SineGen.harmonic_sines (sinc_nsf.py and nsf.py) / SineGen._f02sine,
+   and split in two calls carrying the phase
+ - StreamingModel pushed chunk by chunk / Model.forward (sine source on),
+   and the phase of StreamSineGen carried between chunks
+
+Usage:
+ python -m pytest tests
+"""
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import pytest
+import torch
+
+from models.nsf import nsf
+from models.nsf import sinc_nsf
+from models.nsf.streaming import StreamingModel, StreamSineGen
+
+__author__ = "Ninon Devis, Philippe Esling, Martin Vert"
+__email__ = "{devis, esling}@ircam.fr"
+
+
+def small_model():
+    """ randomly initialised sinc_nsf.Model of a reduced size, with the
+    sine source on and without additive noise (the noise branch and the
+    noise of the voiced steps), so that the output only depends on the
+    features and on the random initial phases of the harmonics
+    """
+    model = sinc_nsf.Model(7, 1, argparse.Namespace(sr=22050),
+                           hidden_dim=16, filter_block_num=2,
+                           cnn_num_in_block=3, harmonic_num=4)
+    model.m_source.l_sin_gen.noise_std = 0
+    model.m_source.sine_amp = 0
+    model.eval()
+    return model
+
+
+def features(frames, seed=0):
+    """ random features (batchsize=1, frames, 7), voiced F0 as last dim
+    """
+    gen = torch.Generator().manual_seed(seed)
+    feat = torch.randn(1, frames, 7, generator=gen)
+    feat[:, :, -1] = 100 + 300 * torch.rand(1, frames, generator=gen)
+    return feat
+
+
+@pytest.mark.parametrize("chunk_size", [16384, 100])
+def test_time_var_fir_matches_roll(chunk_size):
+    gen = torch.Generator().manual_seed(0)
+    signal = torch.randn(1, 1000, 1, generator=gen)
+    f_coef = torch.randn(1, 1000, 31, generator=gen)
+    l_fir = sinc_nsf.TimeVarFIRFilter()
+    l_fir.chunk_size = chunk_size
+    torch.testing.assert_close(l_fir(signal, f_coef),
+                               l_fir.forward_roll(signal, f_coef),
+                               rtol=0, atol=1e-5)
+
+
+def test_time_var_fir_history():
+    gen = torch.Generator().manual_seed(0)
+    signal = torch.randn(1, 1000, 1, generator=gen)
+    f_coef = torch.randn(1, 1000, 31, generator=gen)
+    l_fir = sinc_nsf.TimeVarFIRFilter()
+    reference = l_fir.forward_roll(signal, f_coef)
+    # second half filtered with the last samples of the first half
+    split = 437
+    output = l_fir(signal[:, split:], f_coef[:, split:],
+                   history=signal[:, split - 30:split])
+    torch.testing.assert_close(output, reference[:, split:],
+                               rtol=0, atol=1e-5)
+
+
+def test_sinc_lut():
+    l_sinc = sinc_nsf.SincFilter(31)
+    cut_f = sinc_nsf.SincFilter.lut_range[0] + torch.rand(1, 500, 1) * \
+        (sinc_nsf.SincFilter.lut_range[1] - sinc_nsf.SincFilter.lut_range[0])
+    lp_ref, hp_ref = l_sinc(cut_f)
+    error = l_sinc.enable_lut(4096)
+    assert error['lp'] < 1e-5 and error['hp'] < 1e-5
+    lp_coef, hp_coef = l_sinc(cut_f)
+    torch.testing.assert_close(lp_coef, lp_ref, rtol=0, atol=1e-5)
+    torch.testing.assert_close(hp_coef, hp_ref, rtol=0, atol=1e-5)
+    l_sinc.disable_lut()
+    torch.testing.assert_close(l_sinc(cut_f)[0], lp_ref)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="no CUDA device")
+def test_sinc_lut_device():
+    # the tables are built on the device of the model
+    l_sinc = sinc_nsf.SincFilter(31).to('cuda')
+    cut_f = torch.full((1, 10, 1), 0.3, device='cuda')
+    lp_ref, hp_ref = l_sinc(cut_f)
+    error = l_sinc.enable_lut(4096, device=cut_f.device)
+    assert error['lp'] < 1e-5 and error['hp'] < 1e-5
+    assert l_sinc.lut_lp.device == cut_f.device
+    torch.testing.assert_close(l_sinc(cut_f)[0], lp_ref, rtol=0, atol=1e-5)
+
+
+@pytest.mark.parametrize("length", [1, 100, 2000])
+def test_moving_average_prefix_sum(length):
+    l_ave = sinc_nsf.MovingAverage(3, 512)
+    data = torch.randn(1, length, 3, generator=torch.Generator().manual_seed(0))
+    with torch.no_grad():
+        torch.testing.assert_close(l_ave(data), l_ave.forward_conv(data),
+                                   rtol=0, atol=1e-5)
+
+
+@pytest.mark.parametrize("length", [1, 5, 40])
+def test_up_sample_fused(length):
+    l_up = sinc_nsf.UpSampleLayer(3, 512, smoothing=True)
+    data = torch.randn(1, length, 3, generator=torch.Generator().manual_seed(0))
+    with torch.no_grad():
+        torch.testing.assert_close(l_up(data), l_up.forward_reference(data),
+                                   rtol=0, atol=1e-5)
+
+
+def harmonic_inputs(gen):
+    """ sample-level F0 (batchsize=1, length, 1) and random initial
+    phases of the harmonics, drawn as in SineGen._f02sine (seed 0)
+    """
+    f0 = features(20)[:, :, -1:].repeat_interleave(512, dim=1)
+    torch.manual_seed(0)
+    offset = torch.rand(1, gen.dim)
+    offset[:, 0] = 0
+    return f0, offset
+
+
+@pytest.mark.parametrize("module", [sinc_nsf, nsf])
+def test_harmonic_sines_phase(module):
+    gen = module.SineGen(22050, harmonic_num=16)
+    f0, offset = harmonic_inputs(gen)
+    phase = torch.zeros(1, 1, dtype=torch.float64)
+    reference = gen.harmonic_sines(f0, phase, offset)[0]
+    split = 3333
+    first, phase = gen.harmonic_sines(f0[:, :split], phase, offset)
+    second = gen.harmonic_sines(f0[:, split:], phase, offset)[0]
+    torch.testing.assert_close(torch.cat((first, second), dim=1), reference,
+                               rtol=0, atol=1e-5)
+
+
+@pytest.mark.parametrize("module", [sinc_nsf, nsf])
+def test_harmonic_sines_matches_f02sine(module):
+    gen = module.SineGen(22050, harmonic_num=16)
+    f0, offset = harmonic_inputs(gen)
+    output = gen.harmonic_sines(f0, torch.zeros(1, 1, dtype=torch.float64),
+                                offset)[0]
+    # same initial phases (first random draw), float32 phase accumulation
+    torch.manual_seed(0)
+    reference = gen._f02sine(f0 * torch.arange(1, gen.dim + 1))
+    torch.testing.assert_close(output, reference, rtol=0, atol=1e-2)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 15])
+def test_streaming_matches_offline(chunk_size):
+    model = small_model()
+    feat = features(40)
+    with torch.no_grad():
+        torch.manual_seed(0)
+        reference = model(feat)
+        torch.manual_seed(0)
+        stream = StreamingModel(model)
+        outputs = [stream.push(chunk)
+                   for chunk in torch.split(feat, chunk_size, dim=1)]
+        outputs.append(stream.flush())
+    output = torch.cat(outputs, dim=1)
+    assert output.shape[1] >= reference.shape[1]
+    torch.testing.assert_close(output[:, :reference.shape[1]], reference,
+                               rtol=0, atol=1e-4)
+    # the sine source contributes to the output
+    model.m_source.l_sin_gen.sine_amp = 0
+    with torch.no_grad():
+        torch.manual_seed(0)
+        muted = model(feat)
+    assert (muted - reference).abs().max() > 1e-2
+
+
+@pytest.mark.parametrize("chunk_size", [1, 333, 5000])
+def test_stream_sine_phase(chunk_size):
+    # initial phases of the harmonics are the first random draw of both
+    gen = sinc_nsf.SineGen(22050, harmonic_num=4, noise_std=0)
+    f0 = features(20)[:, :, -1:].repeat_interleave(512, dim=1)
+    torch.manual_seed(0)
+    reference = gen(f0)[0]
+    torch.manual_seed(0)
+    stream = StreamSineGen(gen)
+    output = torch.cat([stream.push(chunk) for chunk in
+                        torch.split(f0, chunk_size, dim=1)], dim=1)
+    torch.testing.assert_close(output, reference, rtol=0, atol=1e-4)
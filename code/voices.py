@@ -0,0 +1,157 @@
+"""
+
+ ~ Neurorack project ~
+ Voices : Polyphonic playback of the generated impacts
+
+ This file contains the voice pool used by the audio callback. Each gate
+ starts a new voice (playhead) over the generated blocks, so that the tail
+ of the previous impacts keeps ringing. New voices start with a short
+ fade in and, when all voices are busy, the oldest one is stolen with a
+ short fade out.
+
+ Author               :  Ninon Devis, Philippe Esling, Martin Vert
+                        <{devis, esling}@ircam.fr>
+
+ All authors contributed equally to the project and are listed aphabetically.
+
+"""
+
+import numpy as np
+from models.block_buffer import BlockBuffer
+
+
+class VoicePool():
+    '''
+        The VoicePool class mixes several playheads reading a BlockBuffer.
+        Voices are stored in flat arrays (position, age, envelope) so that
+        the mix is a single vectorised pass whatever the number of voices.
+        All voice states are only modified in the output callback: trigger
+        only counts the gates, which are started at the next block.
+    '''
+    # Envelopes applied to a voice on its next block
+    env_steady  = 0
+    env_release = 1
+    env_attack  = 2
+
+    def __init__(self,
+                 n_voices: int = 4,
+                 block_size: int = 512,
+                 fade: int = 64):
+        '''
+            Constructor - Creates a new instance of the VoicePool class.
+            Parameters:
+                n_voices:   [int], optional
+                            Maximum number of sounding voices [default: 4]
+                block_size: [int], optional
+                            Number of samples per block [default: 512]
+                fade:       [int], optional
+                            Length of the fade in of new voices and of the fade out
+                            of stolen voices (in samples) [default: 64]
+        '''
+        self._n_voices = n_voices
+        self._block_size = block_size
+        # Stolen voices release during one block, next to the voices replacing them
+        n_slots = 2 * n_voices
+        self._pos = np.full(n_slots, -1, dtype=np.int64)
+        self._age = np.zeros(n_slots, dtype=np.int64)
+        self._env = np.zeros(n_slots, dtype=np.int64)
+        # Preallocated mixing buffers
+        self._blocks = np.zeros((n_slots, block_size), dtype=np.float32)
+        self._gains = np.zeros((n_slots, block_size), dtype=np.float32)
+        self._status = np.zeros(n_slots, dtype=np.int64)
+        # Envelope table (steady, release, attack)
+        fade = min(fade, block_size)
+        self._envelopes = np.ones((3, block_size), dtype=np.float32)
+        self._envelopes[self.env_release, :fade] = np.linspace(1, 0, fade, dtype=np.float32)
+        self._envelopes[self.env_release, fade:] = 0
+        self._envelopes[self.env_attack, :fade] = np.linspace(0, 1, fade, dtype=np.float32)
+        # Gates counted by trigger and started by mix
+        self._triggers = 0
+        self._started = 0
+        self.stolen = 0
+
+    @property
+    def n_voices(self):
+        return self._n_voices
+
+    @property
+    def active(self):
+        ''' Number of voices currently sounding (including releases) '''
+        return int(np.count_nonzero(self._pos >= 0))
+
+    def trigger(self):
+        '''
+            Request a new voice, started on the next output block.
+        '''
+        self._triggers += 1
+
+    def reset(self):
+        '''
+            Silence all voices.
+        '''
+        self._pos.fill(-1)
+        self._started = self._triggers
+
+    def start_pending(self):
+        '''
+            Start the voices requested since the last block (callback side).
+        '''
+        while self._started < self._triggers:
+            self._started += 1
+            sounding = (self._pos >= 0) & (self._env != self.env_release)
+            if np.count_nonzero(sounding) >= self._n_voices:
+                # Steal the oldest voice
+                oldest = np.flatnonzero(sounding)[np.argmin(self._age[sounding])]
+                self._env[oldest] = self.env_release
+                self.stolen += 1
+            free = np.flatnonzero(self._pos < 0)
+            if len(free) > 0:
+                voice = free[0]
+            else:
+                # Only releasing voices are left (gates faster than a block)
+                voice = np.argmin(self._age)
+            self._pos[voice] = 0
+            self._age[voice] = self._started
+            self._env[voice] = self.env_attack
+
+    def mix(self, buffer: BlockBuffer, out):
+        '''
+            Mix the next block of all voices into the output buffer.
+            Voices waiting on a block not yet generated play silence and stay
+            in place, voices reaching the end of the stream are freed.
+            Parameters:
+                buffer:     [BlockBuffer]
+                            Generated blocks
+                out:        [np.ndarray]
+                            Output buffer (block_size)
+            Returns the position of the most recent voice (-1 if none is left).
+        '''
+        self.start_pending()
+        voices = np.flatnonzero(self._pos >= 0)
+        n = len(voices)
+        if n == 0:
+            out.fill(0)
+            return -1
+        pos = self._pos[voices]
+        blocks = self._blocks[:n]
+        gains = self._gains[:n]
+        status = self._status[:n]
+        buffer.gather(pos, blocks, status)
+        np.take(self._envelopes, self._env[voices], axis=0, out=gains, mode='clip')
+        np.einsum('vs,vs->s', blocks, gains, out=out)
+        # Move the playheads (released and finished voices are freed)
+        # Voices fade in on their first block actually played
+        self._env[voices[(status == BlockBuffer.ok) & (self._env[voices] == self.env_attack)]] = self.env_steady
+        self._pos[voices[status == BlockBuffer.ok]] += 1
+        self._pos[voices[(status == BlockBuffer.end) | (self._env[voices] == self.env_release)]] = -1
+        sounding = self._pos >= 0
+        if not sounding.any():
+            return -1
+        return int(self._pos[sounding][np.argmax(self._age[sounding])])
+
+    def playheads(self):
+        '''
+            Positions of all sounding voices (including releases), which
+            must not be overwritten while they are being played.
+        '''
+        return self._pos[self._pos >= 0].copy()